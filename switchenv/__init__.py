@@ -1,2 +1,6 @@
 # flake8: noqa
+# Imported first so that tracing can time the rest of the imports
+from . import trace
 from .version import __version__
+from .api import activated, get_environ
+from .environ import ActivationError
@@ -0,0 +1,89 @@
+import contextlib
+import os
+import threading
+
+from .cache import file_fingerprint
+from .environ import apply_delta, environment_fingerprint
+from .switchenv import SwitchEnv
+
+# A long-running process reuses one SwitchEnv (and the blob it has parsed)
+# per thread until the store changes on disk.  Threads don't share them,
+# since sqlite connections can only be used by the thread that opened them.
+_local = threading.local()
+
+# Maps (store, profile, bashrc, environment) fingerprints to profile deltas
+_deltas = {}
+MAX_MEMOIZED_DELTAS = 256
+
+
+def _get_switchenv():
+    swenv = getattr(_local, 'swenv', None)
+    if swenv is None:
+        swenv = _local.swenv = SwitchEnv()
+        _local.store_fingerprint = swenv.store.fingerprint()
+    else:
+        fingerprint = swenv.store.fingerprint()
+        if fingerprint != _local.store_fingerprint:
+            swenv = _local.swenv = SwitchEnv()
+            _local.store_fingerprint = fingerprint
+    return swenv
+
+
+def get_delta(profile):
+    """
+    Returns the changes a profile makes to the current environment as a
+    dict with 'set' and 'unset' keys.  Raises KeyError for unknown profiles,
+    and switchenv.ActivationError if the environment the profile makes can't
+    be worked out, such as when bash couldn't run it to the end, a cached
+    profile's code failed or a provider value couldn't be fetched.
+    """
+    swenv = _get_switchenv()
+    env = swenv.env
+    memo_key = (_local.store_fingerprint, profile, file_fingerprint(swenv.BASH_RC_FILE), environment_fingerprint(env))
+    if memo_key in _deltas:
+        return _deltas[memo_key]
+
+    if swenv.store.get(profile) is None:
+        raise KeyError(f"No profile named '{profile}'")
+
+    # Profiles that only export literal values are applied without running bash
+    delta = swenv.activation_delta(profile)
+
+    # Cached profiles expire and can be refreshed and provider values can change,
+    # so go back to them every time
+    if not swenv.leaves_of_type(profile, 'cached', 'providers'):
+        if len(_deltas) >= MAX_MEMOIZED_DELTAS:
+            _deltas.clear()
+        _deltas[memo_key] = delta
+    return delta
+
+
+def get_environ(profile):
+    """
+    Returns the environment a command run with 'sw exec -p PROFILE' would see, as a dict
+    """
+    delta = get_delta(profile)
+    return apply_delta(_get_switchenv().env, delta)
+
+
+@contextlib.contextmanager
+def activated(profile):
+    """
+    Temporarily apply a profile to os.environ.  Everything the profile
+    changed is put back the way it was on exit.
+    """
+    delta = get_delta(profile)
+    changed_keys = set(delta['set']) | set(delta['unset'])
+    saved = {key: os.environ.get(key) for key in changed_keys}
+
+    for key in delta['unset']:
+        os.environ.pop(key, None)
+    os.environ.update(delta['set'])
+    try:
+        yield os.environ
+    finally:
+        for key, val in saved.items():
+            if val is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = val
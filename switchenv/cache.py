@@ -0,0 +1,174 @@
+import hashlib
+import os
+
+from .trace import tracer
+
+
+class FileCache:
+    """
+    A directory of content-addressed files with least-recently-used eviction.
+
+    Entries are never modified once written.  New entries are written to a
+    private temp file and renamed into place, so concurrent readers never see
+    partial contents.  A cache hit bumps the entry's mtime, and eviction
+    removes the entries with the oldest mtimes first.
+    """
+    DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+    TEMP_PREFIX = '.tmp-'
+
+    def __init__(self, directory, max_bytes=None, suffix=''):
+        self.directory = directory
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('SWITCHENV_CACHE_MAX_BYTES', self.DEFAULT_MAX_BYTES))
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Hash an arbitrary sequence of parts into a cache key
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode('utf-8', 'surrogateescape'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f'{key}{self.suffix}')
+
+    def get(self, key):
+        """
+        Returns the path of a cached entry, or None on a miss.
+        """
+        path = self.path_for(key)
+        try:
+            # Touching the file is both the existence check and the LRU bump
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def read(self, key):
+        """
+        Returns the contents of a cached entry, or None on a miss.
+        """
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            with open(path) as buff:
+                text = buff.read()
+        except FileNotFoundError:
+            return None
+        tracer.count('files_read')
+        return text
+
+    def discard(self, key):
+        """
+        Remove an entry.  Returns True if there was one.
+        """
+        try:
+            os.unlink(self.path_for(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, text):
+        """
+        Atomically store text under key and return the path of the entry
+        """
+        # tempfile drags in several other modules, so only import it on a miss
+        import tempfile
+
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+        # mkstemp creates the file readable only by its owner.  Cached
+        # scripts carry exported environment values, so keep it that way.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=self.TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'w') as buff:
+                buff.write(text)
+            path = self.path_for(key)
+            os.replace(temp_path, path)
+        except BaseException:
+            unlink_if_exists(temp_path)
+            raise
+        tracer.count('files_written')
+
+        self.evict()
+        return path
+
+    def entries(self):
+        """
+        Returns a list of (path, stat_result) tuples for every cached entry
+        """
+        entries = []
+        try:
+            dir_entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return entries
+
+        for dir_entry in dir_entries:
+            if dir_entry.name.startswith(self.TEMP_PREFIX) or not dir_entry.name.endswith(self.suffix):
+                continue
+            try:
+                entries.append((dir_entry.path, dir_entry.stat()))
+            except FileNotFoundError:
+                pass
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        Returns the number of entries removed.
+        """
+        entries = self.entries()
+        total = sum(stat.st_size for _, stat in entries)
+        removed = 0
+        for path, stat in sorted(entries, key=lambda entry: entry[1].st_mtime_ns):
+            if total <= self.max_bytes:
+                break
+            unlink_if_exists(path)
+            total -= stat.st_size
+            removed += 1
+        return removed
+
+    def stats(self):
+        entries = self.entries()
+        mtimes = [stat.st_mtime for _, stat in entries]
+        return {
+            'directory': self.directory,
+            'entries': len(entries),
+            'bytes': sum(stat.st_size for _, stat in entries),
+            'max_bytes': self.max_bytes,
+            'oldest': min(mtimes) if mtimes else None,
+            'newest': max(mtimes) if mtimes else None,
+        }
+
+    def clear(self):
+        """
+        Remove every entry.  Returns the number of entries removed.
+        """
+        entries = self.entries()
+        for path, _ in entries:
+            unlink_if_exists(path)
+        return len(entries)
+
+
+def unlink_if_exists(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def file_fingerprint(path):
+    """
+    A cheap identity for a file's contents based only on a stat call
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return 'missing'
+    return f'{stat.st_ino}:{stat.st_mtime_ns}:{stat.st_size}'
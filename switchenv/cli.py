@@ -0,0 +1,575 @@
+import json
+import os
+import sys
+import textwrap
+
+import click
+
+from .resolver import ProfileCycleError
+from .storage import STORES, convert_store, open_layered_store
+from .switchenv import (
+    DAEMON_SOCKET,
+    BlobDirHandler,
+    SwitchEnv,
+    ensure_profiles_exist,
+    print_matches,
+    print_names,
+    print_profiles,
+    print_switch,
+    run_exec,
+    run_switch_env,
+)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(help='Show usage examples')
+def examples():
+    text = textwrap.dedent("""
+
+    # Snapshot the current environment as a profile
+    switchenv snapshot -p my_snapshot_profile_name
+
+    # Add an existing shell script as a profile
+    switchenv add -p my_profile_name -f path/to/my_scrpt.sh
+
+    # Add a script that fetches secrets, running it at most once an hour
+    switchenv add -p my_secrets -f path/to/fetch_secrets.sh --cache-for 3600
+
+    # Fetch a cached profile's secrets again on its next use
+    switchenv refresh -p my_secrets
+
+    # Add a profile whose variables are fetched concurrently on every use from
+    # lines like TOKEN=cmd:vault read -field=token secret/app, CERT=file:~/ca.pem or ME=env:USER
+    switchenv add -p my_tokens -f path/to/providers.txt --providers [--timeout 5]
+
+    # Add every .sh file in a directory as a profile named after the file
+    switchenv add --dir path/to/scripts --glob '*.sh' [--dry-run]
+
+    # Create a composite profile
+    switchenv compose -c my_composite_profile_name -p my_snapshot_profile_name -p my_profile_name
+
+    # Show all profile names
+    switchenv list
+
+    # Print the profiles best matching a name, most used first
+    switchenv find prod
+
+    # Show contents of a specific profile
+    switchenv show                                # allows for fuzzysearch of profile name
+    switchenv show -p profile1 [-p profile2... ]  # show a specific profile(s)
+
+    # Drop into a subshell with a specific profile
+    switchenv  # Will present you with a fuzzy searchable list of profiles
+
+    # Drop into a named profile (useful for invoking in scripts)
+    switchenv source -p profile_name
+
+    # Switch the current shell to a profile without starting a subshell, and back again
+    eval "$(switchenv env -p profile_name)"
+    eval "$(switchenv env --reset)"
+
+    # Delete profiles
+    switchenv delete -p profile_name_1 [-p profile_name_2, ...]
+
+
+    """)
+    print(text)
+
+
+@cli.command(name='list', help='List all profile names')
+def list_profiles():
+    print_profiles()
+
+
+def complete_profile_names(ctx, param, incomplete):
+    return [name for name in SwitchEnv().profile_names() if name.startswith(incomplete)]
+
+
+@cli.command(name='names', hidden=True, help='Print profile names one per line (used by shell completion)')
+def names():
+    print_names()
+
+
+@cli.command(help='Print a bash completion script (eval "$(sw completion)" in your ~/.bashrc)')
+def completion():
+    import shlex
+
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'completion.bash')) as buff:
+        script = buff.read()
+
+    # Completion reads the names file from wherever the config directory is right now
+    sys.stdout.write(script.replace('__SWITCHENV_CONFIG_DIR__', shlex.quote(SwitchEnv.BLOB_DIR)))
+
+
+@cli.command(help='Show contents of a single profile')
+@click.option('-p', '--profiles', multiple=True, shell_complete=complete_profile_names)
+def show(profiles):
+    swenv = SwitchEnv()
+    ensure_profiles_exist(swenv)
+    if not profiles:
+        profiles = [swenv.get_key()]
+    swenv = SwitchEnv()
+    swenv.show(key_list=profiles)
+
+
+@cli.command(help='Drop into subshell with named profile (useful in scripts)')
+@click.option('-p', '--profile', required=True, shell_complete=complete_profile_names)
+def source(profile):
+    run_switch_env(profile)
+
+
+@cli.command(name='env', help='Print the exports that switch this shell to a profile: eval "$(sw env -p NAME)"')
+@click.option('-p', '--profile', shell_complete=complete_profile_names)
+@click.option('--reset', is_flag=True, help='Undo the last switch instead')
+def env_(profile, reset):
+    if (profile is None) != reset:
+        print('\nSpecify exactly one of -p or --reset\n', file=sys.stderr)
+        sys.exit(1)
+    print_switch(profile, reset=reset)
+
+
+@cli.command(help='Delete a profile')
+@click.option('-p', '--profiles', multiple=True, shell_complete=complete_profile_names)
+def delete(profiles):
+    swenv = SwitchEnv()
+    ensure_profiles_exist(swenv)
+    if not profiles:
+        profiles = [swenv.get_key()]
+
+    initial_keys = set(swenv.keys)
+    swenv.delete(keys=profiles)
+    final_keys = set(swenv.keys)
+    deleted_keys = initial_keys - final_keys
+    if deleted_keys:
+        print(f'Deleted profiles: {sorted(deleted_keys)}')
+
+
+def profile_name_for_file(file_name):
+    """
+    Derive a profile name from a file name by dropping its directory and extension
+    """
+    base_name = os.path.basename(file_name).lstrip('.')
+    return os.path.splitext(base_name)[0] or base_name
+
+
+def read_manifest(lines):
+    """
+    Parse a manifest of files to import.  Each line holds a file name,
+    optionally preceded by a profile name and a tab.  Blank lines and lines
+    starting with # are ignored.  Returns a list of (profile_name, file_name).
+    """
+    pairs = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        if '\t' in line:
+            profile_name, file_name = line.split('\t', 1)
+        else:
+            profile_name, file_name = None, line.strip()
+        pairs.append((profile_name or profile_name_for_file(file_name), file_name))
+    return pairs
+
+
+@cli.command(help='Create profiles from files')
+@click.option('-p', '--profile_name', help='Profile name for the file given with -f')
+@click.option('-f', '--file_name', help='Create a single profile from this file')
+@click.option('-d', '--dir', 'dir_name', help='Create a profile from every file in this directory')
+@click.option('-g', '--glob', 'pattern', default='*', show_default=True, help='Only use --dir files matching this glob')
+@click.option('--from-stdin', is_flag=True, help='Read a manifest of files (one per line, "NAME<tab>FILE" allowed)')
+@click.option('-n', '--dry-run', is_flag=True, help='Report what would change without saving anything')
+@click.option(
+    '--cache-for', type=int, metavar='SECONDS',
+    help='Run the -f file at most once per SECONDS and reuse the variables it exports in between'
+)
+@click.option(
+    '--providers', is_flag=True,
+    help='The -f file holds NAME=cmd:...|file:...|env:... lines whose values are fetched on every use'
+)
+@click.option('--timeout', type=float, metavar='SECONDS', help='How long each --providers value may take to fetch')
+def add(profile_name, file_name, dir_name, pattern, from_stdin, dry_run, cache_for, providers, timeout):
+    check_add_options(file_name, dir_name, from_stdin, dry_run, cache_for, providers, timeout)
+    codes = read_sources(source_files(profile_name, file_name, dir_name, pattern))
+
+    swenv = SwitchEnv()
+    if cache_for is not None:
+        swenv.update_cached(profile_name, codes[profile_name], ttl=cache_for)
+    elif providers:
+        add_providers(swenv, profile_name, codes[profile_name], timeout)
+    else:
+        add_raw(swenv, codes, dry_run, quiet=bool(file_name) and not dry_run)
+
+
+def check_add_options(file_name, dir_name, from_stdin, dry_run, cache_for, providers, timeout):
+    """
+    Exit with a message if the options given to add don't go together
+    """
+    sources = [option for option in (file_name, dir_name, from_stdin) if option]
+    if len(sources) != 1:
+        print('\nSpecify exactly one of -f, --dir or --from-stdin\n')
+        sys.exit(1)
+
+    if cache_for is not None and (not file_name or dry_run):
+        print('\n--cache-for can only be used with -f, and not with --dry-run\n')
+        sys.exit(1)
+
+    if providers and (not file_name or dry_run or cache_for is not None):
+        print('\n--providers can only be used with -f, and not with --dry-run or --cache-for\n')
+        sys.exit(1)
+
+    if timeout is not None and not providers:
+        print('\n--timeout can only be used with --providers\n')
+        sys.exit(1)
+
+
+def source_files(profile_name, file_name, dir_name, pattern):
+    """
+    Returns the (profile_name, file_name) pairs add reads profiles from
+    """
+    import glob
+
+    if file_name:
+        if not profile_name:
+            print('\nA profile name (-p) is required with -f\n')
+            sys.exit(1)
+        return [(profile_name, file_name)]
+    if profile_name:
+        print('\n-p can only be used with -f.  Names are derived from file names otherwise.\n')
+        sys.exit(1)
+    if dir_name:
+        file_names = sorted(glob.glob(os.path.join(dir_name, pattern), recursive=True))
+        return [(profile_name_for_file(name), name) for name in file_names if os.path.isfile(name)]
+    return read_manifest(sys.stdin)
+
+
+def read_sources(pairs):
+    """
+    Returns {profile_name: code} read from (profile_name, file_name) pairs
+    """
+    missing = [name for _, name in pairs if not os.path.isfile(name)]
+    if missing:
+        print(f"\nThe following files do not exist: {missing}\n")
+        sys.exit(1)
+
+    codes = {}
+    for name, source_file in pairs:
+        if name in codes:
+            print(f"\nMore than one file maps to the profile name '{name}'\n")
+            sys.exit(1)
+        with open(source_file, 'r') as code_file:
+            codes[name] = code_file.read()
+    return codes
+
+
+def add_providers(swenv, profile_name, code, timeout):
+    from .providers import ProviderError, parse_provider_file
+    try:
+        swenv.update_providers(profile_name, parse_provider_file(code), timeout=timeout)
+    except ProviderError as e:
+        print(f'\n{e}\n')
+        sys.exit(1)
+
+
+def add_raw(swenv, codes, dry_run, quiet=False):
+    report = swenv.update_raw_many(codes, dry_run=dry_run)
+
+    # Stay quiet for the single file case, just like before bulk imports existed
+    if quiet:
+        return
+
+    if dry_run:
+        labels = {'added': 'Would add', 'updated': 'Would update', 'unchanged': 'Unchanged'}
+    else:
+        labels = {'added': 'Added', 'updated': 'Updated', 'unchanged': 'Unchanged'}
+    for action, label in labels.items():
+        if report[action]:
+            print(f'{label} {len(report[action])} profile(s): {report[action]}')
+
+
+@cli.command(help='Run cached profiles again the next time they are used')
+@click.option('-p', '--profiles', multiple=True, required=True, shell_complete=complete_profile_names)
+def refresh(profiles):
+    refreshed = SwitchEnv().refresh(profiles)
+    if refreshed:
+        print(f'Refreshed cached profiles: {sorted(set(refreshed))}')
+    else:
+        print('Nothing was cached')
+
+
+@cli.command(help='Compose a new profile from existing profiles')
+@click.option('-c', '--composed_profile_name', required=True, help='The name of the posed profile')
+@click.option(
+    '-p', '--profiles', multiple=True, shell_complete=complete_profile_names, help='The name of the source profile'
+)
+def compose(composed_profile_name, profiles):
+    if not profiles:
+        print('You must supply at least one source profile')
+
+    swenv = SwitchEnv()
+    try:
+        swenv.update_composed(composed_profile_name, profiles)
+    except ProfileCycleError as e:
+        print(f'\n{e}\n')
+        sys.exit(1)
+
+
+@cli.command(help='Show the order in which a profile runs its sub-profiles')
+@click.option('-p', '--profile', required=True, shell_complete=complete_profile_names)
+def deps(profile):
+    swenv = SwitchEnv()
+    swenv.ensure_profile_names_exist([profile])
+    for index, leaf_name in enumerate(swenv.graph.resolve(profile), 1):
+        print(f'{index:>3}. {leaf_name}')
+
+
+@cli.command(help='Print the profiles matching QUERY, best match and most used first')
+@click.argument('query', nargs=1)
+@click.option('-n', '--limit', default=20, show_default=True, help='Most matches to print (0 for all)')
+def find(query, limit):
+    print_matches(query, limit)
+
+
+@cli.command(help='Snapshot current env into a profile')
+@click.option('-p', '--profile_name', required=True)
+def snapshot(profile_name):
+    swenv = SwitchEnv()
+    try:
+        swenv.update_snapshot(profile_name, swenv.env)
+    except RuntimeError:
+        print(
+            f"\nProfile '{profile_name}' is not a snapshot.  "
+            'If an older version snapshotted it, run `switchenv storage --migrate-snapshots` first.\n'
+        )
+        sys.exit(1)
+
+
+@cli.command(help='View or set where the config directory lives')
+@click.option('-s', '--set-location', help='Set the location to the specified directory')
+@click.option('-r', '--reset-default-location', is_flag=True, help='Set config directory to default location')
+@click.option(
+    '--shared', multiple=True,
+    help='Layer the read-only profiles of this config directory under yours (repeat for more)'
+)
+@click.option('--no-shared', is_flag=True, help='Stop using shared config directories')
+@click.option(
+    '--normalize', multiple=True, metavar='VARIABLE',
+    help='Deduplicate this colon separated variable on activation (repeat for more)'
+)
+@click.option('--no-normalize', is_flag=True, help='Stop deduplicating variables on activation')
+@click.option(
+    '--drop-missing/--keep-missing', default=None,
+    help='Whether normalizing also drops entries that are not directories'
+)
+def config(set_location, reset_default_location, shared, no_shared, normalize, no_normalize, drop_missing):
+    # Instantiate the class that knows how to handle config blob
+    handler = BlobDirHandler()
+
+    # If requested, change to the default location and quit
+    if reset_default_location:
+        handler.change_blob_location(handler.DEFAULT_BLOB_DIR)
+        exit(0)
+
+    # Shared directories are set all at once, in order of precedence
+    if shared or no_shared:
+        handler.change_shared_locations([os.path.realpath(os.path.expanduser(location)) for location in shared])
+        exit(0)
+
+    # Normalized variables are also set all at once
+    if normalize or no_normalize or drop_missing is not None:
+        variables = list(normalize) if normalize or no_normalize else None
+        handler.change_normalization(variables=variables, drop_missing=drop_missing)
+        exit(0)
+
+    # If no options supplied, just print the current location of the config dir
+    config_dir = handler.location
+    if set_location is None:
+        shared_dirs = ''.join(f'{location}\n' for location in handler.shared_locations)
+        parts = [f'\n\nCurrent config directory:\n{config_dir}\n\n']
+        if shared_dirs:
+            parts.append(f'Shared config directories:\n{shared_dirs}\n')
+        dropping = ', dropping missing directories' if handler.drop_missing_dirs else ''
+        parts.append(f"Normalized variables: {' '.join(handler.normalized_variables) or 'none'}{dropping}\n\n")
+        parts.append('Run with the -s or -r options to change it.\n\n')
+        print(''.join(parts))
+        exit(0)
+    # Otherwise set the location
+    else:
+        # Get the full absolute path
+        full_location = os.path.realpath(os.path.expanduser(set_location))
+
+        # Prompt to create non-existing directory
+        if not os.path.isdir(full_location):
+            msg = (
+                f'\n\nDirectory does not exist: {set_location}\n\n'
+                'Create it?  y/n:  '
+            )
+            answer = input(msg)
+            if answer and answer.lower()[0] == 'y':
+                os.makedirs(full_location)
+            else:
+                print('\n\nNothing done.')
+                exit(0)
+
+        handler.change_blob_location(full_location)
+
+
+@cli.command(help='View or change the storage backend for profiles')
+@click.option('-u', '--use', type=click.Choice(sorted(STORES)), help='Move all profiles into this backend')
+@click.option(
+    '--migrate-snapshots', is_flag=True,
+    help='Store profiles snapshotted by older versions so that they share their values'
+)
+@click.option('-n', '--dry-run', is_flag=True, help='With --migrate-snapshots, report without saving anything')
+def storage(use, migrate_snapshots, dry_run):
+    swenv = SwitchEnv()
+    if migrate_snapshots:
+        report = swenv.migrate_snapshots(dry_run=dry_run)
+        label = 'Would migrate' if dry_run else 'Migrated'
+        saved = report['bytes_before'] - report['bytes_after']
+        print(f"\n{label} {len(report['migrated'])} snapshot profile(s): {report['migrated']}")
+        print(f"Size: {report['bytes_before']} bytes -> {report['bytes_after']} bytes ({saved} bytes saved)")
+
+    if use is not None:
+        if 'SWITCHENV_STORE' in os.environ:
+            print('\nUnset SWITCHENV_STORE before changing the storage backend\n', file=sys.stderr)
+            sys.exit(1)
+        convert_store(swenv.BLOB_DIR, swenv.BLOB_VERSION, use)
+        swenv.store = open_layered_store(swenv.BLOB_DIR, swenv.BLOB_VERSION, swenv.SHARED_DIRS)
+
+    print(f'\nStorage backend: {swenv.store.name}')
+    print(f'Profiles:        {len(swenv.store.names())}\n')
+
+
+@cli.group(help='Inspect or purge the compiled activation-script cache')
+def cache():
+    pass
+
+
+@cache.command(name='stats', help='Show how much space the cache is using')
+def cache_stats():
+    swenv = SwitchEnv()
+    stats = swenv.rc_cache.stats()
+    print(f'\nCache directory: {stats["directory"]}')
+    print(f'Entries:         {stats["entries"]}')
+    print(f'Size:            {stats["bytes"]} bytes')
+    print(f'Size limit:      {stats["max_bytes"]} bytes\n')
+
+
+@cache.command(name='clear', help='Remove every cached activation script')
+def cache_clear():
+    swenv = SwitchEnv()
+    removed = swenv.rc_cache.clear()
+    print(f'\nRemoved {removed} cached activation script(s)\n')
+
+
+@cli.command(help='Serve profiles from memory to other sw commands until stopped')
+def serve():
+    from .daemon import serve as serve_profiles
+
+    serve_profiles(os.path.join(SwitchEnv.BLOB_DIR, DAEMON_SOCKET), SwitchEnv)
+
+
+@cli.command(help='Export config to stdout (see also import-config)')
+@click.option(
+    '--format', 'output_format', type=click.Choice(['json', 'ndjson']), default='json', show_default=True,
+    help='ndjson streams one profile per line'
+)
+@click.option(
+    '-p', '--profile', 'profiles', multiple=True, shell_complete=complete_profile_names,
+    help='Only export this profile.  Repeat for more.'
+)
+@click.option('-g', '--glob', 'patterns', multiple=True, help='Only export profiles whose names match this glob')
+def export_config(output_format, profiles, patterns):
+    from .transfer import select_names, without_derived, write_ndjson
+
+    swenv = SwitchEnv()
+    swenv.ensure_profile_names_exist(profiles)
+    names = select_names(swenv.store.names(), profiles, patterns)
+
+    if output_format == 'ndjson':
+        write_ndjson(swenv.store, sys.stdout, names)
+    else:
+        blob = dict(swenv.blob, profiles={name: without_derived(swenv.store.get(name)) for name in names})
+        print(json.dumps(blob, indent=2))
+
+
+@cli.command(help='Import config from file (see also export-config)')
+@click.option('-f', '--file-name', required=True, help='The config file to import, json or ndjson.  - reads stdin.')
+@click.option(
+    '--merge/--replace', default=False,
+    help='Add to the existing profiles instead of replacing them all  [default: replace]'
+)
+@click.option('--overwrite', is_flag=True, help='When merging, let imported profiles replace differing ones')
+def import_config(file_name, merge, overwrite):
+    from .transfer import ImportConflictError, read_profiles
+
+    if file_name == '-':
+        buff = sys.stdin
+    else:
+        file_name = os.path.realpath(os.path.expanduser(file_name))
+        if not os.path.isfile(file_name):
+            print(f'Config file does not exist: {file_name}', file=sys.stderr)
+            exit(1)
+        buff = open(file_name)
+
+    # The generation counter belongs to the machine the config was exported from,
+    # so it is never imported
+    swenv = SwitchEnv()
+    try:
+        with buff:
+            report = swenv.import_profiles(
+                read_profiles(buff, swenv.BLOB_VERSION), replace=not merge, overwrite=overwrite
+            )
+    except ImportConflictError as e:
+        print(f'\n{e}\nNothing was imported.  Use --overwrite to import them anyway.\n', file=sys.stderr)
+        exit(1)
+    except ValueError as e:
+        print(f'\nNothing was imported.  {e}\n', file=sys.stderr)
+        exit(1)
+
+    labels = {'added': 'Added', 'updated': 'Updated', 'unchanged': 'Unchanged', 'deleted': 'Deleted'}
+    for action, label in labels.items():
+        if report[action]:
+            print(f'{label} {len(report[action])} profile(s)')
+
+    print('\n\n Success!\n')
+
+
+@cli.command(help='Execute a QUOTED command in the specified env')
+@click.argument('command', nargs=1)
+@click.option(
+    '-p', '--profile', 'profiles', multiple=True, shell_complete=complete_profile_names,
+    help='Profile to run in.  Repeat to run in several.'
+)
+@click.option('-g', '--glob', 'patterns', multiple=True, help='Run in every profile whose name matches this glob')
+@click.option('-j', '--jobs', default=4, show_default=True, help='How many profiles to run at once')
+@click.option('--log-dir', help='Write the output of each profile to DIR/PROFILE.log instead of stdout')
+@click.option(
+    '--direct', is_flag=True,
+    help='Run the command with a cached copy of the profile environment instead of sourcing it in bash'
+)
+def exec(command, profiles, patterns, jobs, log_dir, direct):
+    if len(profiles) <= 1 and not patterns and log_dir is None:
+        run_exec(command, profiles[0] if profiles else None, direct=direct)
+
+    import fnmatch
+    from .fanout import run_fanout
+
+    swenv = SwitchEnv()
+    ensure_profiles_exist(swenv)
+    swenv.ensure_profile_names_exist(profiles)
+
+    # Keep explicitly named profiles in order, then add glob matches
+    selected = list(dict.fromkeys(profiles))
+    for pattern in patterns:
+        selected.extend(name for name in fnmatch.filter(swenv.keys, pattern) if name not in selected)
+    if not selected:
+        print(f'\nNo profiles match {list(patterns)}\n')
+        sys.exit(1)
+
+    swenv.usage.record(*selected)
+    sys.exit(run_fanout(swenv, command, selected, jobs, log_dir=log_dir, direct=direct))
@@ -0,0 +1,66 @@
+# Bash completion for switchenv.  Load it from your ~/.bashrc with
+#
+#     eval "$(sw completion)"
+#
+# or save the output of `sw completion` into your bash-completion directory.
+#
+# Profile names are read straight from the names file that switchenv rewrites
+# whenever profiles change, so completing them doesn't start python.  Only when
+# that file is missing, or a shared store changed after it was written, does
+# it fall back to asking `sw names`, which also rebuilds it.  The file is
+# looked for in SWITCHENV_HOME if it is set, and otherwise in the config
+# directory in use when `sw completion` printed this script.
+
+_switchenv_names_file_is_current() {
+    local names_file="$1" shared_dir store_file
+    [[ -r "$names_file" && -r "$names_file.shared" ]] || return 1
+
+    # The first line is the shared stores' fingerprint, for python, and the shared directories follow
+    {
+        read -r
+        while read -r shared_dir; do
+            for store_file in "$shared_dir/profiles.json" "$shared_dir/profiles.db" "$shared_dir/profiles.db-wal"; do
+                [[ "$store_file" -nt "$names_file" ]] && return 1
+            done
+        done
+    } < "$names_file.shared"
+    return 0
+}
+
+_switchenv_profile_names() {
+    local config_dir=__SWITCHENV_CONFIG_DIR__
+    [[ -n "$SWITCHENV_HOME" ]] && config_dir="$SWITCHENV_HOME"
+    local names_file="$config_dir/profile_names"
+    if _switchenv_names_file_is_current "$names_file"; then
+        mapfile -t __switchenv_names < "$names_file"
+    else
+        mapfile -t __switchenv_names < <("${COMP_WORDS[0]}" names 2>/dev/null)
+    fi
+}
+
+_switchenv() {
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    local prev="${COMP_WORDS[COMP_CWORD-1]}"
+    local commands="add cache completion compose config delete deps env examples exec export-config find import-config list refresh serve show snapshot source storage"
+
+    COMPREPLY=()
+    if [[ $COMP_CWORD -eq 1 ]]; then
+        mapfile -t COMPREPLY < <(compgen -W "$commands" -- "$cur")
+        return
+    fi
+
+    case "${COMP_WORDS[1]} $prev" in
+        "show -p"|"show --profiles"|"source -p"|"source --profile"|"delete -p"|"delete --profiles"|\
+        "compose -p"|"compose --profiles"|"deps -p"|"deps --profile"|"exec -p"|"exec --profile"|\
+        "env -p"|"env --profile"|"refresh -p"|"refresh --profiles"|\
+        "export-config -p"|"export-config --profile")
+            local name __switchenv_names
+            _switchenv_profile_names
+            for name in "${__switchenv_names[@]}"; do
+                [[ "$name" == "$cur"* ]] && COMPREPLY+=("$name")
+            done
+            ;;
+    esac
+}
+
+complete -o default -F _switchenv sw switchenv
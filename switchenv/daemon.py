@@ -0,0 +1,249 @@
+"""
+An optional resident process that keeps profiles parsed and resolved in
+memory, and answers lookups over a Unix domain socket in the config directory.
+
+Every request and response is a single line of json.  A request names an op
+and its arguments, and the response is {"ok": true, "result": ...} or
+{"ok": false, "error": ...}.  The ops are
+
+    ping                       answers 'pong'
+    list                       the text `sw list` prints
+    get-code  profile          the resolved code of a profile
+    get-env   profile, env     the delta from SwitchEnv.resolved_environment
+    rc-file   profile, env     an rc file that activates the profile on top of env
+"""
+import json
+import os
+import sys
+
+from .trace import tracer
+
+# How long a client waits on the daemon before doing the work itself
+CLIENT_TIMEOUT = 10
+
+
+class DaemonUnavailable(Exception):
+    pass
+
+
+class ProfileServer:
+    """
+    Answers requests from a SwitchEnv it keeps for as long as the store is
+    unchanged.  A request that finds the store's fingerprint changed gets a
+    fresh SwitchEnv, so the daemon never serves profiles older than the files.
+    """
+    def __init__(self, swenv_factory):
+        import threading
+
+        self.swenv_factory = swenv_factory
+        self.lock = threading.Lock()
+        self.swenv = None
+        self.fingerprint = None
+
+    def current(self):
+        fingerprint = None if self.swenv is None else self.swenv.store.fingerprint()
+        if fingerprint is None or fingerprint != self.fingerprint:
+            self.swenv = self.swenv_factory()
+            self.fingerprint = self.swenv.store.fingerprint()
+        return self.swenv
+
+    def handle(self, request):
+        # SwitchEnv and its caches aren't thread safe, so handle one at a time
+        with self.lock:
+            swenv = self.current()
+            op = request.get('op')
+            profile = request.get('profile')
+
+            if op == 'ping':
+                return 'pong'
+            if op == 'list':
+                return self.list_text(swenv)
+
+            if swenv.store.get(profile) is None:
+                raise KeyError(f'No profile named {profile!r}')
+            if swenv.leaves_of_type(profile, 'providers'):
+                # Providers have to see the client's environment, not the daemon's
+                raise ValueError('Provider profiles are resolved by the client')
+            code = swenv.get_code(profile)
+            if op == 'get-code':
+                return code
+
+            env = request['env']
+            if request.get('record'):
+                swenv.usage.record(profile)
+            if op == 'get-env':
+                return swenv.activation_delta(profile, env=env)
+            if op == 'rc-file':
+                if swenv.rc_cache.max_bytes <= 0:
+                    # Private rc files can't be handed to another process
+                    raise ValueError('The activation cache is turned off')
+                return swenv.make_temp_rc_file(profile, code, env=env)
+
+            raise ValueError(f'Unknown op {op!r}')
+
+    def list_text(self, swenv):
+        lines = []
+        for key, profile in swenv.items:
+            if profile['code_type'] == 'composed':
+                lines.append(f'{key} -> {profile["code"]}')
+            else:
+                lines.append(key)
+        if not lines:
+            raise KeyError('No saved profiles')
+        return ''.join(f'{line}\n' for line in lines)
+
+    def respond(self, line):
+        try:
+            response = {'ok': True, 'result': self.handle(json.loads(line))}
+        except Exception as e:  # noqa  Anything going wrong just sends the client down its usual path
+            response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        return json.dumps(response).encode() + b'\n'
+
+
+def serve(socket_path, swenv_factory):
+    """
+    Serve requests on socket_path until interrupted
+    """
+    # Refuse to steal the socket from a daemon that is still answering
+    try:
+        request(socket_path, {'op': 'ping'})
+    except DaemonUnavailable:
+        pass
+    else:
+        print(f'\nA switchenv daemon is already serving {socket_path}\n')
+        sys.exit(1)
+
+    unix_server = make_unix_server(socket_path, ProfileServer(swenv_factory))
+    print(f'Serving profiles on {socket_path}', file=sys.stderr)
+    try:
+        unix_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        unix_server.server_close()
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+        print('Stopped serving profiles', file=sys.stderr)
+
+
+def make_unix_server(socket_path, server):
+    """
+    Returns a socket server that answers the lines sent to socket_path with
+    server, and makes SIGTERM stop it the way ctrl-c does
+    """
+    import signal
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                self.wfile.write(server.respond(line))
+
+    try:
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+
+    # Requests are answered one at a time on this thread.  They only take a few
+    # milliseconds, and sqlite connections can't be used from other threads.
+    # Only the user should be able to ask for their profiles.
+    old_umask = os.umask(0o077)
+    try:
+        unix_server = socketserver.UnixStreamServer(socket_path, Handler)
+    finally:
+        os.umask(old_umask)
+
+    # Shut down cleanly on SIGTERM as well as on ctrl-c
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    return unix_server
+
+
+def request(socket_path, payload, timeout=CLIENT_TIMEOUT):
+    """
+    Send one request to the daemon and return its result.  Raises
+    DaemonUnavailable if there is no daemon or it couldn't answer.
+    """
+    import socket
+
+    with tracer.phase('daemon.request', op=payload.get('op')):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(timeout)
+                sock.connect(socket_path)
+                sock.sendall(json.dumps(payload).encode() + b'\n')
+                with sock.makefile('rb') as buff:
+                    line = buff.readline()
+        except OSError as e:
+            raise DaemonUnavailable(str(e))
+
+    try:
+        response = json.loads(line)
+    except ValueError:
+        raise DaemonUnavailable('The daemon sent an unreadable response')
+    if not response.get('ok'):
+        raise DaemonUnavailable(response.get('error'))
+    return response['result']
+
+
+def run_with_daemon(socket_path, command_name, kwargs):
+    """
+    Run a fast-path command by asking the daemon instead of loading profiles
+    here.  Returns False, having done nothing, if the daemon can't do it.
+    Commands that activate a profile never return.
+    """
+    from .switchenv import current_env, exec_shell, exec_with_delta, exec_with_rc
+
+    profile = kwargs.get('profile')
+    try:
+        if command_name == 'list':
+            sys.stdout.write(request(socket_path, {'op': 'list'}))
+            return True
+
+        if profile is None:
+            return False
+
+        env = current_env()
+        payload = {'profile': profile, 'env': env, 'record': True}
+        if command_name == 'env':
+            return print_switch_with_daemon(socket_path, payload)
+
+        if command_name == 'exec' and kwargs.get('direct'):
+            delta = request(socket_path, dict(payload, op='get-env'))
+            if not delta['functions']:
+                exec_with_delta(kwargs['command'], delta, env)
+            payload['record'] = False
+
+        # With the cache turned off, rc files must stay private to this process
+        if int(env.get('SWITCHENV_CACHE_MAX_BYTES', 1)) <= 0:
+            return False
+        rc_file = request(socket_path, dict(payload, op='rc-file'))
+    except DaemonUnavailable:
+        return False
+
+    if command_name == 'source':
+        exec_shell(rc_file, env)
+    exec_with_rc(kwargs['command'], rc_file, env)
+
+
+def print_switch_with_daemon(socket_path, payload):
+    """
+    Print what `sw env` would, with the delta worked out by the daemon.
+    Returns False, having printed nothing, if it has to be done here instead.
+    """
+    from .environ import ESSENTIAL_VARS, switch_script, unswitched_environment
+    from .switchenv import warn_about_functions
+
+    env, profile = payload['env'], payload['profile']
+    base_env = unswitched_environment(env)
+    delta = request(socket_path, dict(payload, env=base_env, op='get-env'))
+    if any(name in delta['unset'] for name in ESSENTIAL_VARS):
+        # Only the profile's code can say whether that is meant, which print_switch checks
+        return False
+    warn_about_functions(profile, delta)
+    sys.stdout.write(switch_script(env, base_env, profile, delta))
+    return True
@@ -0,0 +1,307 @@
+import json
+import os
+import re
+import shlex
+
+# Variables that bash maintains for itself.  They say nothing about what a
+# profile did, and letting them into a cache key would make it miss for
+# every new shell or working directory.
+VOLATILE_VARS = {'_', 'SHLVL', 'PWD', 'OLDPWD'}
+
+# `sw env` records the profile it applied, and the values it replaced so that
+# switching away can restore them, in these variables of the shell it changes
+PROFILE_VAR = 'SWITCHENV_PROFILE'
+STATE_VAR = '__SWITCHENV_STATE'
+
+# Names that bash can export
+VARIABLE_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# The pieces of code that only exports literal values
+STATIC_GAP = re.compile(r'(?:\s|#[^\n]*)*')
+STATIC_EXPORT = re.compile(r'export[ \t]+([A-Za-z_][A-Za-z0-9_]*)=')
+STATIC_WORD_PART = re.compile(r"[A-Za-z0-9_@%+=:,./-]+|'[^']*'|\"[^$`\\\\\"]*\"")
+STATIC_LINE_END = re.compile(r'[ \t]*(?:(?<=[ \t])#[^\n]*)?(?:\n|$)')
+
+# Anything that needs a shell to interpret it
+SHELL_SYNTAX = re.compile(r'[|&;<>()$`\\*?\[\]{}~!#\n]')
+
+# Variables no shell can do without.  `sw env` only unsets them for a profile whose code does.
+ESSENTIAL_VARS = ('PATH', 'HOME')
+
+# Colon separated variables that activation deduplicates unless configured otherwise
+DEFAULT_NORMALIZED_VARS = ('PATH', 'LD_LIBRARY_PATH', 'PYTHONPATH')
+
+
+class ActivationError(RuntimeError):
+    """
+    Raised when the environment a profile makes can't be worked out
+    """
+
+
+class ProbeError(ActivationError):
+    """
+    Raised when bash didn't run a probe to the end, such as when a bashrc
+    returns early in shells that aren't interactive.  What it printed then
+    says nothing about the environment the profile makes.
+    """
+
+
+# Shell code that makes a probe report whether the profile code defined
+# any functions or aliases, followed by the resulting environment.  The
+# report starts after a delimiter from probe_delimiter(), so whatever the
+# profile prints is ignored.
+PROBE_BEFORE_CODE = '__switchenv_definitions="$(declare -F; alias)"'
+PROBE_AFTER_CODE = '\n'.join([
+    'if [ "$__switchenv_definitions" = "$(declare -F; alias)" ]; then',
+    "    printf '%s\\0environment\\0' {delimiter}",
+    'else',
+    "    printf '%s\\0definitions\\0' {delimiter}",
+    'fi',
+    'unset __switchenv_definitions',
+    'env -0',
+])
+
+
+def probe_delimiter():
+    """
+    A fresh random word to mark where a probe's report starts in its output
+    """
+    import secrets
+    return f'__switchenv_probe_{secrets.token_hex(16)}'
+
+
+def environment_fingerprint(env):
+    """
+    A stable string identifying the parts of an environment a profile can see
+    """
+    return '\0'.join(f'{key}={val}' for key, val in sorted(env.items()) if key not in VOLATILE_VARS)
+
+
+def parse_probe_output(output, delimiter):
+    """
+    Parse the output of a probe script that ended with PROBE_AFTER_CODE
+    formatted with delimiter.
+    Returns a tuple of (defines_functions, environment_dict), or raises
+    ProbeError if the output has no report.
+    """
+    _, found, report = output.partition(f'{delimiter}\0')
+    marker, _, env_block = report.partition('\0')
+    if not found or marker not in {'environment', 'definitions'}:
+        raise ProbeError('bash stopped before reporting the environment')
+    return marker != 'environment', parse_env_output(env_block)
+
+
+def parse_env_output(env_block):
+    """
+    Returns the environment dict printed by env -0
+    """
+    env = {}
+    for item in env_block.split('\0'):
+        key, sep, val = item.partition('=')
+        if sep:
+            env[key] = val
+    return env
+
+
+def diff_environments(before, after):
+    """
+    Returns the delta that turns the before environment into the after environment
+    """
+    return {
+        'set': {
+            key: val for key, val in after.items()
+            if key not in VOLATILE_VARS and before.get(key) != val
+        },
+        'unset': sorted(key for key in before if key not in after and key not in VOLATILE_VARS),
+    }
+
+
+def apply_delta(env, delta):
+    """
+    Returns a copy of env with a delta from diff_environments applied
+    """
+    env = dict(env)
+    for key in delta['unset']:
+        env.pop(key, None)
+    env.update(delta['set'])
+    return env
+
+
+def delta_to_shell(delta):
+    """
+    Returns shell code that applies a delta from diff_environments
+    """
+    lines = [f'unset {key}' for key in delta['unset'] if VARIABLE_NAME.match(key)]
+    lines.extend(
+        f'export {key}={shlex.quote(val)}' for key, val in sorted(delta['set'].items()) if VARIABLE_NAME.match(key)
+    )
+    return '\n'.join(lines)
+
+
+def parse_static_exports(code):
+    """
+    Returns the {name: value} dict of what code exports if it does nothing
+    but export literal values, or None if bash is needed to know what it does.
+    Blank lines and comments are allowed.  Values can be unquoted, single
+    quoted, or double quoted with nothing in the quotes that bash would expand.
+    """
+    exports = {}
+    position = 0
+    while True:
+        position = STATIC_GAP.match(code, position).end()
+        if position == len(code):
+            return exports
+
+        match = STATIC_EXPORT.match(code, position)
+        if match is None:
+            return None
+        name, position = match.group(1), match.end()
+
+        value = []
+        while position < len(code):
+            match = STATIC_WORD_PART.match(code, position)
+            if match is None:
+                break
+            part = match.group()
+            value.append(part[1:-1] if part[0] in '\'"' else part)
+            position = match.end()
+
+        # Only whitespace or a comment may follow the value on its line
+        match = STATIC_LINE_END.match(code, position)
+        if match is None:
+            return None
+        exports[name] = ''.join(value)
+        position = match.end()
+
+
+def normalize_path_list(value, drop_missing=False):
+    """
+    Returns a colon separated value with only the first occurrence of each
+    entry kept, and optionally without entries that aren't directories.
+    Empty entries, which mean the current directory, are kept like any other.
+    """
+    seen = set()
+    kept = []
+    for entry in value.split(':'):
+        if entry in seen:
+            continue
+        seen.add(entry)
+        if drop_missing and entry and not os.path.isdir(entry):
+            continue
+        kept.append(entry)
+    return ':'.join(kept)
+
+
+def normalize_script(variables, drop_missing=False):
+    """
+    Returns shell code that does what normalize_path_list does to each of
+    the variables that is set, without starting any other process
+    """
+    variables = [name for name in variables if VARIABLE_NAME.match(name)]
+    if not variables:
+        return ''
+    lines = [
+        f'for __switchenv_var in {" ".join(variables)}; do',
+        '    [ -n "${!__switchenv_var+set}" ] || continue',
+        '    __switchenv_rest="${!__switchenv_var}:"',
+        '    __switchenv_seen=":"',
+        '    __switchenv_value=""',
+        '    while [ -n "$__switchenv_rest" ]; do',
+        '        __switchenv_entry="${__switchenv_rest%%:*}"',
+        '        __switchenv_rest="${__switchenv_rest#*:}"',
+        '        case "$__switchenv_seen" in *":$__switchenv_entry:"*) continue ;; esac',
+        '        __switchenv_seen="$__switchenv_seen$__switchenv_entry:"',
+    ]
+    if drop_missing:
+        lines.append('        [ -z "$__switchenv_entry" ] || [ -d "$__switchenv_entry" ] || continue')
+    lines.extend([
+        '        __switchenv_value="$__switchenv_value:$__switchenv_entry"',
+        '    done',
+        '    printf -v "$__switchenv_var" "%s" "${__switchenv_value#:}" 2>/dev/null',
+        'done',
+        'unset __switchenv_var __switchenv_rest __switchenv_seen __switchenv_entry __switchenv_value',
+    ])
+    return '\n'.join(lines)
+
+
+def path_reductions(env, variables, drop_missing=False):
+    """
+    Returns {variable: (entries before, entries after)} for each of the
+    variables in env that normalizing would shorten
+    """
+    reductions = {}
+    for name in variables:
+        if name not in env:
+            continue
+        before = len(env[name].split(':'))
+        after = len(normalize_path_list(env[name], drop_missing).split(':'))
+        if after < before:
+            reductions[name] = (before, after)
+    return reductions
+
+
+def unswitched_environment(env):
+    """
+    Returns a copy of env with whatever `sw env` last applied to it undone
+    """
+    try:
+        saved = json.loads(env.get(STATE_VAR, '{}')).get('saved', {})
+    except (ValueError, AttributeError):
+        saved = {}
+
+    env = dict(env)
+    for key, val in saved.items():
+        if val is None:
+            env.pop(key, None)
+        else:
+            env[key] = val
+    env.pop(STATE_VAR, None)
+    env.pop(PROFILE_VAR, None)
+    return env
+
+
+def unexpected_unsets(delta, code):
+    """
+    Returns the essential variables a delta unsets that code never unsets itself
+    """
+    return [
+        name for name in ESSENTIAL_VARS
+        if name in delta['unset'] and not re.search(rf'\bunset\b[^\n;&|]*\b{name}\b', code)
+    ]
+
+
+def switch_script(env, base_env, profile=None, delta=None):
+    """
+    Returns the export and unset statements that move a shell from env to
+    base_env (env with the active profile undone) with a delta from
+    diff_environments applied for profile.  Without a profile the shell
+    just goes back to base_env.
+    """
+    target = dict(base_env)
+    if profile is not None:
+        # Activation scripts keep the prompt of the subshells they start in __PSSWE__, which means nothing here
+        delta = dict(delta, set={key: val for key, val in delta['set'].items() if key != '__PSSWE__'})
+        changed = list(delta['set']) + list(delta['unset'])
+        saved = {key: base_env.get(key) for key in changed}
+        target = apply_delta(target, delta)
+        target[PROFILE_VAR] = profile
+        target[STATE_VAR] = json.dumps({'profile': profile, 'saved': saved}, sort_keys=True)
+
+    code = delta_to_shell(diff_environments(env, target))
+    return f'{code}\n' if code else ''
+
+
+def direct_argv(command):
+    """
+    Returns the argv to run a command string without sourcing anything.  Plain
+    commands are run directly.  Anything using shell syntax goes through a
+    non-interactive bash, which doesn't read any rc files.
+    """
+    try:
+        argv = shlex.split(command) if not SHELL_SYNTAX.search(command) else []
+    except ValueError:
+        argv = []
+
+    if not argv or '=' in argv[0]:
+        argv = ['bash', '-c', command]
+    return argv
@@ -0,0 +1,111 @@
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FanoutRun:
+    """
+    Runs one command in one profile's environment, either prefixing its
+    output onto our stdout or writing it to a log file of its own.
+    """
+    def __init__(self, profile, argv, env, output_lock, log_file=None, pass_fds=()):
+        self.profile = profile
+        self.argv = argv
+        self.env = env
+        self.output_lock = output_lock
+        self.log_file = log_file
+        self.pass_fds = tuple(pass_fds)
+        self.returncode = None
+        self.seconds = None
+
+    def __call__(self):
+        started = time.monotonic()
+        if self.log_file is not None:
+            with open(self.log_file, 'wb') as log:
+                process = subprocess.Popen(
+                    self.argv, env=self.env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                    pass_fds=self.pass_fds,
+                )
+                self.returncode = process.wait()
+        else:
+            process = subprocess.Popen(
+                self.argv, env=self.env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                pass_fds=self.pass_fds,
+            )
+            prefix = f'[{self.profile}] '.encode()
+            for line in process.stdout:
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                with self.output_lock:
+                    sys.stdout.buffer.write(prefix + line)
+                    sys.stdout.buffer.flush()
+            process.stdout.close()
+            self.returncode = process.wait()
+
+        self.seconds = time.monotonic() - started
+        return self
+
+
+def run_fanout(swenv, command, profiles, jobs, log_dir=None, direct=False):
+    """
+    Run command in the environment of every profile, at most jobs at a time.
+    Prints a summary to stderr and returns 0 if every run succeeded, 1 otherwise.
+    """
+    from .environ import ProbeError, apply_delta, direct_argv
+
+    if log_dir is not None:
+        os.makedirs(log_dir, exist_ok=True)
+
+    # Activation is prepared up front so that the worker threads only wait on processes.
+    # Every run gets its own argv and environment, and rc files are immutable cache
+    # entries or private to their run, so concurrent runs share no mutable state.
+    output_lock = threading.Lock()
+    runs = []
+    rc_fds = []
+    for profile in profiles:
+        pass_fds = []
+        code = swenv.get_code(profile)
+        delta = None
+        if direct:
+            try:
+                delta = swenv.activation_delta(profile)
+            except ProbeError:
+                delta = None
+        if delta is not None and not delta['functions']:
+            argv, env = direct_argv(command), apply_delta(swenv.env, delta)
+        else:
+            rc_file = swenv.make_temp_rc_file(profile, code)
+
+            # With the cache off, rc files live in memory files that children only see if they are passed on
+            if rc_file.startswith('/dev/fd/'):
+                pass_fds.append(int(rc_file[len('/dev/fd/'):]))
+                rc_fds.extend(pass_fds)
+
+            # Never run the command in the wrong environment because activation failed
+            argv, env = ['bash', '-c', f"source {shlex.quote(rc_file)} || exit 1\nexec {command}"], swenv.env
+
+        log_file = None if log_dir is None else os.path.join(log_dir, f'{profile.replace(os.sep, "_")}.log')
+        runs.append(FanoutRun(profile, argv, env, output_lock, log_file, pass_fds=pass_fds))
+
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            finished = list(executor.map(lambda run: run(), runs))
+    finally:
+        for fd in rc_fds:
+            os.close(fd)
+    elapsed = time.monotonic() - started
+
+    failed = [run for run in finished if run.returncode != 0]
+    width = max(len('profile'), *(len(run.profile) for run in finished))
+    lines = [f'\n{"profile":<{width}}  exit  seconds']
+    for run in finished:
+        lines.append(f'{run.profile:<{width}}  {run.returncode:>4}  {run.seconds:>7.2f}')
+    lines.append(f'\n{len(finished) - len(failed)} succeeded, {len(failed)} failed in {elapsed:.2f} seconds\n')
+    print('\n'.join(lines), file=sys.stderr)
+
+    return 1 if failed else 0
@@ -0,0 +1,198 @@
+import json
+import os
+import time
+
+from .trace import tracer
+
+
+def trigrams(text):
+    text = text.lower()
+    return {text[start:start + 3] for start in range(len(text) - 2)}
+
+
+def is_subsequence(query, text):
+    """
+    True if every character of query appears in text, in order
+    """
+    chars = iter(text)
+    return all(char in chars for char in query)
+
+
+def write_json_atomically(data, file_name):
+    return write_text_atomically(json.dumps(data, separators=(',', ':')), file_name)
+
+
+def write_text_atomically(text, file_name):
+    """
+    Write text to a process-private temp file and rename it into place, so
+    readers never see a partial file.  Returns False if the directory can't be written.
+    """
+    temp_file = f'{file_name}.{os.getpid()}.tmp'
+    try:
+        with open(temp_file, 'w') as buff:
+            buff.write(text)
+        os.replace(temp_file, file_name)
+    except OSError:
+        try:
+            os.unlink(temp_file)
+        except OSError:
+            pass
+        return False
+    tracer.count('files_written')
+    return True
+
+
+def read_json(file_name):
+    """
+    Returns the data in a json file, or None if it is missing or unreadable
+    """
+    try:
+        with open(file_name) as buff:
+            data = json.load(buff)
+    except (OSError, ValueError):
+        return None
+    tracer.count('files_read')
+    return data
+
+
+class NameIndex:
+    """
+    A trigram index over profile names kept next to the store.  It holds
+    only names, so searching it never loads any profile code.  The index
+    records the fingerprint of the store it was built from and is rebuilt
+    the first time it is read after the store changes.
+    """
+    FILE_NAME = 'name_index.json'
+
+    def __init__(self, store):
+        self.store = store
+        self.index_file = os.path.join(store.blob_dir, self.FILE_NAME)
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            fingerprint = self.store.fingerprint()
+            with tracer.phase('index.load'):
+                index = read_json(self.index_file)
+            if index is None or index.get('fingerprint') != fingerprint:
+                index = self.build(fingerprint)
+            self._index = index
+        return self._index
+
+    def build(self, fingerprint):
+        with tracer.phase('index.build'):
+            names = self.store.names()
+            postings = {}
+            for position, name in enumerate(names):
+                for trigram in trigrams(name):
+                    postings.setdefault(trigram, []).append(position)
+            index = {'fingerprint': fingerprint, 'names': names, 'trigrams': postings}
+        write_json_atomically(index, self.index_file)
+        return index
+
+    @property
+    def names(self):
+        return self.index['names']
+
+    def candidates(self, query):
+        """
+        Returns the names that could match query.  Queries too short to have
+        a trigram are checked against every name.
+        """
+        names = self.names
+        query_trigrams = trigrams(query)
+        if not query_trigrams:
+            return names
+
+        postings = self.index['trigrams']
+        positions = set()
+        for trigram in query_trigrams:
+            positions.update(postings.get(trigram, ()))
+        return [names[position] for position in sorted(positions)]
+
+    def match_score(self, query, name):
+        """
+        How well name matches query.  Higher is better and 0 is no match.
+        """
+        query, name = query.lower(), name.lower()
+        if name.startswith(query):
+            return 4
+        if query in name:
+            return 3
+        if is_subsequence(query, name):
+            return 2
+
+        # Tolerate typos as long as most of the query's trigrams are in the name
+        query_trigrams = trigrams(query)
+        if query_trigrams and len(query_trigrams & trigrams(name)) * 2 >= len(query_trigrams):
+            return 1
+        return 0
+
+
+class UsageTable:
+    """
+    Remembers how often and how recently each profile was activated.
+    Recording is best effort: concurrent activations may drop a count, and
+    a config directory that can't be written just means nothing is remembered.
+    """
+    FILE_NAME = 'usage.json'
+
+    # A use counts half as much after this many days
+    HALF_LIFE_DAYS = 14
+
+    def __init__(self, blob_dir):
+        self.usage_file = os.path.join(blob_dir, self.FILE_NAME)
+        self._usage = None
+
+    @property
+    def usage(self):
+        if self._usage is None:
+            self._usage = read_json(self.usage_file) or {}
+        return self._usage
+
+    def record(self, *names):
+        with tracer.phase('usage.record'):
+            usage = dict(read_json(self.usage_file) or {})
+            now = time.time()
+            for name in names:
+                entry = usage.get(name, {})
+                usage[name] = {'count': entry.get('count', 0) + 1, 'last': now}
+            write_json_atomically(usage, self.usage_file)
+            self._usage = usage
+
+    def score(self, name, now=None):
+        """
+        Use count, decayed by how long ago the profile was last used
+        """
+        entry = self.usage.get(name)
+        if entry is None:
+            return 0.
+        now = time.time() if now is None else now
+        age_days = max(0., now - entry['last']) / 86400
+        return entry['count'] * 0.5 ** (age_days / self.HALF_LIFE_DAYS)
+
+
+def rank(index, usage, query='', limit=None):
+    """
+    Returns profile names matching query, best first.  Better matches come
+    first, and profiles used often and recently come first among equally good
+    matches.  An empty query ranks every profile by use.
+    """
+    now = time.time()
+    with tracer.phase('index.search'):
+        if not query:
+            scored = [(1, name) for name in index.names]
+        else:
+            scored = [(index.match_score(query, name), name) for name in index.candidates(query)]
+            scored = [(match, name) for match, name in scored if match]
+
+            # Abbreviations like 'prd' for 'prod' share no trigram with the name,
+            # so scan every name when the index doesn't turn up enough matches
+            if len(scored) < (limit or 1):
+                scored = [(index.match_score(query, name), name) for name in index.names]
+                scored = [(match, name) for match, name in scored if match]
+
+        ranked = sorted((-match, -usage.score(name, now), len(name), name) for match, name in scored)
+    names = [name for *_, name in ranked]
+    return names if limit is None else names[:limit]
@@ -0,0 +1,43 @@
+from fuzzypicker.picker import ENTER, FuzzyPicker, Response, wrapper
+
+from .index import rank
+
+
+class RankedPicker(FuzzyPicker):
+    """
+    The fuzzypicker interface, but listing profiles in the order ranked by
+    the name index and usage table rather than in fuzzypicker's own order.
+    """
+    def __init__(self, index, usage, **kwargs):
+        super().__init__([], **kwargs)
+        self.index = index
+        self.usage = usage
+        self.prompt = self.filler
+
+    def render(self, screen):
+        # FuzzyPicker lists its items in order when nothing has been typed, and
+        # shows the filler where the typed text goes.  So rank the matches for
+        # what was typed and present them as an untouched list.
+        query = ''.join(self.letters)
+        letters, self.letters = self.letters, []
+        self.items = rank(self.index, self.usage, query, limit=max(1, screen.getmaxyx()[0] - 4))
+        self.filler = query or self.prompt
+        try:
+            return super().render(screen)
+        finally:
+            self.letters = letters
+
+    def process(self, key):
+        # Unlike fuzzy matching, ranking can leave nothing to select
+        if key == ENTER and not self.vis_items:
+            return Response.keepon
+        return super().process(key)
+
+
+def pick_profile(index, usage):
+    """
+    Interactively pick a profile name.  Returns None if nothing was picked.
+    """
+    picker = RankedPicker(index, usage)
+    wrapper(picker)
+    return picker.selected
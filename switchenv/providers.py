@@ -0,0 +1,115 @@
+"""
+Values for profile variables that are fetched from providers, all at once.
+A provider reference names the provider and what to fetch from it
+
+    cmd:<command>    the output of a bash command
+    file:<path>      the contents of a file
+    env:<name>       the value of a variable in the environment sw runs in
+
+Trailing newlines are dropped, just like bash does for command substitutions.
+"""
+import os
+import subprocess
+import threading
+import time
+
+PROVIDERS = ('cmd', 'file', 'env')
+
+# Seconds a provider gets when its profile doesn't say
+DEFAULT_TIMEOUT = 10
+
+
+class ProviderError(RuntimeError):
+    pass
+
+
+def parse_reference(reference):
+    """
+    Returns the (provider, argument) tuple of a provider reference
+    """
+    provider, sep, argument = reference.partition(':')
+    if not sep or provider not in PROVIDERS or not argument:
+        raise ProviderError(f'{reference!r} is not a provider reference.  Use one of {[f"{p}:" for p in PROVIDERS]}')
+    return provider, argument
+
+
+def parse_provider_file(text):
+    """
+    Parse lines of NAME=<provider reference> into a dict.  Blank lines and
+    lines starting with # are ignored.
+    """
+    references = {}
+    for line_number, line in enumerate(text.split('\n'), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        name, sep, reference = line.partition('=')
+        if not sep or not name.strip().isidentifier():
+            raise ProviderError(f'Line {line_number} is not NAME=<provider reference>')
+        parse_reference(reference.strip())
+        references[name.strip()] = reference.strip()
+    return references
+
+
+def fetch(reference, env, timeout):
+    """
+    Returns the value a provider reference points to
+    """
+    provider, argument = parse_reference(reference)
+    if provider == 'env':
+        if argument not in env:
+            raise ProviderError(f'{argument} is not set')
+        return env[argument]
+
+    if provider == 'cmd':
+        result = subprocess.run(
+            ['bash', '-c', argument], env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            timeout=timeout, encoding='utf-8', errors='surrogateescape',
+        )
+        if result.returncode != 0:
+            raise ProviderError(f'exited with code {result.returncode}')
+        value = result.stdout
+    else:
+        with open(os.path.expanduser(argument), encoding='utf-8', errors='surrogateescape') as buff:
+            value = buff.read()
+    return value.rstrip('\n')
+
+
+def resolve_providers(references, env):
+    """
+    Fetch every reference at once.  references maps any key to a tuple of
+    (reference, timeout seconds).  Returns a dict mapping each key to its
+    value, or raises ProviderError describing every reference that failed or
+    didn't answer within its timeout.
+    """
+    outcomes = {}
+
+    def run(key, reference, timeout):
+        try:
+            outcomes[key] = (True, fetch(reference, env, timeout))
+        except subprocess.TimeoutExpired:
+            pass
+        except (OSError, ProviderError) as e:
+            outcomes[key] = (False, str(e))
+
+    # Daemon threads, so that a read stuck on a dead network mount can be left behind
+    started = time.monotonic()
+    threads = {}
+    for key, (reference, timeout) in references.items():
+        threads[key] = threading.Thread(target=run, args=(key, reference, timeout), daemon=True)
+        threads[key].start()
+
+    values = {}
+    errors = []
+    for key, thread in threads.items():
+        reference, timeout = references[key]
+        thread.join(max(0, started + timeout - time.monotonic()))
+        succeeded, result = outcomes.get(key, (False, f'no answer within {timeout} seconds'))
+        if succeeded:
+            values[key] = result
+        else:
+            errors.append(f'{reference}: {result}')
+
+    if errors:
+        raise ProviderError('\n'.join(errors))
+    return values
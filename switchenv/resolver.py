@@ -0,0 +1,133 @@
+from collections import defaultdict
+
+
+class ProfileCycleError(ValueError):
+    pass
+
+
+class ProfileGraph:
+    """
+    Resolves composed profiles into a flat list of the non-composed profiles
+    they run, in order, with every profile appearing only once (at its first
+    position).
+
+    Entries are fetched lazily through the lookup callable, which takes a
+    profile name and returns its entry (or None if there is no such profile).
+    Resolutions are memoized, and a reverse-dependency index makes it possible
+    to invalidate a profile along with only the composed profiles that
+    include it.
+    """
+    def __init__(self, lookup):
+        self.lookup = lookup
+
+        # Maps profile name to its sub-profile names (None for non-composed profiles)
+        self._children = {}
+
+        # Maps profile name to the tuple of non-composed profiles it resolves to
+        self._resolved = {}
+
+        # Maps profile name to the set of composed profiles that directly include it
+        self._dependents = defaultdict(set)
+
+    def children(self, name):
+        """
+        Returns the sub-profile names of a composed profile, or None for any
+        other kind of profile.  Raises KeyError for unknown profiles.
+        """
+        if name not in self._children:
+            entry = self.lookup(name)
+            if entry is None:
+                raise KeyError(name)
+
+            children = list(entry['code']) if entry['code_type'] == 'composed' else None
+            self._children[name] = children
+            for child in children or []:
+                self._dependents[child].add(name)
+
+        return self._children[name]
+
+    def resolve(self, name):
+        """
+        Returns the ordered, deduplicated tuple of non-composed profile names
+        that the named profile runs.
+        """
+        return self._resolve(name, [])
+
+    def _resolve(self, name, stack):
+        if name in self._resolved:
+            return self._resolved[name]
+
+        if name in stack:
+            cycle = stack[stack.index(name):] + [name]
+            raise ProfileCycleError(f'Composed profiles form a cycle: {" -> ".join(cycle)}')
+
+        children = self.children(name)
+        if children is None:
+            resolved = (name,)
+        else:
+            stack.append(name)
+            seen = set()
+            resolved = []
+            for child in children:
+                for leaf_name in self._resolve(child, stack):
+                    if leaf_name not in seen:
+                        seen.add(leaf_name)
+                        resolved.append(leaf_name)
+            stack.pop()
+            resolved = tuple(resolved)
+
+        self._resolved[name] = resolved
+        return resolved
+
+    def check(self, name, children):
+        """
+        Raise ProfileCycleError if composing name out of children would create a cycle
+        """
+        for child in children:
+            path = self._find_path(child, name, set())
+            if path is not None:
+                cycle = [name] + path
+                raise ProfileCycleError(f'Composed profiles would form a cycle: {" -> ".join(cycle)}')
+
+    def _find_path(self, start, target, visited):
+        if start == target:
+            return [start]
+        if start in visited:
+            return None
+
+        visited.add(start)
+        try:
+            children = self.children(start)
+        except KeyError:
+            # A dangling reference can't lead back to the target
+            return None
+
+        for child in children or []:
+            path = self._find_path(child, target, visited)
+            if path is not None:
+                return [start] + path
+        return None
+
+    def dependents(self, name):
+        """
+        Returns the set of known composed profiles that include name, directly or indirectly
+        """
+        found = set()
+        pending = [name]
+        while pending:
+            for dependent in self._dependents.get(pending.pop(), ()):
+                if dependent not in found:
+                    found.add(dependent)
+                    pending.append(dependent)
+        return found
+
+    def invalidate(self, name):
+        """
+        Forget everything memoized about a profile and the composed profiles that include it
+        """
+        for stale_name in {name} | self.dependents(name):
+            self._resolved.pop(stale_name, None)
+
+        # Drop the profile's own edges so they are re-read from the lookup
+        for child in self._children.pop(name, None) or []:
+            self._dependents[child].discard(name)
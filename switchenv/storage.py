@@ -0,0 +1,812 @@
+import contextlib
+import json
+import os
+
+from .trace import tracer
+
+
+class ConcurrentModificationError(RuntimeError):
+    pass
+
+
+class ReadOnlyStoreError(RuntimeError):
+    pass
+
+
+class FileLock:
+    """
+    A reentrant, cross-process exclusive lock built on fcntl.flock.  The
+    lock is released when the file descriptor is closed, so a crashed
+    process can never leave it held.  Threads of one process take turns
+    on a reentrant thread lock first, so only the thread holding that ever
+    counts depth or takes the flock.
+    """
+    def __init__(self, path):
+        import threading
+
+        self.path = path
+        self.depth = 0
+        self._fd = None
+        self._thread_lock = threading.RLock()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self.depth == 0:
+            try:
+                self._fd = self._flock()
+            except BaseException:
+                self._thread_lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def _flock(self):
+        import fcntl
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+
+def upgrade_blob(blob, blob_version):
+    """
+    Convert a blob saved by an older version of switchenv to the current layout
+    """
+    version = blob.get('version', 'unversioned')
+    if version != 'unversioned':
+        return blob
+
+    profiles = {}
+    for profile_name, code in blob.items():
+        entry = {'code': code, 'code_type': 'raw'}
+        profiles[profile_name] = entry
+
+    new_blob = {'version': blob_version, 'profiles': profiles}
+    return new_blob
+
+
+def value_digest(value):
+    """
+    The key a snapshot value is kept under in a store's value table
+    """
+    import hashlib
+    return hashlib.blake2b(value.encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+
+
+def pack_entry(entry, values):
+    """
+    Returns a snapshot entry with its values replaced by their digests, adding
+    the values to the values dict.  Other entries are returned unchanged.
+    """
+    if entry.get('code_type') != 'snapshot':
+        return entry
+    code = {}
+    for key, value in entry['code'].items():
+        code[key] = digest = value_digest(value)
+        values[digest] = value
+    return dict(entry, code=code)
+
+
+def unpack_entry(entry, values):
+    """
+    Undo pack_entry, looking the digests of a snapshot entry up in values
+    """
+    if entry.get('code_type') != 'snapshot':
+        return entry
+    return dict(entry, code={key: values[digest] for key, digest in entry['code'].items()})
+
+
+def referenced_digests(entries):
+    return {digest for entry in entries if entry.get('code_type') == 'snapshot' for digest in entry['code'].values()}
+
+
+_LOCKS = {}
+
+
+class BaseStore:
+    """
+    Every change to a store happens while holding a lock file in the config
+    directory, and bumps a generation counter.  Writers can pass the
+    generation they read to have the write refused if anyone else committed
+    in between.
+    """
+    name = None
+
+    def __init__(self, blob_dir, blob_version, read_only=False):
+        self.blob_dir = blob_dir
+        self.blob_version = blob_version
+        self.read_only = read_only
+
+        # Share one lock object per lock file, so that a process holding the
+        # lock through one store object can re-enter it through another
+        lock_file = os.path.join(blob_dir, '.profiles.lock')
+        self._lock = _LOCKS.setdefault(lock_file, FileLock(lock_file))
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Hold the store's lock.  Use this around a read-modify-write cycle so
+        that the reads see the latest committed state and nobody else can
+        commit until the cycle is done.
+        """
+        with self._lock:
+            if self._lock.depth == 1:
+                self._refresh()
+            yield self
+
+    def _refresh(self):
+        """
+        Forget anything cached from reads made before the lock was taken
+        """
+
+    def revalidate(self):
+        """
+        Forget anything cached if the store has changed since it was read
+        """
+
+    def writable_names(self):
+        """
+        Returns the names of the profiles that writes to this store can change or delete
+        """
+        return self.names()
+
+    def shared_fingerprint(self):
+        """
+        A cheap token that changes whenever any shared store layered under this one changes
+        """
+        return ''
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ReadOnlyStoreError(f'The profiles in {self.blob_dir} are read-only')
+
+    def _check_generation(self, current, expected):
+        if expected is not None and expected != current:
+            raise ConcurrentModificationError(
+                f'Profiles were changed by another process (generation {current}, expected {expected}).  '
+                'Nothing was saved, please retry.'
+            )
+
+
+class JSONStore(BaseStore):
+    """
+    Keeps every profile in a single json file.  Any change rewrites the whole
+    file, which is verified before it is moved into place.  The values of
+    snapshot profiles are kept once each, in a 'values' table keyed by digest.
+    """
+    name = 'json'
+
+    def __init__(self, blob_dir, blob_version, read_only=False):
+        super().__init__(blob_dir, blob_version, read_only=read_only)
+        self.BLOB_FILE = os.path.join(blob_dir, 'profiles.json')
+
+        # The blob as saved, and the (saved blob, blob with snapshot values filled in) it was last unpacked into
+        self._blob = None
+        self._blob_fingerprint = None
+        self._unpacked = (None, None)
+
+    def _refresh(self):
+        self._blob = None
+
+    def revalidate(self):
+        if self._blob is not None and self._blob_fingerprint != self.fingerprint():
+            self._blob = None
+
+    def exists(self):
+        return os.path.isfile(self.BLOB_FILE)
+
+    def load(self):
+        """
+        Returns the saved blob in its current version.  Empty blob if nothing saved.
+        """
+        stored = self._stored()
+        if self._unpacked[0] is not stored:
+            values = stored.get('values', {})
+            blob = {key: val for key, val in stored.items() if key != 'values'}
+            if 'profiles' in stored:
+                blob['profiles'] = {name: unpack_entry(entry, values) for name, entry in stored['profiles'].items()}
+            self._unpacked = (stored, blob)
+        return self._unpacked[1]
+
+    def _stored(self):
+        """
+        Returns the blob as saved, with snapshot values kept in its value table
+        """
+        if self._blob is None:
+            # Fingerprint first, so a change made while reading can only make us reload again
+            self._blob_fingerprint = self.fingerprint()
+            self._blob = upgrade_blob(self._load_file(self.BLOB_FILE), self.blob_version)
+        return self._blob
+
+    def fingerprint(self):
+        """
+        A cheap token that changes whenever the store's contents change
+        """
+        from .cache import file_fingerprint
+        return file_fingerprint(self.BLOB_FILE)
+
+    def get(self, name):
+        stored = self._stored()
+        entry = stored.get('profiles', {}).get(name)
+        return None if entry is None else unpack_entry(entry, stored.get('values', {}))
+
+    def names(self):
+        return sorted(self._stored().get('profiles', {}).keys())
+
+    def generation(self):
+        return self._stored().get('generation', 0)
+
+    def write(self, updates=None, deletes=(), generation=None):
+        """
+        Apply a set of profile updates and deletions in a single save.
+        updates maps profile names to entries, or is any iterable of (name,
+        entry) pairs.  Both are consumed in order, updates first, and an
+        exception raised while consuming them saves nothing.
+        """
+        self._check_writable()
+        with tracer.phase('store.write', store=self.name), self.locked():
+            # Work on a copy, so a failed write leaves the loaded blob as it was
+            blob = dict(self._stored())
+            self._check_generation(blob.get('generation', 0), generation)
+
+            values = dict(blob.get('values', {}))
+            if isinstance(updates, dict):
+                updates = updates.items()
+            profiles = blob['profiles'] = dict(blob.get('profiles', {}))
+            profiles.update((name, pack_entry(entry, values)) for name, entry in (updates or ()))
+            for name in deletes:
+                profiles.pop(name, None)
+            self._commit(self._with_values(blob, values))
+
+    def replace(self, blob):
+        """
+        Atomically save a blob to the canonical file_name.  If the blob
+        carries a generation, it must match the generation on disk.
+        """
+        self._check_writable()
+        with tracer.phase('store.replace', store=self.name), self.locked():
+            current = self.generation()
+            self._check_generation(current, blob.get('generation'))
+
+            values = {}
+            profiles = {name: pack_entry(entry, values) for name, entry in blob.get('profiles', {}).items()}
+            self._commit(self._with_values(dict(blob, generation=current, profiles=profiles), values))
+
+    def _with_values(self, blob, values):
+        """
+        Returns blob with a value table holding just the values its snapshot profiles use
+        """
+        blob.pop('values', None)
+        used = referenced_digests(blob['profiles'].values())
+        if used:
+            blob['values'] = {digest: values[digest] for digest in sorted(used)}
+        return blob
+
+    def _commit(self, blob):
+        """
+        Save a blob in its stored form, with snapshot values in its value table
+        """
+        import tempfile
+
+        self._blob = None
+
+        # Make sure the blob has the proper version
+        blob['version'] = self.blob_version
+        blob['generation'] = blob.get('generation', 0) + 1
+
+        # Save the blob to a temp file that no other writer can be using
+        fd, temp_file = tempfile.mkstemp(dir=self.blob_dir, prefix='__temp_profiles__.', suffix='.json')
+        os.close(fd)
+        self._save_file(blob, temp_file)
+
+        # If temp file contents match blob, overwrite standard blob
+        # file with temp file
+        if self._confirm_file_contents(blob, temp_file):
+            os.replace(temp_file, self.BLOB_FILE)
+
+            # The file was just verified to hold exactly this blob
+            self._blob = blob
+            self._blob_fingerprint = self.fingerprint()
+        else:
+            os.unlink(temp_file)
+            import warnings
+            warnings.warn('Warning.  File contents could not be verified.  Something went wrong with saving.')
+
+    def _load_file(self, file_name):
+        """
+        Load a json file with provided name.
+        Returns blank dict if file doesn't exist
+        """
+        if os.path.isfile(file_name):
+            with tracer.phase('store.read', store=self.name), open(file_name, 'r') as data_file:
+                blob = json.load(data_file)
+            tracer.count('files_read')
+        else:
+            blob = {}
+        return blob
+
+    def _save_file(self, blob, file_name):
+        """
+        Saves a json blob to specified file_name
+        """
+        with open(file_name, 'w') as out_file:
+            json.dump(blob, out_file, indent=2)
+        tracer.count('files_written')
+
+    def _confirm_file_contents(self, blob, file_name):
+        """
+        Compares the contents of a blob with those
+        of a saved file
+        """
+        saved_blob = self._load_file(file_name)
+        return blob == saved_blob
+
+    def retire(self):
+        """
+        Move the store's file out of the way after its profiles have moved elsewhere
+        """
+        self._blob = None
+        if self.exists():
+            os.replace(self.BLOB_FILE, f'{self.BLOB_FILE}.migrated')
+
+
+class SQLiteStore(BaseStore):
+    """
+    Keeps one row per profile in a sqlite database running in WAL mode, so
+    reading or writing a single profile doesn't touch any of the others.
+    The values of snapshot profiles are kept once each, in a table keyed by
+    digest.  On first use, profiles are migrated in from an existing json store.
+    """
+    name = 'sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS profiles (
+            name TEXT PRIMARY KEY,
+            entry TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS snapshot_values (
+            digest TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS snapshot_refs (
+            name TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (name, digest)
+        );
+        CREATE INDEX IF NOT EXISTS snapshot_refs_by_digest ON snapshot_refs (digest);
+    """
+
+    # Fills in the digests every snapshot profile uses, for databases saved before they were tracked
+    INDEX_REFS = """
+        INSERT OR IGNORE INTO snapshot_refs (name, digest)
+        SELECT profiles.name, used.value FROM profiles, json_each(profiles.entry, '$.code') AS used
+        WHERE json_extract(profiles.entry, '$.code_type') = 'snapshot'
+    """
+
+    # Drops those of the given digests that no snapshot profile uses any more
+    PRUNE_VALUES = """
+        DELETE FROM snapshot_values
+        WHERE digest IN (SELECT value FROM json_each(?))
+        AND NOT EXISTS (SELECT 1 FROM snapshot_refs WHERE snapshot_refs.digest = snapshot_values.digest)
+    """
+
+    def __init__(self, blob_dir, blob_version, read_only=False):
+        super().__init__(blob_dir, blob_version, read_only=read_only)
+        self.DB_FILE = os.path.join(blob_dir, 'profiles.db')
+        self._connection = None
+
+    def exists(self):
+        return os.path.isfile(self.DB_FILE)
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            import sqlite3
+
+            is_new = not self.exists()
+            with tracer.phase('store.connect', store=self.name):
+                if self.read_only:
+                    # Someone else's database, possibly on a read-only mount, so change nothing
+                    connection = sqlite3.connect(
+                        f'file:{self.DB_FILE}?mode=ro', uri=True, timeout=30, isolation_level=None
+                    )
+                else:
+                    connection = sqlite3.connect(self.DB_FILE, timeout=30, isolation_level=None)
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    connection.execute('PRAGMA synchronous=NORMAL')
+                    connection.executescript(self.SCHEMA)
+            tracer.count('files_read')
+            self._connection = connection
+
+            if not self.read_only:
+                self._index_refs()
+            if is_new and not self.read_only:
+                self._migrate_from_json()
+        return self._connection
+
+    def _index_refs(self):
+        """
+        Track the digests used by profiles saved before they were tracked, once
+        """
+        indexed = "SELECT 1 FROM meta WHERE key = 'snapshot_refs'"
+        if self._connection.execute(indexed).fetchone() is not None:
+            return
+        with self._transaction() as connection:
+            # Checked again under the write lock, in case another process got here first
+            if connection.execute(indexed).fetchone() is None:
+                connection.execute(self.INDEX_REFS)
+                connection.execute("INSERT INTO meta (key, value) VALUES ('snapshot_refs', '1')")
+
+    def _migrate_from_json(self):
+        json_store = JSONStore(self.blob_dir, self.blob_version)
+        if not json_store.exists():
+            return
+
+        blob = dict(json_store.load())
+        blob.pop('generation', None)
+        self.replace(blob)
+        json_store.retire()
+
+    def _transaction(self):
+        return _SQLiteTransaction(self.connection)
+
+    def load(self):
+        with tracer.phase('store.read', store=self.name):
+            rows = self.connection.execute('SELECT name, entry FROM profiles ORDER BY name')
+            profiles = {name: json.loads(entry) for name, entry in rows}
+            if referenced_digests(profiles.values()):
+                values = self._values()
+                profiles = {name: unpack_entry(entry, values) for name, entry in profiles.items()}
+        return {'version': self.blob_version, 'generation': self.generation(), 'profiles': profiles}
+
+    def fingerprint(self):
+        """
+        A cheap token that changes whenever the store's contents change
+        """
+        return str(self.generation())
+
+    def get(self, name):
+        row = self.connection.execute('SELECT entry FROM profiles WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        entry = json.loads(row[0])
+        if entry.get('code_type') == 'snapshot':
+            entry = unpack_entry(entry, self._values(entry['code'].values()))
+        return entry
+
+    def _values(self, digests=None):
+        """
+        Returns {digest: value} for the given digests, or for every stored value
+        """
+        if digests is None:
+            rows = self.connection.execute('SELECT digest, value FROM snapshot_values')
+        else:
+            rows = self.connection.execute(
+                'SELECT digest, value FROM snapshot_values WHERE digest IN (SELECT value FROM json_each(?))',
+                (json.dumps(sorted(set(digests))),)
+            )
+        # Values are saved as json, so that values python read with surrogateescape survive
+        return {digest: json.loads(value) for digest, value in rows}
+
+    def _save_values(self, connection, values, written, changed):
+        """
+        Save the values of the written entries and track which digests each
+        uses.  Only digests the changed profiles used before can have become
+        unused, so only those are checked for pruning.
+        """
+        changed = json.dumps(sorted(changed))
+        dropped = [digest for digest, in connection.execute(
+            'SELECT DISTINCT digest FROM snapshot_refs WHERE name IN (SELECT value FROM json_each(?))', (changed,)
+        )]
+        connection.execute('DELETE FROM snapshot_refs WHERE name IN (SELECT value FROM json_each(?))', (changed,))
+        connection.executemany(
+            'INSERT OR IGNORE INTO snapshot_refs (name, digest) VALUES (?, ?)',
+            ((name, digest) for name, entry in written.items() for digest in referenced_digests([entry]))
+        )
+        connection.executemany(
+            'INSERT OR IGNORE INTO snapshot_values (digest, value) VALUES (?, ?)',
+            ((digest, json.dumps(value)) for digest, value in values.items())
+        )
+        connection.execute(self.PRUNE_VALUES, (json.dumps(dropped),))
+
+    def names(self):
+        return [name for name, in self.connection.execute('SELECT name FROM profiles ORDER BY name')]
+
+    def generation(self):
+        return self._generation(self.connection)
+
+    def _generation(self, connection):
+        row = connection.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return 0 if row is None else int(row[0])
+
+    def _bump_generation(self, connection, expected):
+        current = self._generation(connection)
+        self._check_generation(current, expected)
+        connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (str(current + 1),)
+        )
+
+    def write(self, updates=None, deletes=(), generation=None):
+        """
+        Apply a set of profile updates and deletions in a single transaction.
+        updates maps profile names to entries, or is any iterable of (name,
+        entry) pairs.  Both are consumed in order, updates first, and an
+        exception raised while consuming them rolls everything back.
+        """
+        self._check_writable()
+        if isinstance(updates, dict):
+            updates = updates.items()
+
+        values = {}
+        written = {}
+        deleted = []
+
+        def packed_updates():
+            for name, entry in updates or ():
+                written[name] = entry = pack_entry(entry, values)
+                yield name, json.dumps(entry)
+
+        def consumed_deletes():
+            for name in deletes:
+                deleted.append(name)
+                written.pop(name, None)
+                yield name,
+
+        with tracer.phase('store.write', store=self.name), self.locked(), self._transaction() as connection:
+            self._bump_generation(connection, generation)
+            connection.executemany('INSERT OR REPLACE INTO profiles (name, entry) VALUES (?, ?)', packed_updates())
+            connection.executemany('DELETE FROM profiles WHERE name = ?', consumed_deletes())
+            self._save_values(connection, values, written, set(written) | set(deleted))
+
+    def replace(self, blob):
+        """
+        Replace every stored profile with the contents of blob.  If the blob
+        carries a generation, it must match the generation in the database.
+        """
+        self._check_writable()
+        with tracer.phase('store.replace', store=self.name), self.locked(), self._transaction() as connection:
+            self._bump_generation(connection, blob.get('generation'))
+            previous = [name for name, in connection.execute('SELECT name FROM profiles')]
+            connection.execute('DELETE FROM profiles')
+            values = {}
+            written = {name: pack_entry(entry, values) for name, entry in blob.get('profiles', {}).items()}
+            connection.executemany(
+                'INSERT INTO profiles (name, entry) VALUES (?, ?)',
+                [(name, json.dumps(entry)) for name, entry in written.items()]
+            )
+            self._save_values(connection, values, written, set(written) | set(previous))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def retire(self):
+        """
+        Move the database out of the way after its profiles have moved elsewhere
+        """
+        self.close()
+        if self.exists():
+            os.replace(self.DB_FILE, f'{self.DB_FILE}.migrated')
+
+
+class _SQLiteTransaction:
+    """
+    An explicit write transaction.  BEGIN IMMEDIATE takes the write lock up
+    front so concurrent writers wait instead of failing half way through.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+class LayeredStore(BaseStore):
+    """
+    Merges read-only shared stores, such as a team's profiles on a network
+    mount, underneath a personal store.  A personal profile hides any shared
+    profile with the same name, and every write goes to the personal store.
+    A merged index maps each name to the layer holding it, so looking up a
+    profile reads only that layer and listing names doesn't rescan them all.
+    """
+    def __init__(self, personal, shared):
+        super().__init__(personal.blob_dir, personal.blob_version)
+        self.personal = personal
+        self.shared = list(shared)
+
+        # Maps profile names to the layer they come from, and the fingerprint it was built for
+        self._owners = None
+        self._owners_fingerprint = None
+
+    @property
+    def name(self):
+        return self.personal.name
+
+    @property
+    def layers(self):
+        """
+        Every store in order of precedence, the personal one first
+        """
+        return [self.personal] + self.shared
+
+    def _refresh(self):
+        for layer in self.layers:
+            layer._refresh()
+        self._owners = None
+
+    def revalidate(self):
+        for layer in self.layers:
+            layer.revalidate()
+        if self._owners is not None and self._owners_fingerprint != self.fingerprint():
+            self._owners = None
+
+    @property
+    def owners(self):
+        if self._owners is None:
+            with tracer.phase('store.merge', layers=len(self.layers)):
+                # Fingerprint first, so a change made while reading can only make us rebuild again
+                self._owners_fingerprint = self.fingerprint()
+                owners = {}
+                for layer in reversed(self.layers):
+                    owners.update(dict.fromkeys(layer.names(), layer))
+            self._owners = owners
+        return self._owners
+
+    def exists(self):
+        return self.personal.exists()
+
+    def load(self):
+        profiles = {}
+        for layer in reversed(self.layers):
+            profiles.update(layer.load().get('profiles', {}))
+        return {'version': self.blob_version, 'generation': self.generation(), 'profiles': profiles}
+
+    def fingerprint(self):
+        return '|'.join(layer.fingerprint() for layer in self.layers)
+
+    def shared_fingerprint(self):
+        return '|'.join(layer.fingerprint() for layer in self.shared)
+
+    def get(self, name):
+        layer = self.owners.get(name)
+        return None if layer is None else layer.get(name)
+
+    def names(self):
+        return sorted(self.owners)
+
+    def generation(self):
+        return self.personal.generation()
+
+    def _shared_profiles(self):
+        profiles = {}
+        for layer in reversed(self.shared):
+            profiles.update(layer.load().get('profiles', {}))
+        return profiles
+
+    def write(self, updates=None, deletes=(), generation=None):
+        """
+        Apply a set of profile updates and deletions to the personal store.
+        Shared profiles can be hidden by personal ones, but not deleted.
+        """
+        owners = self.owners
+
+        def checked_deletes():
+            # Checked one at a time, so that deletes can be consumed as lazily as the personal store wants
+            for name in deletes:
+                if owners.get(name) not in (None, self.personal):
+                    raise ReadOnlyStoreError(f"Shared profile '{name}' can only be deleted where it is kept")
+                yield name
+
+        self._owners = None
+        try:
+            self.personal.write(updates=updates, deletes=checked_deletes(), generation=generation)
+        finally:
+            # Lookups made during the write may have indexed it half done
+            self._owners = None
+
+    def writable_names(self):
+        return self.personal.names()
+
+    def replace(self, blob):
+        """
+        Replace everything in the personal store with the contents of blob,
+        leaving out the profiles the shared stores already provide unchanged
+        """
+        shared = self._shared_profiles()
+        profiles = {name: entry for name, entry in blob.get('profiles', {}).items() if shared.get(name) != entry}
+
+        self._owners = None
+        self.personal.replace(dict(blob, profiles=profiles))
+
+
+STORES = {
+    JSONStore.name: JSONStore,
+    SQLiteStore.name: SQLiteStore,
+}
+
+
+_STORES = {}
+
+
+def open_store(blob_dir, blob_version, backend=None, read_only=False):
+    """
+    Returns the store for a config directory.  The backend can be forced
+    with the SWITCHENV_STORE environment variable.  Otherwise a directory
+    holding a sqlite database uses it, and everything else uses json.
+    Read-only stores belong to someone else, so they always go by what the
+    directory holds.
+    """
+    if backend is None and not read_only:
+        backend = os.environ.get('SWITCHENV_STORE')
+    if backend is None:
+        backend = SQLiteStore.name if os.path.isfile(os.path.join(blob_dir, 'profiles.db')) else JSONStore.name
+
+    if backend not in STORES:
+        raise ValueError(f'Unknown store {backend!r}.  Choose from {sorted(STORES)}')
+
+    # Share one store per config directory, so everything in a process reuses
+    # what has already been read.  sqlite connections can't cross threads, so
+    # those are shared per thread.
+    key = (backend, blob_dir, blob_version, read_only)
+    if backend == SQLiteStore.name:
+        import threading
+        key += (threading.get_ident(),)
+    if key not in _STORES:
+        _STORES[key] = STORES[backend](blob_dir, blob_version, read_only=read_only)
+    return _STORES[key]
+
+
+def open_layered_store(blob_dir, blob_version, shared_dirs=()):
+    """
+    Returns the store for a config directory with the stores of shared_dirs
+    layered read-only underneath it, earlier directories taking precedence
+    """
+    store = open_store(blob_dir, blob_version)
+    shared_dirs = [shared_dir for shared_dir in shared_dirs if shared_dir != blob_dir]
+    if not shared_dirs:
+        return store
+
+    shared = tuple(open_store(shared_dir, blob_version, read_only=True) for shared_dir in shared_dirs)
+    key = (LayeredStore, store) + shared
+    if key not in _STORES:
+        _STORES[key] = LayeredStore(store, shared)
+    return _STORES[key]
+
+
+def convert_store(blob_dir, blob_version, backend):
+    """
+    Move every profile into a store of the requested kind.  The store that
+    was in use is renamed with a .migrated suffix.
+    """
+    current = open_store(blob_dir, blob_version)
+    if current.name == backend:
+        return current
+
+    blob = dict(current.load())
+    blob.pop('generation', None)
+
+    target = STORES[backend](blob_dir, blob_version)
+    with current.locked():
+        target.replace(blob)
+        current.retire()
+    return target
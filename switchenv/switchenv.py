@@ -1,16 +1,30 @@
 #! /usr/bin/env python
 
-import contextlib
 import os
-import subprocess
+import shlex
 import sys
 import json
-import click
-import shutil
+import time
 from typing import Optional
-import fuzzypicker
-import textwrap
-import warnings
+
+from .cache import FileCache, file_fingerprint
+from .environ import ActivationError
+from .index import NameIndex, UsageTable, rank, write_text_atomically
+from .resolver import ProfileGraph
+from .storage import ReadOnlyStoreError, open_layered_store
+from .trace import tracer
+
+
+class CachedProfileError(ActivationError):
+    """
+    Raised when a cached profile's code fails, so there are no exports to cache
+    """
+
+
+class ProviderValuesError(ActivationError):
+    """
+    Raised when the values of a provider profile couldn't all be fetched
+    """
 
 
 class cached_property(object):
@@ -28,7 +42,65 @@ class cached_property(object):
         return res
 
 
+class ProfileViews:
+    """
+    Everything derived from one state of a store: the blob, the lists of
+    names and items, the composed-profile resolver and resolved code.  Views
+    are shared by every SwitchEnv in the process and replaced as a whole when
+    the store changes, so none of them can go stale without the others.
+    """
+    def __init__(self, store, fingerprint):
+        self.store = store
+        self.fingerprint = fingerprint
+
+        # Maps profile name to its resolved code
+        self.code = {}
+
+    @cached_property
+    def blob(self):
+        return self.store.load()
+
+    @cached_property
+    def keys(self):
+        return self.store.names()
+
+    @cached_property
+    def items(self):
+        return sorted(self.blob.get('profiles', {}).items())
+
+    @cached_property
+    def graph(self):
+        return ProfileGraph(self.store.get)
+
+
+# Maps each store to the views of its current state
+_VIEWS = {}
+
+
+def shared_views(store):
+    """
+    Returns the views of the store, rebuilt only if its fingerprint (the
+    inode, mtime and size of a json store) shows it has changed.
+    """
+    fingerprint = store.fingerprint()
+    views = _VIEWS.get(store)
+    if views is None or views.fingerprint != fingerprint:
+        store.revalidate()
+        views = _VIEWS[store] = ProfileViews(store, fingerprint)
+    return views
+
+
+# Maps each location file to what was read from it, so it is read once per process
+_LOCATION_BLOBS = {}
+
+
 class BlobDirHandler:
+    """
+    Resolves the config directory from the location file in the package
+    directory.  The file is read at most once per process and never written
+    unless the location is changed, so a read-only install works.  The
+    SWITCHENV_HOME environment variable overrides the location file.
+    """
     FILE_DIR = os.path.dirname(os.path.realpath(__file__))
     LOCATION_FILE = os.path.join(FILE_DIR, 'blob_location.json')
     DEFAULT_BLOB_DIR = os.path.realpath(os.path.expanduser('~/.switchenv'))
@@ -37,70 +109,256 @@ class BlobDirHandler:
         self.location_file = os.path.join(self.FILE_DIR, 'blob_location.json')
 
     def change_blob_location(self, location):
+        self._save(location=location)
+        print(f'\nConfig directory is now: {location}\n')
+
+    def change_shared_locations(self, locations):
+        self._save(shared=list(locations))
+        if locations:
+            print('\nShared config directories are now:\n{}\n'.format('\n'.join(locations)))
+        else:
+            print('\nNo shared config directories\n')
+
+    def change_normalization(self, variables=None, drop_missing=None):
+        changes = {}
+        if variables is not None:
+            changes['normalize'] = list(variables)
+        if drop_missing is not None:
+            changes['drop_missing'] = drop_missing
+        self._save(**changes)
+        print('\nNormalized variables are now: {}{}\n'.format(
+            ' '.join(self.normalized_variables) or 'none',
+            ', dropping missing directories' if self.drop_missing_dirs else '',
+        ))
+
+    def _save(self, **changes):
         location_blob = self.location_blob
-        location_blob.update(location=location)
+        location_blob.update(changes)
 
         with open(self.location_file, 'w') as buff:
             json.dump(location_blob, buff)
-        print(f'\nConfig directory is now: {location}\n')
+        _LOCATION_BLOBS[self.location_file] = location_blob
 
     @property
     def location_blob(self):
-        try:
-            if not os.path.isfile(self.location_file):
-                location_blob = {'location': self.DEFAULT_BLOB_DIR}
-                with open(self.location_file, 'w') as buff:
-                    json.dump(location_blob, buff)
-
-            with open(self.location_file) as buff:
-                location_blob = json.load(buff)
-        except:  # noqa
-            if os.path.isfile(self.location_file):
-                os.unlink(self.location_file)
-                location_blob = self.location_blob
-            else:
-                location_blob = {'location': self.DEFAULT_BLOB_DIR}
-        return location_blob.copy()
+        if self.location_file not in _LOCATION_BLOBS:
+            location_blob = {'location': self.DEFAULT_BLOB_DIR}
+            try:
+                with tracer.phase('location'), open(self.location_file) as buff:
+                    location_blob.update(json.load(buff))
+                tracer.count('files_read')
+            except (OSError, ValueError, TypeError):
+                # A missing or corrupt location file means the defaults
+                pass
+            _LOCATION_BLOBS[self.location_file] = location_blob
+        return dict(_LOCATION_BLOBS[self.location_file])
 
-    def __get__(self, instance, type=None):
+    @property
+    def location(self):
+        home = os.environ.get('SWITCHENV_HOME')
+        if home:
+            return os.path.realpath(os.path.expanduser(home))
         return self.location_blob['location']
 
+    @property
+    def shared_locations(self):
+        """
+        The config directories of read-only stores layered under this one.
+        SWITCHENV_SHARED, separated like PATH, overrides the location file.
+        """
+        shared = os.environ.get('SWITCHENV_SHARED')
+        if shared is None:
+            shared = self.location_blob.get('shared', [])
+        else:
+            shared = shared.split(os.pathsep)
+        return [os.path.realpath(os.path.expanduser(location)) for location in shared if location]
+
+    @property
+    def normalized_variables(self):
+        """
+        The colon separated variables deduplicated on activation.
+        SWITCHENV_NORMALIZE, separated like PATH, overrides the location file,
+        and an empty one turns normalization off.
+        """
+        from .environ import DEFAULT_NORMALIZED_VARS
+
+        variables = os.environ.get('SWITCHENV_NORMALIZE')
+        if variables is None:
+            return list(self.location_blob.get('normalize', DEFAULT_NORMALIZED_VARS))
+        return [name for name in variables.split(os.pathsep) if name]
+
+    @property
+    def drop_missing_dirs(self):
+        """
+        Whether normalizing also drops entries that aren't directories.
+        SWITCHENV_DROP_MISSING=1 or 0 overrides the location file.
+        """
+        drop_missing = os.environ.get('SWITCHENV_DROP_MISSING')
+        if drop_missing is None:
+            return bool(self.location_blob.get('drop_missing', False))
+        return drop_missing not in {'', '0'}
+
+    def __get__(self, instance, type=None):
+        return self.location
+
+
+class SharedDirsHandler(BlobDirHandler):
+    def __get__(self, instance, type=None):
+        return self.shared_locations
+
 
 class SwitchEnv:
     # Define the file locations for persisting environments
     BLOB_DIR = BlobDirHandler()
+    SHARED_DIRS = SharedDirsHandler()
+
+    # How long a cached profile's exports are reused when it doesn't say
+    DEFAULT_CACHED_TTL = 3600
 
     # BLOB_DIR = os.path.realpath(os.path.expanduser('~/.switchenv'))
     def __init__(self):
-        self.BLOB_FILE = os.path.join(self.BLOB_DIR, 'profiles.json')
-        self.TEMP_FILE = os.path.join(self.BLOB_DIR, '__temp_profiles__.json')
+        # Resolve the locations once for this instance
+        self.BLOB_DIR = self.BLOB_DIR
+        self.SHARED_DIRS = self.SHARED_DIRS
+
+        # The colon separated variables activation deduplicates
+        normalization = BlobDirHandler()
+        self.NORMALIZED_VARS = normalization.normalized_variables
+        self.DROP_MISSING_DIRS = normalization.drop_missing_dirs
+
         self.BASH_RC_FILE = os.path.realpath(os.path.expanduser('~/.bashrc'))
-        self.TEMP_RC_FILE = os.path.join(self.BLOB_DIR, 'switchenvrc.sh')
+        self.CACHE_DIR = os.path.join(self.BLOB_DIR, 'cache')
+
+        # Profile names, one per line, for shell completion to read without starting python
+        self.NAMES_FILE = os.path.join(self.BLOB_DIR, 'profile_names')
+        self.SHARED_NAMES_FILE = os.path.join(self.BLOB_DIR, 'profile_names.shared')
 
         self.BLOB_VERSION = '1.0'
 
+        # Bump this whenever the layout of rendered rc files changes so that
+        # previously compiled scripts are never reused
+        self.RC_FORMAT_VERSION = '2'
+        self.rc_cache = FileCache(os.path.join(self.CACHE_DIR, 'rc'), suffix='.sh')
+        self.env_cache = FileCache(os.path.join(self.CACHE_DIR, 'env'), suffix='.json')
+
+        # The exports evaluated from cached profiles, kept until their ttl runs out
+        self.exports_cache = FileCache(os.path.join(self.CACHE_DIR, 'exports'), suffix='.json')
+
         # Ensure directory structure every time class is instantiate4d
         os.makedirs(self.BLOB_DIR, exist_ok=True)
 
-    def make_temp_rc_file(self, profile, code):
+        self.store = open_layered_store(self.BLOB_DIR, self.BLOB_VERSION, self.SHARED_DIRS)
+
+    def make_temp_rc_file(self, profile, code, env=None):
+        """
+        Returns the path to an rc file that activates the profile.  Compiled
+        rc files are cached, keyed on everything that goes into rendering them,
+        so a warm activation costs only a stat of the user's bashrc.  Setting
+        SWITCHENV_CACHE_MAX_BYTES=0 turns the cache off, and the rc file is then
+        private to this process and never touches the disk where possible.
+        The rc file must be run by a bash that inherited env, which defaults to
+        our own environment.
+        """
+        env = self.env if env is None else env
+        if self.rc_cache.max_bytes <= 0:
+            return private_script_path(self.render_rc(profile, code, env=env))
+
+        with tracer.phase('rc_cache.lookup'):
+            key = self.rc_cache.make_key(
+                self.RC_FORMAT_VERSION,
+                self.BLOB_VERSION,
+                profile,
+                code,
+                file_fingerprint(self.BASH_RC_FILE),
+                '__PSSWE__' in env,
+                self.NORMALIZED_VARS,
+                self.DROP_MISSING_DIRS,
+            )
+            rc_file = self.rc_cache.get(key)
+        if rc_file is None:
+            text = self.render_rc(profile, code, env=env)
+            with tracer.phase('rc_cache.put'):
+                rc_file = self.rc_cache.put(key, text)
+        return rc_file
+
+    def resolved_environment(self, profile, code, env=None, normalize=True):
+        """
+        Returns the changes a profile makes to the current environment (or to
+        env if given) as a dict with 'set' and 'unset' keys.  Its 'functions'
+        key is True if the profile defines shell functions or aliases, which an
+        environment alone can't carry.  The profile is evaluated by bash once and
+        the result is cached, keyed on the profile code, the user's bashrc and the environment.
+        With normalize=False, PATH style variables are left as the profile made them.
+        Raises ProbeError, caching nothing, if bash didn't run the profile to the end.
+        """
+        import subprocess
+        from .environ import PROBE_AFTER_CODE, PROBE_BEFORE_CODE, ProbeError, diff_environments
+        from .environ import environment_fingerprint, parse_probe_output, probe_delimiter
+
+        env = self.env if env is None else env
+        with tracer.phase('env_cache.lookup'):
+            key = self.env_cache.make_key(
+                self.RC_FORMAT_VERSION,
+                self.BLOB_VERSION,
+                profile,
+                code,
+                file_fingerprint(self.BASH_RC_FILE),
+                environment_fingerprint(env),
+                self.NORMALIZED_VARS if normalize else (),
+                self.DROP_MISSING_DIRS and normalize,
+            )
+            cached = self.env_cache.read(key)
+        if cached is not None:
+            return json.loads(cached)['delta']
+
+        # Source the probe the same way exec sources its rc file, so that a
+        # bashrc that returns early behaves the same way in both
+        delimiter = probe_delimiter()
+        script = self.render_rc(
+            profile, code, before_code=PROBE_BEFORE_CODE, after_code=PROBE_AFTER_CODE.format(delimiter=delimiter),
+            env=env, normalize=normalize,
+        )
+        with tracer.phase('probe'):
+            result = subprocess.run(
+                ['bash', '-c', 'source /dev/stdin'],
+                input=script, capture_output=True, env=env, encoding='utf-8', errors='surrogateescape',
+            )
+        if result.returncode != 0:
+            raise ProbeError(f'bash exited with code {result.returncode} while activating {profile!r}')
+        defines_functions, resolved_env = parse_probe_output(result.stdout, delimiter)
+
+        delta = dict(diff_environments(env, resolved_env), functions=defines_functions)
+        self.env_cache.put(key, json.dumps({'delta': delta}))
+        return delta
+
+    def render_rc(self, profile, code, before_code='', after_code='', env=None, normalize=True):
+        """
+        Render the text of an rc file that activates the profile in a bash
+        that inherited env.  The optional before_code and after_code run just
+        before and after the profile code.  Unless normalize is False, the
+        PATH style variables in NORMALIZED_VARS are deduplicated after the profile code.
+        """
+        import textwrap
+
+        from .environ import normalize_script
+
+        env = self.env if env is None else env
 
         input_code_lines = code.split('\n')
         # Save off the PS1 variable before anything can change it
         pre_code_lines = []
-        if '__PSSWE__' not in self.env:
+        if '__PSSWE__' not in env:
             pre_code_lines.append(' export __PSSWE__="$PS1"')
 
         # Add the profile name to the front of PS1
         post_code_lines = [
             f' export __PSSWE__="•{profile}•$__PSSWE__"',
-            f' PS1="$__PSSWE__"'
+            ' PS1="$__PSSWE__"'
         ]
 
-        # Create lines that will store the current env
-        env_lines = []
-        for key, val in self.env.items():
-            env_lines.append(f'export {key}="{val}"')
-        env_code = '\n'.join(env_lines)
+        # Nested shells and composed profiles keep prepending to PATH style variables
+        if normalize:
+            post_code_lines.insert(0, normalize_script(self.NORMALIZED_VARS, self.DROP_MISSING_DIRS))
 
         # Build code from the stored profile
         pre_code = '\n'.join(pre_code_lines)
@@ -111,203 +369,654 @@ class SwitchEnv:
         # Load in the user's bashrc file
         bashrc = ''
         if os.path.isfile(self.BASH_RC_FILE):
-            with open(self.BASH_RC_FILE) as bashrc_file:
+            with tracer.phase('bashrc.read'), open(self.BASH_RC_FILE) as bashrc_file:
                 bashrc = bashrc_file.read()
-
-        # The order here is important.  The users .bashrc can reset
-        # the path variable overriding any currently set envs vars.
-        # So:
-        #    1) Run their .bashrc
-        #    2) export all current environment variables
+            tracer.count('files_read')
+
+        # The users .bashrc can reset variables, the path in particular, that
+        # the shell inherited from env.  Rather than writing every variable into
+        # the rc file, the shell saves what it inherited, properly quoted, and
+        # restores it after the bashrc.  Without a bashrc there is nothing to restore.
+        save_env_code = restore_env_code = ''
+        if bashrc.strip():
+            save_env_code = '__switchenv_inherited="$(export -p)"'
+            restore_env_code = '\n'.join([
+                # Inherited variables that bash keeps read-only can't be restored, and never change
+                'eval "$__switchenv_inherited" 2>/dev/null',
+                'unset __switchenv_inherited',
+            ])
+
+        # The order here is important.  So:
+        #    1) Save the inherited environment and run their .bashrc
+        #    2) restore the inherited environment
         #    3) source the custom profile code
-        bashrc = textwrap.dedent(f'\n{bashrc}\n{pre_code}\n{env_code}\n{code}\n{post_code}')
-        bashrc = '\n'.join([f' {line}' for line in bashrc.split('\n') if line])
-        with open(self.TEMP_RC_FILE, 'w') as temp_rc_file:
-            temp_rc_file.write(bashrc)
+        #    4) normalize PATH style variables and set the prompt
+        with tracer.phase('render'):
+            bashrc = textwrap.dedent(
+                f'\n{save_env_code}\n{bashrc}\n{pre_code}\n{restore_env_code}\n{before_code}\n{code}\n'
+                f'{post_code}\n{after_code}'
+            )
+            bashrc = '\n'.join([f' {line}' for line in bashrc.split('\n') if line])
+        return bashrc
 
-    @cached_property
+    @property
+    def views(self):
+        """
+        The process-wide views of the store, checked against it on every access
+        """
+        return shared_views(self.store)
+
+    @property
     def blob(self):
         """
         Returns the currently saved blob.  Empty dict if nothing saved.
         """
-        blob = self._load_file(self.BLOB_FILE)
-        version = blob.get('version', 'unversioned')
-        if version != 'unversioned':
-            return blob
-
-        else:
-            profiles = {}
-            for profile_name, code in blob.items():
-                entry = {'code': code, 'code_type': 'raw'}
-                profiles[profile_name] = entry
+        return self.views.blob
 
-            new_blob = {'version': self.BLOB_VERSION, 'profiles': profiles}
-            return new_blob
-
-    @cached_property
+    @property
     def keys(self):
         """
         Returns list of profile names
         """
-        return sorted(self.blob.get('profiles', {}).keys())
+        return self.views.keys
 
-    @cached_property
+    @property
     def items(self):
         """
-        Returns list of profile names
+        Returns sorted list of (profile name, entry) tuples
         """
-        return sorted(self.blob.get('profiles', {}).items())
+        return self.views.items
+
+    @cached_property
+    def name_index(self):
+        return NameIndex(self.store)
+
+    @cached_property
+    def usage(self):
+        return UsageTable(self.BLOB_DIR)
+
+    def search(self, query='', limit=None):
+        """
+        Returns profile names matching query, with the best matches and the
+        most used profiles first
+        """
+        return rank(self.name_index, self.usage, query, limit=limit)
+
+    def profile_names(self):
+        """
+        Returns the list of profile names from the names file, recreating it
+        from the store if it is missing or a shared store changed since it was written
+        """
+        try:
+            with open(self.SHARED_NAMES_FILE) as buff:
+                shared_fingerprint = buff.readline().rstrip('\n')
+            with open(self.NAMES_FILE) as buff:
+                names = buff.read().split('\n')[:-1]
+        except FileNotFoundError:
+            return self.write_names_file()
+        if shared_fingerprint != self.store.shared_fingerprint():
+            return self.write_names_file()
+        return names
+
+    def write_names_file(self):
+        """
+        Writes the names file, and next to it the fingerprint of the shared
+        stores it was built from followed by their directories, so that
+        readers can tell when a shared store gained or lost a profile
+        """
+        # Fingerprint first, so a change made while reading can only make us rebuild again
+        shared_fingerprint = self.store.shared_fingerprint()
+        self.store.revalidate()
+        names = self.store.names()
+        write_text_atomically(''.join(f'{name}\n' for name in names), self.NAMES_FILE)
+        shared_dirs = [shared_dir for shared_dir in self.SHARED_DIRS if shared_dir != self.BLOB_DIR]
+        shared_lines = [shared_fingerprint] + shared_dirs
+        write_text_atomically(''.join(f'{line}\n' for line in shared_lines), self.SHARED_NAMES_FILE)
+        return names
 
     def get_key(self):
-        key = fuzzypicker.picker(self.keys)
+        # The picker is only needed interactively, so don't pay for importing it up front
+        from .picker import pick_profile
+        key = pick_profile(self.name_index, self.usage)
         if key is None:
             sys.exit(0)
         return key
 
-    def _reset(self):
+    def _reset(self, graph=None):
         """
-        Bust the cache for all cached properties
+        Bust the cached views of the store.  A resolver passed in is carried
+        over to the new views, for writers that have already invalidated the
+        profiles they changed.  Call this while holding the store's lock.
         """
-        for attr in ['keys', 'blob']:
-            try:
-                delattr(self, attr)
-            except AttributeError:
-                pass
+        _VIEWS.pop(self.store, None)
+        if graph is not None:
+            self.views.graph = graph
+
+        try:
+            delattr(self, 'name_index')
+        except AttributeError:
+            pass
+
+    def get_code(self, profile_name):
+        self.ensure_profile_names_exist([profile_name])
+        views = self.views
+        if profile_name in views.code:
+            return views.code[profile_name]
+
+        code = '\n'.join(self._get_code_list(profile_name))
 
-    def _load_file(self, file_name):
+        # Cached profiles can expire or be refreshed and provider values can change,
+        # so go back to them every time
+        if not self.leaves_of_type(profile_name, 'cached', 'providers'):
+            views.code[profile_name] = code
+        return code
+
+    def leaves_of_type(self, profile_name, *code_types):
         """
-        Load a json file with provided name.
-        Returns blank dict if file doesn't exist
+        Returns the names of the profiles of the given code types a profile runs
         """
+        return [
+            leaf_name for leaf_name in self.graph.resolve(profile_name)
+            if self.store.get(leaf_name)['code_type'] in code_types
+        ]
 
-        if os.path.isfile(file_name):
-            with open(file_name, 'r') as data_file:
-                blob = json.load(data_file)
-        else:
-            blob = {}
-        return blob
+    def cached_leaves(self, profile_name):
+        """
+        Returns the names of the cached profiles a profile runs
+        """
+        return self.leaves_of_type(profile_name, 'cached')
 
-    def _save_file(self, blob, file_name):
+    def leaf_exports(self, leaf_name):
         """
-        Saves a json blob to specified file_name
+        Returns the {name: value} dict a non-composed profile exports, or None
+        if it does anything that needs bash.  Raw profiles carry what they
+        export from when they were saved, and older ones are parsed on the fly.
         """
-        with open(file_name, 'w') as out_file:
-            json.dump(blob, out_file, indent=2)
+        from .environ import parse_static_exports
 
-    def _confirm_file_contents(self, blob, file_name):
+        entry = self.store.get(leaf_name)
+        if entry['code_type'] == 'snapshot':
+            return entry['code']
+        if entry['code_type'] == 'raw':
+            return entry['exports'] if 'exports' in entry else parse_static_exports(entry['code'])
+        return None
+
+    def static_delta(self, profile_name, env=None, normalize=True):
+        """
+        Returns the delta resolved_environment would, worked out without
+        running the profiles in bash, if every profile the named profile runs
+        only exports literal values and the user's bashrc could be worked out.
+        Otherwise returns None.
         """
-        Compares the contents of a blob with those
-        of a saved file
+        from .environ import apply_delta, diff_environments, normalize_path_list
+
+        exports = {}
+        for leaf_name in self.graph.resolve(profile_name):
+            leaf_exports = self.leaf_exports(leaf_name)
+            if leaf_exports is None:
+                return None
+            exports.update(leaf_exports)
+
+        env = self.env if env is None else env
+        bashrc_delta = self.bashrc_delta(env)
+        if bashrc_delta is None:
+            return None
+        resolved = apply_delta(env, bashrc_delta)
+        resolved.update(exports)
+        if normalize:
+            for name in self.NORMALIZED_VARS:
+                if name in resolved:
+                    resolved[name] = normalize_path_list(resolved[name], self.DROP_MISSING_DIRS)
+        return dict(diff_environments(env, resolved), functions=False)
+
+    def activation_delta(self, profile_name, env=None, normalize=True):
         """
-        saved_blob = self._load_file(file_name)
-        return blob == saved_blob
+        Returns the delta activating a profile makes, without running bash
+        when static_delta can work it out.  Raises ProbeError if bash is
+        needed and couldn't run the profile to the end.
+        """
+        delta = self.static_delta(profile_name, env=env, normalize=normalize)
+        if delta is None:
+            delta = self.resolved_environment(profile_name, self.get_code(profile_name), env=env, normalize=normalize)
+        return delta
 
-    def get_code(self, profile_name):
-        self.ensure_profile_names_exist([profile_name])
-        code_list = self._get_code_list(profile_name)
-        return '\n'.join(code_list)
+    def bashrc_delta(self, env):
+        """
+        Returns the variables the user's bashrc adds to a shell that inherited
+        env, which every activation sees before its profile code runs.  Bash
+        works it out once per bashrc and environment, and the result is cached.
+        Returns None if bash couldn't run the bashrc to the end, or if it
+        leaves behind functions or aliases, which only bash can bring along.
+        """
+        from .environ import ProbeError
 
-    def _get_code_list(self, profile_name, code_list=None):
-        if code_list is None:
-            code_list = []
+        if not os.path.isfile(self.BASH_RC_FILE) or not os.path.getsize(self.BASH_RC_FILE):
+            return {'set': {}, 'unset': []}
 
-        profiles = self.blob['profiles']
+        try:
+            delta = self.resolved_environment('', '', env=env, normalize=False)
+        except ProbeError:
+            return None
+        if delta['functions']:
+            return None
+
+        # Leave out the prompt, which activation scripts set for interactive shells
+        return {
+            'set': {key: val for key, val in delta['set'].items() if key not in {'__PSSWE__', 'PS1'}},
+            'unset': delta['unset'],
+        }
 
-        entry = profiles.get(profile_name)
-        if entry is None:
-            print(f"No profile named '{profile_name}'")
+    @property
+    def graph(self):
+        """
+        The composed-profile resolver.  It reads entries through the store, so
+        an unchanged resolver can be carried across writes that invalidate what they change.
+        """
+        return self.views.graph
+
+    def _get_code_list(self, profile_name):
+        try:
+            with tracer.phase('resolve', profile=profile_name):
+                leaf_names = self.graph.resolve(profile_name)
+        except KeyError as e:
+            print(f"No profile named '{e.args[0]}'")
             sys.exit(1)
 
-        if entry['code_type'] == 'raw':
-            code_list.append(f'# ------- switchenv starting code for profile: {profile_name}\n')
-            code_list.append(entry['code'])
+        # Fetch the values of every provider profile at once, before any code is rendered
+        provided = self.provided_values(leaf_names)
+
+        code_list = []
+        for leaf_name in leaf_names:
+            entry = self.store.get(leaf_name)
+            if entry['code_type'] == 'raw':
+                code_list.append(f'# ------- switchenv starting code for profile: {leaf_name}\n')
+                code_list.append(entry['code'])
+            elif entry['code_type'] == 'cached':
+                code_list.append(f'# ------- switchenv cached exports for profile: {leaf_name}\n')
+                code_list.append(self.cached_exports(leaf_name, entry))
+            elif entry['code_type'] == 'snapshot':
+                from .environ import delta_to_shell
+                code_list.append(f'# ------- switchenv snapshot for profile: {leaf_name}\n')
+                code_list.append(delta_to_shell({'set': entry['code'], 'unset': []}))
+            elif entry['code_type'] == 'providers':
+                from .environ import delta_to_shell
+                code_list.append(f'# ------- switchenv provider values for profile: {leaf_name}\n')
+                code_list.append(delta_to_shell({'set': provided[leaf_name], 'unset': []}))
+            else:
+                raise ValueError('Only code types allowed are raw, snapshot, cached, providers and composed')
 
-        elif entry['code_type'] == 'composed':
-            for sub_profile_name in entry['code']:
-                code_list = self._get_code_list(sub_profile_name, code_list=code_list)
+        return code_list
 
-        else:
-            raise ValueError('Only code types allowed are raw and composed')
+    def provided_values(self, leaf_names):
+        """
+        Fetch the values of the variables in every provider profile among
+        leaf_names concurrently, each provider under its profile's timeout.
+        Returns {profile_name: {variable: value}}, or raises ProviderValuesError
+        describing every value that couldn't be fetched.  Providers see the
+        environment sw runs in, not the changes made by the profiles before them.
+        """
+        from .providers import DEFAULT_TIMEOUT, ProviderError, resolve_providers
 
-        return code_list
+        references = {}
+        for leaf_name in leaf_names:
+            entry = self.store.get(leaf_name)
+            if entry['code_type'] == 'providers':
+                timeout = entry.get('timeout', DEFAULT_TIMEOUT)
+                for variable, reference in entry['code'].items():
+                    references[leaf_name, variable] = (reference, timeout)
 
-    def save(self, blob):
+        provided = {leaf_name: {} for leaf_name, _ in references}
+        if not references:
+            return provided
+
+        try:
+            with tracer.phase('providers', count=len(references)):
+                values = resolve_providers(references, self.env)
+        except ProviderError as e:
+            raise ProviderValuesError(f'Could not fetch provider values:\n{e}')
+
+        for (leaf_name, variable), value in values.items():
+            provided[leaf_name][variable] = value
+        return provided
+
+    def _exports_key(self, profile_name, entry):
+        return self.exports_cache.make_key(self.BLOB_VERSION, profile_name, entry['code'])
+
+    def cached_exports(self, profile_name, entry):
         """
-        Atomically save a blob to the canonical file_name
+        Returns shell code that exports what a cached profile's code sets.
+        The code itself runs at most once per ttl, and the exports it made
+        are kept in between in a cache file only the user can read.
         """
-        # Bust the cached property caches
-        self._reset()
+        key = self._exports_key(profile_name, entry)
+        with tracer.phase('exports_cache.lookup'):
+            cached = self.exports_cache.read(key)
+        if cached is not None:
+            cached = json.loads(cached)
+            if cached['expires'] > time.time():
+                return cached['code']
+
+        code = self.evaluate_exports(profile_name, entry['code'])
+        expires = time.time() + entry.get('ttl', self.DEFAULT_CACHED_TTL)
+        self.exports_cache.put(key, json.dumps({'expires': expires, 'code': code}))
+        return code
+
+    def evaluate_exports(self, profile_name, code):
+        """
+        Run a cached profile's code in bash and return shell code that
+        reproduces the changes it made to the environment.  Raises
+        CachedProfileError, caching nothing, if the code exits non-zero or stops early.
+        """
+        import subprocess
+        from .environ import PROBE_AFTER_CODE, PROBE_BEFORE_CODE, ProbeError, delta_to_shell, diff_environments
+        from .environ import parse_probe_output, probe_delimiter
+
+        env = self.env
+        delimiter = probe_delimiter()
+        script = '\n'.join([PROBE_BEFORE_CODE, code, PROBE_AFTER_CODE.format(delimiter=delimiter)])
+
+        # Leave stderr alone, so the user sees any prompts or errors from whatever fetches the values
+        with tracer.phase('evaluate', profile=profile_name):
+            result = subprocess.run(
+                ['bash', '-c', 'source /dev/stdin'],
+                input=script, stdout=subprocess.PIPE, env=env, encoding='utf-8', errors='surrogateescape',
+            )
+        if result.returncode != 0:
+            raise CachedProfileError(
+                f"Cached profile '{profile_name}' exited with code {result.returncode}.  Nothing was cached."
+            )
+        try:
+            _, resolved_env = parse_probe_output(result.stdout, delimiter)
+        except ProbeError:
+            raise CachedProfileError(f"Cached profile '{profile_name}' stopped early.  Nothing was cached.")
+        return delta_to_shell(diff_environments(env, resolved_env))
 
+    def refresh(self, profile_names):
+        """
+        Forget the cached exports of every cached profile the named profiles
+        run, so they are evaluated again on next use.  Returns the names of
+        the profiles that had exports cached.
+        """
+        self.ensure_profile_names_exist(profile_names)
+        refreshed = []
+        for profile_name in profile_names:
+            for leaf_name in self.cached_leaves(profile_name):
+                if self.exports_cache.discard(self._exports_key(leaf_name, self.store.get(leaf_name))):
+                    refreshed.append(leaf_name)
+        return refreshed
+
+    def save(self, blob):
+        """
+        Atomically replace everything in the store with the contents of blob.
+        A blob read from this store carries its generation, so saving it fails
+        with ConcurrentModificationError if another process saved in between.
+        """
         # Make sure the blob has the proper version
         blob['version'] = self.BLOB_VERSION
 
-        # Save the blob to a temp file
-        self._save_file(blob, self.TEMP_FILE)
+        # Any profile may have changed, so start every view from scratch
+        with self.store.locked():
+            self.store.replace(blob)
+            self._reset()
+        self.write_names_file()
 
-        # If temp file contents match blob, overwrite standard blob
-        # file with temp file
-        if self._confirm_file_contents(blob, self.TEMP_FILE):
-            shutil.move(self.TEMP_FILE, self.BLOB_FILE)
-        else:
-            warnings.warn('Warning.  File contents could not be verified.  Something went wrong with saving.')
+    def _write(self, updates=None, deletes=(), generation=None):
+        """
+        Save changes to individual profiles without rewriting the others
+        """
+        with self.store.locked():
+            # The names file only changes when names come or go, so updates to
+            # existing profiles don't have to rewrite it
+            names_change = bool(deletes) or any(self.store.get(name) is None for name in updates or {})
+
+            graph = self.graph
+            self.store.write(updates=updates, deletes=deletes, generation=generation)
+            for profile_name in list(updates or {}) + list(deletes):
+                graph.invalidate(profile_name)
+            self._reset(graph=graph)
+        if names_change:
+            self.write_names_file()
 
     def ensure_profile_names_exist(self, profile_names):
-        existing_profiles = set(self.blob['profiles'].keys())
-        profile_names = set(profile_names)
-        bad_profiles = profile_names - existing_profiles
+        self.store.revalidate()
+        bad_profiles = {name for name in profile_names if self.store.get(name) is None}
         if bad_profiles:
             print(f'\n\nThe following profiles do not exist: {sorted(bad_profiles)}\n')
             sys.exit(1)
 
     def update_composed(self, composed_profile_name, source_profile_names):
-        self.ensure_profile_names_exist(source_profile_names)
-        blob = self.blob
-        profiles = blob['profiles']
-        entry = profiles.get(composed_profile_name, {'code_type': 'composed'})
+        # Hold the lock from the first read to the write so concurrent writers can't interleave
+        with self.store.locked():
+            generation = self.store.generation()
+            self.ensure_profile_names_exist(source_profile_names)
+            entry = dict(self.store.get(composed_profile_name) or {'code_type': 'composed'})
+
+            # Can only update same kind of code_type
+            if entry['code_type'] != 'composed':
+                raise RuntimeError('Trying to update a profile with wrong code type')
 
-        # Can only update same kind of code_type
-        if entry['code_type'] != 'composed':
-            raise RuntimeError('Trying to update a profile with wrong code type')
+            # Refuse anything that would make the profile include itself
+            self.graph.check(composed_profile_name, source_profile_names)
 
-        entry['code'] = list(source_profile_names)
+            entry['code'] = list(source_profile_names)
 
-        # Save the entry to profiles
-        profiles[composed_profile_name] = entry
+            # Save the entry
+            self._write(updates={composed_profile_name: entry}, generation=generation)
 
-        # Save profiles to blob
-        blob['profiles'] = profiles
+    def update_cached(self, profile_name, code, ttl=None):
+        """
+        Add or update a cached profile.  Its code runs at most once every
+        ttl seconds, and activations in between reuse the exports it made.
+        """
+        # Hold the lock from the first read to the write so concurrent writers can't interleave
+        with self.store.locked():
+            generation = self.store.generation()
+            entry = dict(self.store.get(profile_name) or {'code_type': 'cached'})
 
-        # Save the blob
-        self.save(blob)
+            # Can only update same kind of code_type
+            if entry['code_type'] != 'cached':
+                raise RuntimeError('Trying to update a profile with wrong code type')
+
+            entry['code'] = code
+            entry['ttl'] = entry.get('ttl', self.DEFAULT_CACHED_TTL) if ttl is None else ttl
+            self._write(updates={profile_name: entry}, generation=generation)
+
+    def update_providers(self, profile_name, references, timeout=None):
+        """
+        Add or update a provider profile.  references maps variable names to
+        provider references like cmd:..., file:... or env:..., whose values
+        are fetched concurrently every time the profile is used.
+        """
+        from .providers import parse_reference
+
+        for reference in references.values():
+            parse_reference(reference)
+
+        # Hold the lock from the first read to the write so concurrent writers can't interleave
+        with self.store.locked():
+            generation = self.store.generation()
+            entry = dict(self.store.get(profile_name) or {'code_type': 'providers'})
+
+            # Can only update same kind of code_type
+            if entry['code_type'] != 'providers':
+                raise RuntimeError('Trying to update a profile with wrong code type')
+
+            entry['code'] = dict(references)
+            if timeout is not None:
+                entry['timeout'] = timeout
+            self._write(updates={profile_name: entry}, generation=generation)
+
+    def update_snapshot(self, profile_name, env):
+        """
+        Save the variables of env as a snapshot profile.  Stores keep each
+        distinct value once, however many snapshots share it.
+        """
+        from .environ import VARIABLE_NAME, diff_environments
+
+        values = {key: val for key, val in diff_environments({}, env)['set'].items() if VARIABLE_NAME.match(key)}
+
+        # Hold the lock from the first read to the write so concurrent writers can't interleave
+        with self.store.locked():
+            generation = self.store.generation()
+            entry = dict(self.store.get(profile_name) or {'code_type': 'snapshot'})
+
+            # Can only update same kind of code_type
+            if entry['code_type'] != 'snapshot':
+                raise RuntimeError('Trying to update a profile with wrong code type')
+
+            entry['code'] = values
+            self._write(updates={profile_name: entry}, generation=generation)
+
+    def migrate_snapshots(self, dry_run=False):
+        """
+        Turn raw profiles saved by older snapshots, which only export static
+        values including HOME and PATH, into snapshot profiles.  Returns the
+        migrated names with the bytes their entries took before and take
+        after, counting each distinct value once.
+        """
+        from .storage import pack_entry
+
+        with self.store.locked():
+            generation = self.store.generation()
+            updates = {}
+            for name in self.store.writable_names():
+                if self.store.get(name)['code_type'] != 'raw':
+                    continue
+                values = self.leaf_exports(name)
+                if values is not None and {'HOME', 'PATH'} <= set(values):
+                    updates[name] = {'code_type': 'snapshot', 'code': values}
+
+            values = {}
+            before = sum(len(json.dumps(self.store.get(name))) for name in updates)
+            after = sum(len(json.dumps(pack_entry(entry, values))) for entry in updates.values())
+            after += sum(len(digest) + len(json.dumps(value)) for digest, value in values.items())
+
+            if updates and not dry_run:
+                self._write(updates=updates, generation=generation)
+        return {'migrated': sorted(updates), 'bytes_before': before, 'bytes_after': after}
 
     def update_raw(self, profile_name, code):
         """
         Add or update blob contents
         """
-        # Get a reference to the blob
-        blob = self.blob
+        self.update_raw_many({profile_name: code})
+
+    def update_raw_many(self, codes, dry_run=False):
+        """
+        Add or update several raw profiles in a single save.  codes maps
+        profile names to code.  Returns a dict listing the profile names that
+        were 'added', 'updated' and 'unchanged'.
+        """
+        from .environ import parse_static_exports
+
+        report = {'added': [], 'updated': [], 'unchanged': []}
+        updates = {}
 
-        # All profile information held in the 'profiles' blob key
-        profiles = blob.get('profiles', {})
+        # Hold the lock from the first read to the write so concurrent writers can't interleave
+        with self.store.locked():
+            generation = self.store.generation()
 
-        # Get the current entry or dict initialized with default code type
-        entry = profiles.get(profile_name, {'code_type': 'raw'})
+            for profile_name, code in codes.items():
+                # Get the current entry or dict initialized with default code type
+                existing = self.store.get(profile_name)
+                entry = dict(existing or {'code_type': 'raw'})
 
-        # Can only update same kind of code_type
-        if entry['code_type'] != 'raw':
-            raise RuntimeError('Trying to update a profile with wrong code type')
+                # Can only update same kind of code_type
+                if entry['code_type'] != 'raw':
+                    raise RuntimeError(f'Trying to update profile {profile_name!r} with wrong code type')
 
-        # Update the entry's code
-        entry['code'] = code
+                if existing is None:
+                    report['added'].append(profile_name)
+                elif existing.get('code') == code:
+                    report['unchanged'].append(profile_name)
+                    continue
+                else:
+                    report['updated'].append(profile_name)
 
-        # Save the entry to profiles
-        profiles[profile_name] = entry
+                # Update the entry's code, along with what it exports if that is known without bash
+                entry['code'] = code
+                entry['exports'] = parse_static_exports(code)
+                updates[profile_name] = entry
 
-        # Save profiles to blob
-        blob['profiles'] = profiles
+            # Save all the entries at once
+            if updates and not dry_run:
+                self._write(updates=updates, generation=generation)
 
-        # Save the blob
-        self.save(blob)
+        return report
+
+    def import_profiles(self, profiles, replace=False, overwrite=False):
+        """
+        Import (name, entry) pairs from any iterable, such as an export being
+        read, in a single commit and without holding them all in memory.
+        Profiles that already exist with different contents are conflicts,
+        which fail the import with ImportConflictError unless overwrite is set.
+        What raw profiles export is worked out again from their code.
+        With replace, imported profiles always win and every profile that
+        wasn't imported is deleted.  Composed profiles that would form a cycle
+        fail the import with ProfileCycleError.  Nothing is saved if anything fails.
+        Returns a dict listing the profile names that were 'added', 'updated',
+        'unchanged' and 'deleted'.
+        """
+        from .transfer import ImportConflictError, import_action, with_derived
+
+        report = {'added': [], 'updated': [], 'unchanged': [], 'deleted': []}
+        seen = set()
+
+        # The composed profiles being imported, which are all that can form a new cycle
+        composed = {}
+
+        def updates():
+            conflicts = []
+            for profile_name, entry in profiles:
+                seen.add(profile_name)
+                if entry['code_type'] == 'composed':
+                    composed[profile_name] = entry
+                action = import_action(self.store.get(profile_name), entry, overwrite=replace or overwrite)
+                if action is None:
+                    conflicts.append(profile_name)
+                    continue
+                report[action].append(profile_name)
+                if action != 'unchanged':
+                    yield profile_name, with_derived(entry)
+
+            # Raising while the store consumes the updates saves nothing
+            if conflicts:
+                raise ImportConflictError(conflicts)
+            self._check_import_cycles(composed, seen, replace)
+
+        def deletes():
+            # The store only gets here once it has consumed every update, so seen is complete
+            for profile_name in existing_names:
+                if profile_name not in seen:
+                    report['deleted'].append(profile_name)
+                    yield profile_name
+
+        # Hold the lock from the first read to the write so concurrent writers can't interleave
+        with self.store.locked():
+            generation = self.store.generation()
+            existing_names = self.store.writable_names() if replace else []
+            self.store.write(updates=updates(), deletes=deletes(), generation=generation)
+            self._reset()
+        self.write_names_file()
+        return report
+
+    def _check_import_cycles(self, composed, imported_names, replace):
+        """
+        Raise ProfileCycleError if the imported composed profiles would form a cycle
+        with each other or with the saved profiles the import keeps
+        """
+        def lookup(profile_name):
+            if profile_name in composed:
+                return composed[profile_name]
+            if profile_name in imported_names or replace:
+                # Imported profiles that aren't composed can't be part of a cycle,
+                # and replacing deletes everything that wasn't imported
+                return None
+            return self.store.get(profile_name)
+
+        graph = ProfileGraph(lookup)
+        for profile_name, entry in composed.items():
+            graph.check(profile_name, entry['code'])
 
     def delete(self, keys):
         """
@@ -319,10 +1028,11 @@ class SwitchEnv:
             print('Nothing done')
             return
 
-        blob = self.blob
-        for key in keys:
-            blob['profiles'].pop(key, None)
-        self.save(blob)
+        try:
+            self._write(deletes=keys)
+        except ReadOnlyStoreError as e:
+            print(f'\n{e}\n')
+            sys.exit(1)
 
     def show(self, key_list=None, template=None):
         """
@@ -347,20 +1057,47 @@ class SwitchEnv:
         print(f"#{'=' * 40}")
         print(f'# {key}')
         print(f"#{'=' * 40}")
-        print(self.get_code(key))
+        code = self.get_code(key)
+        print(code)
+        if self.static_delta(key) is not None:
+            print('\n# ------- switchenv applies these exports without running bash')
+        self._show_normalization(key)
+
+    def _show_normalization(self, key):
+        """
+        Print how much activating the profile shortens each PATH style variable
+        """
+        from .environ import ProbeError, apply_delta, path_reductions
+
+        if not self.NORMALIZED_VARS:
+            return
+        try:
+            delta = self.activation_delta(key, normalize=False)
+        except ProbeError:
+            return
+        env = apply_delta(self.env, delta)
+        reductions = path_reductions(env, self.NORMALIZED_VARS, self.DROP_MISSING_DIRS)
+        if reductions:
+            print('\n# ------- switchenv normalizes on activation')
+        for name, (before, after) in reductions.items():
+            print(f'# {name}: {before} entries -> {after} ({before - after} removed)')
 
     @property
     def env(self):
-        env = dict(os.environ)
+        return current_env()
+
 
-        # OSX does a weird thing by setting this variable
-        # It ends up screwing up execvpe, so zap it out of
-        # the environment
-        # See: https://stackoverflow.com/questions/26323852/whats-the-meaning-of-pyvenv-launcher-environment-variable
-        env.pop('__PYVENV_LAUNCHER__', None)
-        env.pop('_', None)
+def current_env():
+    env = dict(os.environ)
 
-        return env
+    # OSX does a weird thing by setting this variable
+    # It ends up screwing up execvpe, so zap it out of
+    # the environment
+    # See: https://stackoverflow.com/questions/26323852/whats-the-meaning-of-pyvenv-launcher-environment-variable
+    env.pop('__PYVENV_LAUNCHER__', None)
+    env.pop('_', None)
+
+    return env
 
 
 def ensure_profiles_exist(swenv):
@@ -377,58 +1114,26 @@ def run_switch_env(profile: Optional[str] = None):
         profile = swenv.get_key()
 
     code = swenv.get_code(profile)
-    swenv.make_temp_rc_file(profile, code)
-
-    commands = ['bash', '--init-file', swenv.TEMP_RC_FILE]
-
-    os.execvpe('bash', commands, swenv.env)
-
-
-@click.group()
-def cli():
-    pass
-
-@cli.command(help='Show usage examples')
-def examples():
-    text = textwrap.dedent("""
+    swenv.usage.record(profile)
+    exec_shell(swenv.make_temp_rc_file(profile, code), swenv.env)
 
-    # Snapshot the current environment as a profile
-    switchenv snapshot -p my_snapshot_profile_name
-
-    # Add an existing shell script as a profile
-    switchenv add -p my_profile_name -f path/to/my_scrpt.sh
-
-    # Create a composite profile
-    switchenv compose -c my_composite_profile_name -p my_snapshot_profile_name -p my_profile_name
-
-    # Show all profile names
-    switchenv list
-
-    # Show contents of a specific profile
-    switchenv show                                # allows for fuzzysearch of profile name
-    switchenv show -p profile1 [-p profile2... ]  # show a specific profile(s)
-
-    # Drop into a subshell with a specific profile
-    switchenv  # Will present you with a fuzzy searchable list of profiles
-
-    # Drop into a named profile (useful for invoking in scripts)
-    switchenv source -p profile_name
-
-    # Delete profiles
-    switchenv delete -p profile_name_1 [-p profile_name_2, ...]
 
+def exec_shell(rc_file, env):
+    """
+    Replace this process with an interactive bash that starts from rc_file
+    """
+    commands = ['bash', '--init-file', rc_file]
 
-    """)
-    print(text)
+    tracer.flush()
+    os.execvpe('bash', commands, env)
 
 
-@cli.command(name='list', help='List all profile names')
-def list_profiles():
+def print_profiles():
     swenv = SwitchEnv()
     ensure_profiles_exist(swenv)
     for key, profile in swenv.items:
         code_type = profile['code_type']
-        if code_type == 'raw':
+        if code_type in {'raw', 'snapshot', 'cached', 'providers'}:
             print(key)
         elif code_type == 'composed':
             print(f'{key} -> {profile["code"]}')
@@ -436,194 +1141,285 @@ def list_profiles():
             raise ValueError('unkown code_type')
 
 
-@cli.command(help='Show contents of a single profile')
-@click.option('-p', '--profiles', multiple=True)
-def show(profiles):
+def run_exec(command: str, profile: Optional[str] = None, direct: bool = False):
+    # Make the temp rc file based on the specifed profile
     swenv = SwitchEnv()
     ensure_profiles_exist(swenv)
-    if not profiles:
-        profiles = [swenv.get_key()]
-    swenv = SwitchEnv()
-    swenv.show(key_list=profiles)
+    if profile is None:
+        profile = swenv.get_key()
+    code = swenv.get_code(profile)
+    swenv.usage.record(profile)
 
-@cli.command(help='Drop into subshell with named profile (useful in scripts)')
-@click.option('-p', '--profile', required=True)
-def source(profile):
-    run_switch_env(profile)
+    # Skip bash and the bashrc altogether when the profile's effect on the
+    # environment is known.  Profiles defining functions or aliases need bash,
+    # and so does everything when bash couldn't tell what the profile does.
+    if direct:
+        from .environ import ProbeError
+        try:
+            delta = swenv.activation_delta(profile)
+        except ProbeError:
+            delta = None
+        if delta is not None and not delta['functions']:
+            exec_with_delta(command, delta, swenv.env)
 
+    exec_with_rc(command, swenv.make_temp_rc_file(profile, code), swenv.env)
 
 
-@cli.command(help='Delete a profile')
-@click.option('-p', '--profiles', multiple=True)
-def delete(profiles):
-    swenv = SwitchEnv()
-    ensure_profiles_exist(swenv)
-    if not profiles:
-        profiles = [swenv.get_key()]
-
-    initial_keys = set(swenv.keys)
-    swenv.delete(keys=profiles)
-    final_keys = set(swenv.keys)
-    deleted_keys = initial_keys - final_keys
-    if deleted_keys:
-        print(f'Deleted profiles: {sorted(deleted_keys)}')
-
-
-@cli.command(help='Create a profile from file')
-@click.option('-p', '--profile_name', required=True)
-@click.option('-f', '--file_name', required=True)
-def add(profile_name, file_name):
-    if not os.path.isfile(file_name):
-        print(f"\nThe file '{file_name}' does not exist\n")
-        sys.exit(1)
+def exec_with_delta(command, delta, env):
+    """
+    Replace this process with command, run in env with a delta from resolved_environment applied
+    """
+    from .environ import apply_delta, direct_argv
+    argv = direct_argv(command)
+    tracer.flush()
+    os.execvpe(argv[0], argv, apply_delta(env, delta))
 
-    with open(file_name, 'r') as code_file:
-        code = code_file.read()
 
-    swenv = SwitchEnv()
-    swenv.update_raw(profile_name, code)
+def exec_with_rc(command, rc_file, env):
+    """
+    Replace this process with a bash that sources rc_file and then runs command
+    """
+    # You want to the executed command to replace the running temp script process
+    command = f'exec {command}'
 
+    # Prepend sourcing the appropriate rc file to the begnning of the script.  When
+    # tracing, bash reports how long it took to start up and source the rc file.
+    commands = [f'source {shlex.quote(rc_file)}', tracer.shell_phase('bash.activate', time.time()), command]
 
-@cli.command(help='Compose a new profile from existing profiles')
-@click.option('-c', '--composed_profile_name', required=True, help='The name of the posed profile')
-@click.option('-p', '--profiles', multiple=True, help='The name of the source profile')
-def compose(composed_profile_name, profiles):
-    if not profiles:
-        print('You must supply at least one source profile')
+    # Replace this python process with a modified bash shell running the script.  The rc
+    # file is either an immutable cache entry or private to this process, and the script
+    # is passed as an argument, so concurrent execs never share a file that can change.
+    tracer.flush()
+    os.execvpe('bash', ['bash', '-c', '\n'.join(commands)], env)
 
-    swenv = SwitchEnv()
-    swenv.update_composed(composed_profile_name, profiles)
 
+def private_script_path(text):
+    """
+    Returns a path that a child bash can read text from, which no other
+    process can see or overwrite.  On Linux the text lives in an anonymous
+    memory file that is inherited across exec.  Elsewhere it goes to a
+    uniquely named temp file that removes itself as soon as bash runs it.
+    """
+    data = text.encode('utf-8', 'surrogateescape')
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('switchenvrc')
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.set_inheritable(fd, True)
+        return f'/dev/fd/{fd}'
+
+    import tempfile
+    fd, path = tempfile.mkstemp(prefix='switchenvrc-', suffix='.sh')
+    with os.fdopen(fd, 'wb') as buff:
+        buff.write(f"rm -f '{path}'\n".encode() + data)
+    return path
+
+
+def print_switch(profile: Optional[str] = None, reset: bool = False):
+    """
+    Print the export and unset statements that switch the calling shell to
+    profile in place, undoing whatever the last switch changed.  With reset,
+    just undo the last switch.  Meant to be run as eval "$(sw env -p name)".
+    """
+    from .environ import ProbeError, switch_script, unexpected_unsets, unswitched_environment
 
-@cli.command(help='Snapshot current env into a profile')
-@click.option('-p', '--profile_name', required=True)
-def snapshot(profile_name):
     swenv = SwitchEnv()
+    env = swenv.env
+    base_env = unswitched_environment(env)
+    delta = None
+    if not reset:
+        # Whatever goes to stdout gets evaluated, so complain on stderr
+        if swenv.store.get(profile) is None:
+            print(f"switchenv: no profile named '{profile}'", file=sys.stderr)
+            sys.exit(1)
+        code = swenv.get_code(profile)
+        swenv.usage.record(profile)
+        try:
+            delta = swenv.activation_delta(profile, env=base_env)
+        except ProbeError as e:
+            print(f"switchenv: could not work out what profile '{profile}' changes ({e})", file=sys.stderr)
+            sys.exit(1)
 
-    code_lines = []
-    for key, val in swenv.env.items():
-        code_lines.append(f'export {key}="{val}"')
+        # Never wipe out the calling shell because something went wrong working out the delta
+        dropped = unexpected_unsets(delta, code)
+        if dropped:
+            print(
+                f"switchenv: not switching to profile '{profile}', which would unset {' and '.join(dropped)}",
+                file=sys.stderr
+            )
+            sys.exit(1)
+        warn_about_functions(profile, delta)
 
-    code = '\n'.join(code_lines)
-    swenv.update_raw(profile_name, code)
+    sys.stdout.write(switch_script(env, base_env, profile, delta))
 
 
-@cli.command(help='View or set where the config directory lives')
-@click.option('-s', '--set-location', help='Set the location to the specified directory')
-@click.option('-r', '--reset-default-location', is_flag=True, help='Set config directory to default location')
-def config(set_location, reset_default_location):
-    # Instantiate the class that knows how to handle config blob
-    handler = BlobDirHandler()
+def warn_about_functions(profile, delta):
+    if delta['functions']:
+        print(
+            f"switchenv: profile '{profile}' defines functions or aliases, which only `sw source` can bring along",
+            file=sys.stderr
+        )
 
-    # If requested, change to the default location and quit
-    if reset_default_location:
-        handler.change_blob_location(handler.DEFAULT_BLOB_DIR)
-        exit(0)
 
+def print_names():
+    # No existence check or header, so that shell completion gets just the names
+    sys.stdout.write(''.join(f'{name}\n' for name in SwitchEnv().profile_names()))
 
-    # If no options supplied, just print the current location of the config dir
-    config_dir = handler.location_blob['location']
-    if set_location is None:
-        msg = (
-            f'\n\nCurrent config directory:\n{config_dir}\n\n'
-            'Run with the -s or -r options to change it.\n\n'
-        )
-        print(msg)
-        exit(0)
-    # Otherwise set the location
-    else:
-        # Get the full absolute path
-        full_location = os.path.realpath(os.path.expanduser(set_location))
-
-        # Prompt to create non-existing directory
-        if not os.path.isdir(full_location):
-            msg = (
-                f'\n\nDirectory does not exist: {set_location}\n\n'
-                'Create it?  y/n:  '
-            )
-            answer = input(msg)
-            if answer and answer.lower()[0] == 'y':
-                os.makedirs(full_location)
+
+def print_matches(query, limit=20):
+    swenv = SwitchEnv()
+    for name in swenv.search(query, limit=limit or None):
+        print(name)
+
+
+def _split_fast_args(args, flags):
+    """
+    Split the arguments of a fast command into (profile, set flags,
+    positionals), or None if any of them needs click.  flags are the options
+    besides -p/--profile the command takes.
+    """
+    profile = None
+    seen = set()
+    positionals = []
+    while args:
+        arg, args = args[0], args[1:]
+        if arg in flags:
+            seen.add(arg)
+        elif arg in {'-p', '--profile'} or arg.startswith('--profile='):
+            if profile is not None:
+                return None
+            if arg.startswith('--profile='):
+                profile = arg[len('--profile='):]
+            elif not args:
+                return None
             else:
-                print('\n\nNothing done.')
-                exit(0)
+                profile, args = args[0], args[1:]
+        elif arg.startswith('-'):
+            return None
+        else:
+            positionals.append(arg)
+    return profile, seen, positionals
 
-        handler.change_blob_location(full_location)
 
+def _listing_kwargs(profile, flags, positionals):
+    if profile is None and not positionals:
+        return {}
 
-@cli.command(help='Export config to stdout (see also import-config)')
-def export_config():
-    swenv = SwitchEnv()
-    print(json.dumps(swenv.blob, indent=2))
 
+def _source_kwargs(profile, flags, positionals):
+    if profile is not None and not positionals:
+        return {'profile': profile}
 
-@cli.command(help='Import config from file (see also export-config)')
-@click.option('-f', '--file-name', required=True, help='The name of the config file to import')
-def import_config(file_name):
-    file_name = os.path.realpath(os.path.expanduser(file_name))
-    if not os.path.isfile(file_name):
-        print(f'Config file does not exist: {file_name}', file=sys.stderr)
-        exit(1)
 
-    with open(file_name) as buff:
-        blob = json.load(buff)
+def _env_kwargs(profile, flags, positionals):
+    reset = '--reset' in flags
+    if (profile is None) == reset and not positionals:
+        return {'profile': profile, 'reset': reset}
 
-    swenv = SwitchEnv()
-    with open(swenv.BLOB_FILE, 'w') as buff:
-        json.dump(blob, buff, indent=2)
 
-    print('\n\n Success!\n')
+def _find_kwargs(profile, flags, positionals):
+    if profile is None and len(positionals) == 1:
+        return {'query': positionals[0]}
 
-@cli.command(help='Execute a QUOTED command in the specified env')
-@click.argument('command', nargs=1)
-@click.option('-p', '--profile')
-def exec(command, profile):
-    # Make the temp rc file based on the specifed profile
-    swenv = SwitchEnv()
-    ensure_profiles_exist(swenv)
-    if profile is None:
-        profile = swenv.get_key()
-    code = swenv.get_code(profile)
-    swenv.make_temp_rc_file(profile, code)
 
-    # You want to the executed command to replace the running temp script process
-    command = f'exec {command}'
+def _exec_kwargs(profile, flags, positionals):
+    if len(positionals) == 1:
+        return {'command': positionals[0], 'profile': profile, 'direct': '--direct' in flags}
 
-    # Prepend sourcing the appropriate rc file to the begnning of the script
-    commands = [f'source {swenv.TEMP_RC_FILE}', command]
 
-    # Replace this python process with a modified bash shell running the temp script
-    with temp_script(commands) as script_file:
-        os.execvpe('bash', ['bash', script_file], swenv.env)
+# Maps each fast command to the options it takes besides -p/--profile, and
+# the function turning its parsed arguments into kwargs, or None if they need click
+FAST_ARGS = {
+    'list': (set(), _listing_kwargs),
+    'names': (set(), _listing_kwargs),
+    'source': (set(), _source_kwargs),
+    'exec': ({'--direct'}, _exec_kwargs),
+    'find': (set(), _find_kwargs),
+    'env': ({'--reset'}, _env_kwargs),
+}
 
 
-@contextlib.contextmanager
-def temp_script(commands):
+def parse_fast_args(args):
     """
-    Run commands in a temporary, self-deleting bash script.
-    Each element in the commands list is treated as a different line in a bash script
+    Parse the scripted invocations that can run without click.  Returns a
+    (command_name, kwargs) tuple, or None if the arguments need the full
+    click cli (help text, unknown options, interactive commands, ...).
     """
-    # The file name of the tmp script
-    file_name = os.path.join('/tmp/', f'__working_script_util_file__.sh')
+    if not args or args[0] not in FAST_ARGS:
+        return None
+    command_name = args[0]
+    flags, to_kwargs = FAST_ARGS[command_name]
 
-    # The first command will delete the bash script, but the rest will still run
-    commands = [f'rm {file_name}'] + commands
+    parsed = _split_fast_args(args[1:], flags)
+    kwargs = None if parsed is None else to_kwargs(*parsed)
+    return None if kwargs is None else (command_name, kwargs)
 
-    # Write commands to the temp bash script
-    with open(file_name, 'w') as buff:
-        buff.write('\n'.join(commands) + '\n')
 
-    # Yield file_name back to calling code for it to run whatever it wants
-    yield file_name
+def __getattr__(name):
+    # The click cli used to live in this module.  Keep it reachable without
+    # importing click for everyone who only needs the fast path.
+    if name == 'cli':
+        from .cli import cli
+        return cli
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
+# The fast commands that `sw serve` can answer, and the socket it listens on in the config directory
+DAEMON_COMMANDS = {'list', 'source', 'exec', 'env'}
+DAEMON_SOCKET = 'serve.sock'
+
+FAST_COMMANDS = {
+    'list': print_profiles,
+    'names': print_names,
+    'source': run_switch_env,
+    'exec': run_exec,
+    'find': print_matches,
+    'env': print_switch,
+}
 
 
 def main():
-    if len(sys.argv) > 1:
-        cli()
-    else:
+    # sw --trace <command> traces to stderr unless SWITCHENV_TRACE names a file
+    if sys.argv[1:2] == ['--trace']:
+        del sys.argv[1]
+        tracer.enable(os.environ.get('SWITCHENV_TRACE') or 'stderr')
+
+    if tracer.enabled:
+        import atexit
+        from .trace import IMPORT_STARTED
+        tracer.record('imports', time.perf_counter() - IMPORT_STARTED)
+        atexit.register(tracer.flush)
+
+    # Whatever goes to stdout may be evaluated by the calling shell, so failures only go to stderr
+    try:
+        run_command()
+    except ActivationError as e:
+        print(f'\nswitchenv: {e}\n', file=sys.stderr)
+        sys.exit(1)
+
+
+def run_command():
+    if len(sys.argv) <= 1:
         run_switch_env()
+        return
+
+    # Scripted calls are handled here so they never import click
+    parsed = parse_fast_args(sys.argv[1:])
+    if parsed is not None:
+        command_name, kwargs = parsed
+        if command_name in DAEMON_COMMANDS and not os.environ.get('SWITCHENV_NO_DAEMON'):
+            # Let a running `sw serve` do the work if there is one
+            socket_path = os.path.join(SwitchEnv.BLOB_DIR, DAEMON_SOCKET)
+            if os.path.exists(socket_path):
+                from .daemon import run_with_daemon
+                if run_with_daemon(socket_path, command_name, kwargs):
+                    return
+        FAST_COMMANDS[command_name](**kwargs)
+        return
+
+    from .cli import cli
+    cli()
 
 
 if __name__ == '__main__':
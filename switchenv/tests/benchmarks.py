@@ -0,0 +1,271 @@
+"""
+Benchmarks for the main switchenv code paths against synthetic profile stores.
+
+    python -m switchenv.tests.benchmarks --sizes 10,1000,10000 --output results.json
+    python -m switchenv.tests.benchmarks --output new.json --compare results.json --threshold 0.25
+    python -m switchenv.tests.benchmarks --env-sizes 100,1000 --sizes ''
+
+Results are written as json so runs from different versions can be compared.
+With --compare, the run fails if any benchmark got slower than the baseline
+by more than the threshold fraction.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from switchenv.storage import _STORES
+from switchenv.switchenv import _VIEWS, SwitchEnv, print_profiles
+from switchenv.version import __version__
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# Runs the sw entry point against the config directory passed as the first argument
+SW_SCRIPT = (
+    'import sys; from switchenv.switchenv import SwitchEnv, main; '
+    'SwitchEnv.BLOB_DIR = sys.argv.pop(1); main()'
+)
+
+
+def generate_blob(profiles, depth=3, width=4, snapshot_every=50, snapshot_exports=300):
+    """
+    Build a blob with the requested number of profiles.  Most are small raw
+    profiles, every snapshot_every-th one is a snapshot-sized profile with
+    snapshot_exports exports, and a tenth of the profiles are composed into
+    trees depth levels deep where each composed profile includes width others.
+    """
+    entries = {}
+    composed_count = max(1, profiles // 10) if depth else 0
+    raw_count = max(1, profiles - composed_count)
+
+    for index in range(raw_count):
+        name = f'raw_{index:06d}'
+        if snapshot_every and index % snapshot_every == 0:
+            lines = [f'export SNAPSHOT_VAR_{var}="/opt/tool_{var}/bin:/usr/local/share/{index}"'
+                     for var in range(snapshot_exports)]
+        else:
+            lines = [f'export PGHOST=host{index}.example.com', f'export PGPORT={5000 + index % 1000}']
+        entries[name] = {'code_type': 'raw', 'code': '\n'.join(lines)}
+
+    # Level 1 composes raw profiles, and each higher level composes the level below it
+    previous_level = sorted(entries)
+    for level in range(1, depth + 1):
+        per_level = composed_count // depth + (1 if level <= composed_count % depth else 0)
+        current_level = []
+        for index in range(per_level):
+            name = f'composed_{level}_{index:06d}'
+            children = [previous_level[(index * width + offset) % len(previous_level)] for offset in range(width)]
+            entries[name] = {'code_type': 'composed', 'code': children}
+            current_level.append(name)
+        previous_level = current_level or previous_level
+
+    return {'version': '1.0', 'profiles': entries}
+
+
+def generate_environment(size, value_bytes=200):
+    """
+    Build an environment like a CI or login shell's, with size extra
+    variables whose values are value_bytes long and full of characters
+    that need quoting
+    """
+    env = dict(os.environ)
+    for index in range(size):
+        value = f'"quoted" $dollar `tick` \'single\' {index} '
+        env[f'BENCH_VAR_{index:05d}'] = (value * (value_bytes // len(value) + 1))[:value_bytes]
+    return env
+
+
+def deepest_composed(blob):
+    composed = sorted(name for name, entry in blob['profiles'].items() if entry['code_type'] == 'composed')
+    return composed[-1] if composed else sorted(blob['profiles'])[0]
+
+
+def time_call(func, repeat, setup=None):
+    """
+    Returns the median wall-clock seconds of calling func repeat times.
+    setup, if given, runs untimed before each call.
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def forget_reads():
+    """
+    Drop every store and parsed view this process keeps, so the next call
+    reads and parses profiles the way a fresh sw process does
+    """
+    _VIEWS.clear()
+    _STORES.clear()
+
+
+@contextlib.contextmanager
+def scratch_home(store):
+    home = tempfile.mkdtemp(prefix='switchenv-bench-')
+    blob_dir = os.path.join(home, '.switchenv')
+    env = {'HOME': home, 'SWITCHENV_STORE': store}
+    try:
+        with mock.patch.object(SwitchEnv, 'BLOB_DIR', blob_dir), mock.patch.dict(os.environ, env):
+            yield home
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+def run_suite(size, repeat=5, exec_repeat=5, depth=3, width=4, store='json'):
+    """
+    Time every benchmark against a store of the given size.  Returns a dict
+    mapping benchmark name to median seconds.
+    """
+    results = {}
+    with scratch_home(store) as home:
+        blob = generate_blob(size, depth=depth, width=width)
+        target = deepest_composed(blob)
+        SwitchEnv().save(json.loads(json.dumps(blob)))
+
+        # Cold calls start from nothing, like a new sw process.  Warm calls reuse
+        # what this process has already read while the store is unchanged.
+        results['blob_load'] = time_call(lambda: SwitchEnv().blob, repeat, setup=forget_reads)
+        results['keys'] = time_call(lambda: SwitchEnv().keys, repeat, setup=forget_reads)
+        results['items'] = time_call(lambda: SwitchEnv().items, repeat, setup=forget_reads)
+        results['resolve'] = time_call(lambda: SwitchEnv()._get_code_list(target), repeat, setup=forget_reads)
+        results['blob_load_warm'] = time_call(lambda: SwitchEnv().blob, repeat)
+        results['keys_warm'] = time_call(lambda: SwitchEnv().keys, repeat)
+        results['items_warm'] = time_call(lambda: SwitchEnv().items, repeat)
+        results['resolve_warm'] = time_call(lambda: SwitchEnv()._get_code_list(target), repeat)
+        results['save'] = time_call(lambda: SwitchEnv().save(SwitchEnv().blob), repeat)
+        results['update_raw'] = time_call(lambda: SwitchEnv().update_raw('raw_000001', 'export A=1'), repeat)
+
+        swenv = SwitchEnv()
+        code = swenv.get_code(target)
+
+        def render_cold():
+            swenv.rc_cache.clear()
+            swenv.make_temp_rc_file(target, code)
+
+        results['make_temp_rc_file_cold'] = time_call(render_cold, repeat)
+        results['make_temp_rc_file_warm'] = time_call(lambda: swenv.make_temp_rc_file(target, code), repeat)
+
+        def list_profiles():
+            with contextlib.redirect_stdout(io.StringIO()):
+                print_profiles()
+
+        results['list'] = time_call(list_profiles, repeat)
+
+        env = dict(os.environ, HOME=home, PYTHONPATH=REPO_DIR)
+        command = [sys.executable, '-c', SW_SCRIPT, SwitchEnv.BLOB_DIR, 'exec', '-p', target, 'true']
+        subprocess.run(command, env=env, check=True)
+        results['exec'] = time_call(lambda: subprocess.run(command, env=env, check=True), exec_repeat)
+
+    return results
+
+
+def run_env_suite(env_size, repeat=5, value_bytes=200):
+    """
+    Measure the rc file and the activation it drives for an environment with
+    env_size extra variables, with a bashrc that resets the path.  Returns a
+    dict with the rc file's size in bytes and median seconds for the rest.
+    """
+    results = {}
+    with scratch_home('json') as home:
+        with open(os.path.join(home, '.bashrc'), 'w') as buff:
+            buff.write('export PATH=/usr/bin:/bin\n')
+
+        env = dict(generate_environment(env_size, value_bytes=value_bytes), HOME=home)
+        swenv = SwitchEnv()
+        code = 'export PGHOST=bench.example.com'
+
+        results['rc_file_bytes'] = len(swenv.render_rc('bench', code, env=env))
+        results['render'] = time_call(lambda: swenv.render_rc('bench', code, env=env), repeat)
+
+        rc_file = swenv.make_temp_rc_file('bench', code, env=env)
+        command = ['bash', '-c', f'source {shlex.quote(rc_file)}\ntrue']
+        results['activate'] = time_call(lambda: subprocess.run(command, env=env, check=True), repeat)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns a list of (size, benchmark, baseline_value, value) for every
+    benchmark that is slower (or bigger) than its baseline by more than threshold
+    """
+    regressions = []
+    for section, label in [('results', ''), ('environment', 'env ')]:
+        for size, benchmarks in results.get(section, {}).items():
+            for name, seconds in benchmarks.items():
+                old_seconds = baseline.get(section, {}).get(size, {}).get(name)
+                if old_seconds is not None and seconds > old_seconds * (1 + threshold):
+                    regressions.append((f'{label}{size}', name, old_seconds, seconds))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark switchenv against synthetic profile stores')
+    parser.add_argument('--sizes', default='10,1000,10000', help='Comma separated store sizes (profiles)')
+    parser.add_argument(
+        '--env-sizes', default='100,1000', help='Comma separated environment sizes (extra variables) for activation'
+    )
+    parser.add_argument('--depth', type=int, default=3, help='Depth of composed profile trees')
+    parser.add_argument('--width', type=int, default=4, help='Sub-profiles per composed profile')
+    parser.add_argument('--repeat', type=int, default=5, help='Repetitions per in-process benchmark')
+    parser.add_argument('--exec-repeat', type=int, default=5, help='Repetitions of the end-to-end exec benchmark')
+    parser.add_argument('--store', default='json', choices=['json', 'sqlite'], help='Storage backend to benchmark')
+    parser.add_argument('--output', help='Write results to this json file (default stdout)')
+    parser.add_argument('--compare', help='Baseline results json to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed slowdown as a fraction of baseline')
+    args = parser.parse_args(argv)
+
+    results = {
+        'switchenv_version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'store': args.store,
+        'results': {},
+        'environment': {},
+    }
+    for size in [int(size) for size in args.sizes.split(',') if size]:
+        results['results'][str(size)] = run_suite(
+            size, repeat=args.repeat, exec_repeat=args.exec_repeat, depth=args.depth, width=args.width,
+            store=args.store,
+        )
+    for env_size in [int(size) for size in args.env_sizes.split(',') if size]:
+        results['environment'][str(env_size)] = run_env_suite(env_size, repeat=args.exec_repeat)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as buff:
+            buff.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as buff:
+            baseline = json.load(buff)
+        regressions = compare(results, baseline, args.threshold)
+        for size, name, old_value, value in regressions:
+            if name.endswith('_bytes'):
+                change = f'{old_value} -> {value} bytes'
+            else:
+                change = f'{old_value * 1000:.2f}ms -> {value * 1000:.2f}ms'
+            print(f'REGRESSION size={size} {name}: {change}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,1240 @@
-from unittest import TestCase
+import io
+import json
+import multiprocessing
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock
+
+import switchenv
+from switchenv import api
+from switchenv.cache import FileCache
+from switchenv.daemon import ProfileServer, request as daemon_request
+from switchenv.tests import benchmarks
+from switchenv.transfer import NDJSON_FORMAT, ImportConflictError, read_profiles
+from switchenv.environ import apply_delta, delta_to_shell, diff_environments, direct_argv, normalize_path_list
+from switchenv.environ import ProbeError, parse_env_output, parse_static_exports, unexpected_unsets
+from switchenv.index import NameIndex
+from switchenv.providers import ProviderError, parse_provider_file
+from switchenv.resolver import ProfileCycleError, ProfileGraph
+from switchenv.storage import ConcurrentModificationError, JSONStore, ReadOnlyStoreError, SQLiteStore, convert_store
+from switchenv.switchenv import BlobDirHandler, CachedProfileError, SwitchEnv, parse_fast_args, print_switch
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# Runs the sw entry point against the config directory passed as the first argument
+SW_SCRIPT = (
+    'import sys; from switchenv.switchenv import SwitchEnv, main; '
+    'SwitchEnv.BLOB_DIR = sys.argv.pop(1); main()'
+)
+
+
+def run_sw(home, *args, python_args=(), extra_env=None, **kwargs):
+    env = dict(os.environ, HOME=home, PYTHONPATH=REPO_DIR, **(extra_env or {}))
+    return subprocess.run(
+        [sys.executable, *python_args, '-c', SW_SCRIPT, os.path.join(home, '.switchenv'), *args],
+        env=env, capture_output=True, text=True, **kwargs
+    )
+
+
+class SwitchEnvTestCase(TestCase):
+    """
+    Points both the config directory and HOME at a scratch directory
+    """
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.blob_dir = os.path.join(self.home, '.switchenv')
+
+        blob_dir_patcher = mock.patch.object(SwitchEnv, 'BLOB_DIR', self.blob_dir)
+        blob_dir_patcher.start()
+        self.addCleanup(blob_dir_patcher.stop)
+
+        env_patcher = mock.patch.dict(os.environ, {'HOME': self.home})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+
+        # Start the Python API afresh, as a new process would
+        for name, value in [('_local', threading.local()), ('_deltas', {})]:
+            patcher = mock.patch.object(api, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.addCleanup(shutil.rmtree, self.home, ignore_errors=True)
+
+    def write_bashrc(self, text):
+        with open(os.path.join(self.home, '.bashrc'), 'w') as buff:
+            buff.write(text)
+
+
+class FileCacheTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def test_put_then_get(self):
+        cache = FileCache(self.directory, suffix='.sh')
+        path = cache.put('abc', 'echo hi')
+        self.assertEqual(cache.get('abc'), path)
+        self.assertEqual(cache.read('abc'), 'echo hi')
+        self.assertIsNone(cache.get('missing'))
+
+    def test_evicts_least_recently_used(self):
+        cache = FileCache(self.directory, max_bytes=10)
+        cache.put('old', 'x' * 6)
+        os.utime(cache.path_for('old'), (0, 0))
+        cache.put('new', 'y' * 6)
+        self.assertIsNone(cache.get('old'))
+        self.assertIsNotNone(cache.get('new'))
+
+    def test_clear(self):
+        cache = FileCache(self.directory)
+        cache.put('a', '1')
+        cache.put('b', '2')
+        self.assertEqual(cache.clear(), 2)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+class RcCacheTests(SwitchEnvTestCase):
+    def test_warm_activation_skips_rendering(self):
+        swenv = SwitchEnv()
+        rc_file = swenv.make_temp_rc_file('dev', 'export A=1')
+        with mock.patch.object(SwitchEnv, 'render_rc') as render_rc:
+            self.assertEqual(swenv.make_temp_rc_file('dev', 'export A=1'), rc_file)
+            render_rc.assert_not_called()
+
+    def test_bashrc_change_invalidates(self):
+        swenv = SwitchEnv()
+        self.write_bashrc('export FROM_BASHRC=1\n')
+        rc_file = swenv.make_temp_rc_file('dev', 'export A=1')
+        self.write_bashrc('export FROM_BASHRC=22\n')
+        new_rc_file = swenv.make_temp_rc_file('dev', 'export A=1')
+        self.assertNotEqual(new_rc_file, rc_file)
+        with open(new_rc_file) as buff:
+            self.assertIn('FROM_BASHRC=22', buff.read())
+
+    def test_inherited_environment_survives_bashrc(self):
+        SwitchEnv().update_raw('dev', 'export A=1')
+        self.write_bashrc('export TRICKY=reset\n')
+        tricky = 'a "quoted" $value `x` \'single\'\n\nline3'
+
+        result = run_sw(self.home, 'exec', '-p', 'dev', 'printenv TRICKY', extra_env={'TRICKY': tricky})
+        self.assertEqual(result.stdout, tricky + '\n')
+        with mock.patch.dict(os.environ, {'TRICKY': tricky}):
+            with open(SwitchEnv().make_temp_rc_file('dev', 'export A=1')) as buff:
+                self.assertNotIn('quoted', buff.read())
+
+
+class FastStartTests(SwitchEnvTestCase):
+    # Generous enough for a slow CI box, small enough to catch an eager import of click
+    IMPORT_BUDGET_US = 150000
+
+    def test_parse_fast_args(self):
+        self.assertEqual(parse_fast_args(['list']), ('list', {}))
+        self.assertEqual(parse_fast_args(['source', '-p', 'dev']), ('source', {'profile': 'dev'}))
+        self.assertEqual(
+            parse_fast_args(['exec', '--profile=dev', 'echo hi']),
+            ('exec', {'command': 'echo hi', 'profile': 'dev', 'direct': False})
+        )
+        self.assertEqual(parse_fast_args(['env', '--reset']), ('env', {'profile': None, 'reset': True}))
+        self.assertIsNone(parse_fast_args(['env', '-p', 'dev', '--reset']))
+        self.assertIsNone(parse_fast_args(['exec', '--help']))
+        self.assertIsNone(parse_fast_args(['source']))
+        self.assertIsNone(parse_fast_args(['show', '-p', 'dev']))
+
+    def test_scripted_commands_skip_click(self):
+        SwitchEnv().update_raw('dev', 'export A=1')
+        result = run_sw(self.home, 'list', python_args=['-X', 'importtime'])
+        self.assertEqual(result.stdout.strip(), 'dev')
+
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative_us, module = line.split('|')
+                if cumulative_us.strip().isdigit():
+                    cumulative[module.strip()] = int(cumulative_us)
+
+        self.assertNotIn('click', cumulative)
+        self.assertNotIn('fuzzypicker', cumulative)
+        self.assertLess(cumulative['switchenv.switchenv'], self.IMPORT_BUDGET_US)
+
+    def test_exec(self):
+        SwitchEnv().update_raw('dev', 'export A=from_dev')
+        result = run_sw(self.home, 'exec', '-p', 'dev', 'echo $A')
+        self.assertEqual(result.stdout.strip(), 'from_dev')
+
+
+class ProfileGraphTests(TestCase):
+    def setUp(self):
+        self.profiles = {
+            'base': {'code_type': 'raw', 'code': ''},
+            'db': {'code_type': 'raw', 'code': ''},
+            'tools': {'code_type': 'composed', 'code': ['base', 'db']},
+            'prod': {'code_type': 'composed', 'code': ['base', 'tools']},
+        }
+        self.lookups = []
+
+        def lookup(name):
+            self.lookups.append(name)
+            return self.profiles.get(name)
+
+        self.graph = ProfileGraph(lookup)
+
+    def test_resolution_is_deduplicated_and_memoized(self):
+        self.assertEqual(self.graph.resolve('prod'), ('base', 'db'))
+        lookup_count = len(self.lookups)
+        self.assertEqual(self.graph.resolve('prod'), ('base', 'db'))
+        self.assertEqual(len(self.lookups), lookup_count)
+
+    def test_rejects_cycles(self):
+        with self.assertRaises(ProfileCycleError):
+            self.graph.check('tools', ['prod'])
+        self.profiles['tools']['code'] = ['prod']
+        with self.assertRaises(ProfileCycleError):
+            self.graph.resolve('prod')
+
+    def test_invalidation_only_touches_dependents(self):
+        self.profiles['other'] = {'code_type': 'composed', 'code': ['db']}
+        self.graph.resolve('prod')
+        self.graph.resolve('other')
+
+        self.profiles['tools']['code'] = ['db']
+        self.graph.invalidate('tools')
+        self.assertEqual(set(self.graph._resolved), {'base', 'db', 'other'})
+        self.assertEqual(self.graph.resolve('prod'), ('base', 'db'))
+        self.assertEqual(self.graph.resolve('tools'), ('db',))
+
+
+class StorageTests(SwitchEnvTestCase):
+    def test_sqlite_migrates_json_store(self):
+        SwitchEnv().update_raw('dev', 'export A=1')
+        SwitchEnv().update_composed('both', ['dev'])
+
+        with mock.patch.dict(os.environ, {'SWITCHENV_STORE': 'sqlite'}):
+            swenv = SwitchEnv()
+            self.assertIsInstance(swenv.store, SQLiteStore)
+            self.assertEqual(swenv.keys, ['both', 'dev'])
+            self.assertFalse(JSONStore(self.blob_dir, '1.0').exists())
+
+            swenv.update_raw('dev', 'export A=2')
+            swenv.update_raw('other', 'export B=1')
+            self.assertEqual(swenv.get_code('both').split('\n')[-1], 'export A=2')
+
+        # The database is picked up without the environment variable
+        self.assertEqual(SwitchEnv().keys, ['both', 'dev', 'other'])
+
+    def test_instances_share_views_until_file_changes(self):
+        SwitchEnv().update_raw('dev', 'export A=1')
+        first, second = SwitchEnv(), SwitchEnv()
+        self.assertIs(first.blob, second.blob)
+        self.assertTrue(first.get_code('dev').endswith('export A=1'))
+
+        # Another process rewrites the file behind this one's back
+        other = JSONStore(self.blob_dir, '1.0')
+        blob = json.loads(json.dumps(other.load()))
+        blob['profiles']['dev']['code'] = 'export A=2'
+        blob['profiles']['new'] = dict(blob['profiles']['dev'])
+        other.replace(blob)
+
+        self.assertEqual(second.keys, ['dev', 'new'])
+        self.assertEqual([name for name, _ in second.items], ['dev', 'new'])
+        self.assertTrue(first.get_code('dev').endswith('export A=2'))
+
+
+class SnapshotTests(SwitchEnvTestCase):
+    ENV = {'HOME': '/home/me', 'PATH': '/usr/bin:/bin', 'LS_COLORS': 'di=34:' * 200, 'A': "it's", 'SHLVL': '2'}
+
+    def test_snapshots_share_their_values(self):
+        for backend in ['json', 'sqlite']:
+            with self.subTest(backend=backend), mock.patch.dict(os.environ, {'SWITCHENV_STORE': backend}):
+                blob_dir = os.path.join(self.home, backend)
+                with mock.patch.object(SwitchEnv, 'BLOB_DIR', blob_dir):
+                    swenv = SwitchEnv()
+                    swenv.update_snapshot('one', self.ENV)
+                    swenv.update_snapshot('two', dict(self.ENV, A='2'))
+
+                    values = {key: val for key, val in self.ENV.items() if key != 'SHLVL'}
+                    self.assertEqual(SwitchEnv().store.get('one')['code'], values)
+                    self.assertEqual(SwitchEnv().store.load()['profiles']['two']['code'], dict(values, A='2'))
+                    self.assertIn("export A='it'\"'\"'s'", swenv.get_code('one'))
+
+                    if backend == 'json':
+                        with open(os.path.join(blob_dir, 'profiles.json')) as buff:
+                            self.assertEqual(buff.read().count(self.ENV['LS_COLORS']), 1)
+                    else:
+                        count = 'SELECT COUNT(*) FROM snapshot_values'
+                        self.assertEqual(swenv.store.connection.execute(count).fetchone()[0], 5)
+                        swenv.store.write(deletes=['two'])
+                        self.assertEqual(swenv.store.connection.execute(count).fetchone()[0], 4)
+
+    def test_sqlite_prunes_only_values_nobody_uses(self):
+        os.makedirs(self.blob_dir)
+        store = SQLiteStore(self.blob_dir, '1.0')
+        store.write(updates={
+            'one': {'code_type': 'snapshot', 'code': {'A': 'shared', 'B': 'one'}},
+            'two': {'code_type': 'snapshot', 'code': {'A': 'shared', 'B': 'two'}},
+        })
+
+        # Databases saved before references were tracked get them filled in once
+        store.connection.execute('DROP TABLE snapshot_refs')
+        store.connection.execute("DELETE FROM meta WHERE key = 'snapshot_refs'")
+        store.close()
+        store = SQLiteStore(self.blob_dir, '1.0')
+
+        def stored_values():
+            return sorted(json.loads(value) for value, in store.connection.execute('SELECT value FROM snapshot_values'))
+
+        store.write(updates={'one': {'code_type': 'raw', 'code': ''}})
+        self.assertEqual(stored_values(), ['shared', 'two'])
+        store.write(updates={'three': {'code_type': 'snapshot', 'code': {'A': 'shared'}}}, deletes=['two'])
+        self.assertEqual(stored_values(), ['shared'])
+        self.assertEqual(store.get('three')['code'], {'A': 'shared'})
+        store.write(deletes=['three'])
+        self.assertEqual(stored_values(), [])
+
+    def test_old_snapshots_are_migrated(self):
+        swenv = SwitchEnv()
+        old_code = '\n'.join(f'export {key}="{val}"' for key, val in self.ENV.items() if key != 'A')
+        swenv.update_raw('old', old_code)
+        swenv.update_raw('quoted', delta_to_shell(diff_environments({}, self.ENV)))
+        swenv.update_raw('dev', 'export A=1')
+        swenv.update_raw('dynamic', old_code + '\nexport NOW="$(date)"')
+        code = swenv.get_code('quoted')
+
+        report = swenv.migrate_snapshots(dry_run=True)
+        self.assertEqual(report['migrated'], ['old', 'quoted'])
+        self.assertLess(report['bytes_after'], report['bytes_before'])
+        self.assertEqual(swenv.store.get('old')['code_type'], 'raw')
+
+        self.assertEqual(swenv.migrate_snapshots(), report)
+        self.assertEqual(swenv.store.get('quoted')['code_type'], 'snapshot')
+        self.assertEqual(swenv.store.get('old')['code']['LS_COLORS'], self.ENV['LS_COLORS'])
+        self.assertEqual(swenv.resolved_environment('quoted', swenv.get_code('quoted'))['set']['A'], "it's")
+        self.assertEqual(swenv.store.get('dynamic')['code_type'], 'raw')
+        self.assertNotEqual(swenv.get_code('quoted'), code)
+
+
+class LocationTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.location_file = os.path.join(self.directory, 'blob_location.json')
+
+        patcher = mock.patch.object(BlobDirHandler, 'FILE_DIR', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_location_file_is_read_once_and_never_written(self):
+        handler = BlobDirHandler()
+        self.assertEqual(handler.location, BlobDirHandler.DEFAULT_BLOB_DIR)
+        self.assertFalse(os.path.exists(self.location_file))
+
+        handler.change_blob_location('/somewhere')
+        with open(self.location_file, 'w') as buff:
+            json.dump({'location': '/elsewhere'}, buff)
+        self.assertEqual(BlobDirHandler().location, '/somewhere')
+
+        with mock.patch.dict(os.environ, {'SWITCHENV_HOME': self.directory}):
+            self.assertEqual(BlobDirHandler().location, os.path.realpath(self.directory))
+
+
+class LayeredStoreTests(SwitchEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        self.team_dir = os.path.join(self.home, 'team')
+        os.makedirs(self.team_dir)
+        JSONStore(self.team_dir, '1.0').write(updates={
+            'team_db': {'code_type': 'raw', 'code': 'export DB=team'},
+            'shadowed': {'code_type': 'raw', 'code': 'export WHO=team'},
+        })
+        SwitchEnv().update_raw('shadowed', 'export WHO=me')
+
+        env_patcher = mock.patch.dict(os.environ, {'SWITCHENV_SHARED': self.team_dir})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+
+    def test_personal_profiles_win_and_writes_stay_personal(self):
+        swenv = SwitchEnv()
+        self.assertEqual(swenv.keys, ['shadowed', 'team_db'])
+        self.assertTrue(swenv.get_code('shadowed').endswith('export WHO=me'))
+        self.assertTrue(swenv.get_code('team_db').endswith('export DB=team'))
+
+        swenv.update_composed('both', ['team_db', 'shadowed'])
+        self.assertEqual(JSONStore(self.team_dir, '1.0').names(), ['shadowed', 'team_db'])
+        self.assertEqual(JSONStore(self.blob_dir, '1.0').names(), ['both', 'shadowed'])
+
+        with self.assertRaises(ReadOnlyStoreError):
+            swenv.store.write(deletes=['team_db'])
+
+    def test_saving_the_merged_blob_leaves_shared_profiles_out(self):
+        swenv = SwitchEnv()
+        swenv.save(swenv.blob)
+        self.assertEqual(JSONStore(self.blob_dir, '1.0').names(), ['shadowed'])
+        self.assertEqual(swenv.keys, ['shadowed', 'team_db'])
+
+    def test_names_file_follows_shared_stores(self):
+        self.assertEqual(SwitchEnv().profile_names(), ['shadowed', 'team_db'])
+        JSONStore(self.team_dir, '1.0').write(updates={'team_web': {'code_type': 'raw', 'code': ''}})
+
+        # The completion script sees the shared store is newer than the names file, and asks sw
+        script = os.path.join(self.home, 'completion.bash')
+        with open(script, 'w') as buff:
+            buff.write(run_sw(self.home, 'completion').stdout)
+        names_file = os.path.join(self.blob_dir, 'profile_names')
+        check = ['bash', '-c', f'source {script}; _switchenv_names_file_is_current "$1"', 'check', names_file]
+        self.assertEqual(subprocess.run(check).returncode, 1)
+
+        self.assertEqual(SwitchEnv().profile_names(), ['shadowed', 'team_db', 'team_web'])
+        self.assertEqual(subprocess.run(check).returncode, 0)
+
+    def test_shared_sqlite_store_is_opened_read_only(self):
+        convert_store(self.team_dir, '1.0', 'sqlite')
+        os.chmod(self.team_dir, 0o555)
+        self.addCleanup(os.chmod, self.team_dir, 0o755)
+
+        self.assertTrue(SwitchEnv().get_code('team_db').endswith('export DB=team'))
+
+
+def add_profiles(worker, count):
+    for index in range(count):
+        SwitchEnv().update_raw(f'worker{worker}_{index}', f'export INDEX={index}')
+
+
+class ConcurrencyTests(SwitchEnvTestCase):
+    WORKERS = 8
+    PROFILES_PER_WORKER = 15
+
+    def assert_no_lost_updates(self):
+        # Forked workers inherit the patched config directory
+        context = multiprocessing.get_context('fork')
+        workers = [
+            context.Process(target=add_profiles, args=(worker, self.PROFILES_PER_WORKER))
+            for worker in range(self.WORKERS)
+        ]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        swenv = SwitchEnv()
+        self.assertEqual(len(swenv.keys), self.WORKERS * self.PROFILES_PER_WORKER)
+        self.assertEqual(swenv.store.generation(), self.WORKERS * self.PROFILES_PER_WORKER)
+        self.assertEqual([name for name in os.listdir(self.blob_dir) if name.startswith('__temp')], [])
+
+    def test_json_writers(self):
+        self.assert_no_lost_updates()
+
+    def test_sqlite_writers(self):
+        with mock.patch.dict(os.environ, {'SWITCHENV_STORE': 'sqlite'}):
+            self.assert_no_lost_updates()
+
+    def test_threads_take_turns(self):
+        store = SwitchEnv().store
+        store.write(updates={'count': {'code_type': 'raw', 'code': '0'}})
+
+        def increment(_):
+            with store.locked():
+                count = int(store.get('count')['code'])
+                time.sleep(0.001)
+                store.write(updates={'count': {'code_type': 'raw', 'code': str(count + 1)}})
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(increment, range(40)))
+        self.assertEqual(store.get('count')['code'], '40')
+
+    def test_stale_blob_is_not_saved(self):
+        swenv = SwitchEnv()
+        swenv.update_raw('dev', 'export A=1')
+        stale_blob = swenv.blob
+        SwitchEnv().update_raw('other', 'export B=1')
+        with self.assertRaises(ConcurrentModificationError):
+            swenv.save(stale_blob)
+
+
+class BulkAddTests(SwitchEnvTestCase):
+    def test_update_raw_many_saves_once(self):
+        swenv = SwitchEnv()
+        swenv.update_raw('a', 'export A=1')
+        generation = swenv.store.generation()
+
+        report = swenv.update_raw_many({'a': 'export A=1', 'b': 'export B=1', 'c': 'export C=1'}, dry_run=True)
+        self.assertEqual(report, {'added': ['b', 'c'], 'updated': [], 'unchanged': ['a']})
+        self.assertEqual(swenv.store.generation(), generation)
+
+        report = swenv.update_raw_many({'a': 'export A=2', 'b': 'export B=1'})
+        self.assertEqual(report, {'added': ['b'], 'updated': ['a'], 'unchanged': []})
+        self.assertEqual(swenv.store.generation(), generation + 1)
+        self.assertEqual(swenv.keys, ['a', 'b'])
+
+
+class TransferTests(SwitchEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        SwitchEnv().update_raw_many({'db_dev': 'export DB=dev', 'db_prod': 'export DB=prod', 'web': 'export W=1'})
+
+    def export(self, *args):
+        result = run_sw(self.home, 'export-config', '--format', 'ndjson', *args)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout
+
+    def test_export_filters_one_profile_per_line(self):
+        lines = self.export('-g', 'db_*').splitlines()
+        self.assertEqual(json.loads(lines[0]), {'format': 'switchenv-ndjson', 'version': '1.0'})
+        self.assertEqual([json.loads(line)['name'] for line in lines[1:]], ['db_dev', 'db_prod'])
+
+    def assert_import_is_atomic(self):
+        exported = self.export('-p', 'db_dev', '-p', 'web')
+        swenv = SwitchEnv()
+        swenv.update_raw_many({'db_dev': 'export DB=changed', 'web': 'export W=2'})
+        generation = swenv.store.generation()
+
+        with self.assertRaises(ImportConflictError) as context:
+            swenv.import_profiles(read_profiles(io.StringIO(exported), '1.0'))
+        self.assertEqual(context.exception.names, ['db_dev', 'web'])
+        self.assertEqual(swenv.store.generation(), generation)
+        self.assertTrue(swenv.get_code('web').endswith('export W=2'))
+
+        with self.assertRaises(ValueError):
+            swenv.import_profiles(read_profiles(io.StringIO(exported + '{"oops"\n'), '1.0'), overwrite=True)
+        self.assertEqual(SwitchEnv().store.generation(), generation)
+
+    def test_json_store_import_is_atomic(self):
+        self.assert_import_is_atomic()
+
+    def test_sqlite_store_import_is_atomic(self):
+        with mock.patch.dict(os.environ, {'SWITCHENV_STORE': 'sqlite'}):
+            self.assert_import_is_atomic()
+
+    def test_merge_and_replace(self):
+        exported = self.export('-g', 'db_*').replace('export DB=dev', 'export DB=new')
+        swenv = SwitchEnv()
+
+        report = swenv.import_profiles(read_profiles(io.StringIO(exported), '1.0'), overwrite=True)
+        self.assertEqual(report, {'added': [], 'updated': ['db_dev'], 'unchanged': ['db_prod'], 'deleted': []})
+
+        swenv.update_raw('db_dev', 'export DB=dev')
+        report = swenv.import_profiles(read_profiles(io.StringIO(exported), '1.0'), replace=True)
+        self.assertEqual(report, {'added': [], 'updated': ['db_dev'], 'unchanged': ['db_prod'], 'deleted': ['web']})
+        self.assertEqual(swenv.keys, ['db_dev', 'db_prod'])
+
+    def test_import_refuses_composed_cycles(self):
+        def ndjson(*entries):
+            lines = [json.dumps({'format': NDJSON_FORMAT, 'version': '1.0'})]
+            lines += [json.dumps(dict(name=name, code_type='composed', code=code)) for name, code in entries]
+            return io.StringIO('\n'.join(lines) + '\n')
+
+        swenv = SwitchEnv()
+        swenv.update_composed('both', ['web', 'db_dev'])
+        before = self.export()
+
+        cases = [
+            ('import', ndjson(('a', ['b']), ('b', ['a'])), {}),
+            ('merge', ndjson(('web', ['both'])), {'overwrite': True}),
+        ]
+        for label, buff, kwargs in cases:
+            with self.subTest(label):
+                with self.assertRaises(ProfileCycleError):
+                    SwitchEnv().import_profiles(read_profiles(buff, '1.0'), **kwargs)
+                self.assertEqual(self.export(), before)
+
+        # Replacing drops the saved profiles, so they can't close a cycle
+        report = SwitchEnv().import_profiles(read_profiles(ndjson(('web', ['both'])), '1.0'), replace=True)
+        self.assertEqual(report['updated'], ['web'])
+
+    def test_derived_exports_are_worked_out_again(self):
+        exported = self.export('-p', 'web')
+        self.assertNotIn('exports', json.loads(exported.splitlines()[1]))
+
+        # Profiles from exports with or without the field are the same as the saved ones
+        swenv = SwitchEnv()
+        stale = exported.replace('"code_type"', '"exports": {"W": "1"}, "code_type"')
+        for text in [exported, stale]:
+            report = swenv.import_profiles(read_profiles(io.StringIO(text), '1.0'))
+            self.assertEqual(report['unchanged'], ['web'])
+
+        # Forged exports never reach the store
+        forged = exported.replace('"code_type"', '"exports": {"W": "evil"}, "code_type"').replace('W=1', 'W=2')
+        swenv.import_profiles(read_profiles(io.StringIO(forged), '1.0'), overwrite=True)
+        self.assertEqual(swenv.store.get('web')['exports'], {'W': '2'})
+        self.assertEqual(swenv.static_delta('web', env={})['set']['W'], '2')
+
+    def test_import_command_reads_old_json_exports(self):
+        export_file = os.path.join(self.home, 'export.json')
+        with open(export_file, 'w') as buff:
+            json.dump({'old_style': 'export OLD=1'}, buff)
+
+        result = run_sw(self.home, 'import-config', '--merge', '-f', export_file)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(SwitchEnv().keys, ['db_dev', 'db_prod', 'old_style', 'web'])
+
+
+class SwitchTests(SwitchEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        SwitchEnv().update_raw_many({
+            'a': 'export A=1\nexport SHARED=a',
+            'b': "export B='it''s $HOME'\nexport SHARED=b\nunset GONE",
+        })
+
+    def switch(self, *switches):
+        sw = ' '.join(shlex.quote(arg) for arg in [sys.executable, '-c', SW_SCRIPT, self.blob_dir, 'env'])
+        script = ''.join(f'eval "$({sw} {switch})" || exit 1\n' for switch in switches) + 'env -0'
+        env = dict(os.environ, PYTHONPATH=REPO_DIR, GONE='here', SHARED='original')
+        result = subprocess.run(['bash', '-c', script], env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return parse_env_output(result.stdout)
+
+    def test_switching_undoes_the_previous_profile(self):
+        env = self.switch('-p a')
+        self.assertEqual((env['A'], env['SHARED'], env['SWITCHENV_PROFILE']), ('1', 'a', 'a'))
+
+        env = self.switch('-p a', '-p b')
+        self.assertNotIn('A', env)
+        self.assertNotIn('GONE', env)
+        self.assertEqual((env['B'], env['SHARED']), ('its $HOME', 'b'))
+
+        env = self.switch('-p a', '-p b', '--reset')
+        self.assertEqual((env['SHARED'], env['GONE']), ('original', 'here'))
+        for key in ['A', 'B', 'SWITCHENV_PROFILE', '__SWITCHENV_STATE']:
+            self.assertNotIn(key, env)
+
+    def test_unknown_profile_prints_nothing_to_eval(self):
+        result = run_sw(self.home, 'env', '-p', 'nope')
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stdout, '')
+
+    def test_failed_probes_print_nothing_to_eval(self):
+        self.write_bashrc('case $- in\n    *i*) ;;\n      *) return;;\nesac\n')
+        result = run_sw(self.home, 'env', '-p', 'a')
+        self.assertEqual((result.returncode, result.stdout), (1, ''))
+        self.assertIn("could not work out what profile 'a' changes", result.stderr)
+
+    def test_essential_variables_are_only_unset_on_purpose(self):
+        delta = {'set': {}, 'unset': ['GONE', 'HOME', 'PATH'], 'functions': False}
+        self.assertEqual(unexpected_unsets(delta, 'unset GONE'), ['PATH', 'HOME'])
+        self.assertEqual(unexpected_unsets(delta, 'unset GONE PATH\nexport HOME=/x'), ['HOME'])
+
+        stdout = io.StringIO()
+        with mock.patch.object(SwitchEnv, 'activation_delta', return_value=delta), \
+                mock.patch('sys.stdout', stdout), mock.patch('sys.stderr', io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit):
+                print_switch('b')
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn('would unset PATH and HOME', stderr.getvalue())
+
+
+class CachedProfileTests(SwitchEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls_file = os.path.join(self.home, 'calls')
+        swenv = SwitchEnv()
+        swenv.update_cached(
+            'secrets', f"echo x >> '{self.calls_file}'\nexport TOKEN=\"$(echo 's3cr3t it''s')\"", ttl=60
+        )
+        swenv.update_raw('dev', 'export A=1')
+        swenv.update_composed('prod', ['dev', 'secrets'])
+
+    def call_count(self):
+        with open(self.calls_file) as buff:
+            return len(buff.read().split())
+
+    def test_exports_are_reused_until_refreshed(self):
+        code = SwitchEnv().get_code('prod')
+        self.assertIn("export TOKEN='s3cr3t its'", code)
+        self.assertEqual(SwitchEnv().get_code('prod'), code)
+        self.assertEqual(self.call_count(), 1)
+
+        cache_files = [path for path, _ in SwitchEnv().exports_cache.entries()]
+        self.assertEqual(len(cache_files), 1)
+        self.assertEqual(os.stat(cache_files[0]).st_mode & 0o077, 0)
+
+        self.assertEqual(SwitchEnv().refresh(['prod']), ['secrets'])
+        SwitchEnv().get_code('prod')
+        self.assertEqual(self.call_count(), 2)
+
+    def test_exports_expire(self):
+        swenv = SwitchEnv()
+        swenv.get_code('secrets')
+        with mock.patch('time.time', return_value=time.time() + 61):
+            swenv.get_code('secrets')
+        self.assertEqual(self.call_count(), 2)
+
+    def test_failures_are_not_cached(self):
+        swenv = SwitchEnv()
+        swenv.update_cached('broken', 'export TOKEN=1\nexit 3')
+        with self.assertRaises(CachedProfileError):
+            swenv.get_code('broken')
+        self.assertEqual(swenv.exports_cache.entries(), [])
+
+    def test_failures_are_reported_on_stderr(self):
+        SwitchEnv().update_cached('broken', 'export TOKEN=1\nexit 3')
+        result = run_sw(self.home, 'env', '-p', 'broken')
+        self.assertEqual((result.returncode, result.stdout), (1, ''))
+        self.assertIn("Cached profile 'broken' exited with code 3", result.stderr)
+
+        with self.assertRaises(switchenv.ActivationError):
+            api.get_environ('broken')
+
+
+class ProviderProfileTests(SwitchEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cert_file = os.path.join(self.home, 'ca.pem')
+        with open(self.cert_file, 'w') as buff:
+            buff.write("it's a cert\n")
+        swenv = SwitchEnv()
+        swenv.update_raw('dev', 'export A=1')
+        swenv.update_providers('tokens', {
+            'CERT': f'file:{self.cert_file}',
+            'ME': 'env:HOME',
+        })
+        swenv.update_providers('slow', {'ONE': 'cmd:sleep 1; echo one'})
+        swenv.update_providers('also_slow', {'TWO': 'cmd:sleep 1; echo two'}, timeout=5)
+        swenv.update_composed('prod', ['dev', 'tokens', 'slow', 'also_slow'])
+
+    def test_values_are_exported(self):
+        code = SwitchEnv().get_code('prod')
+        self.assertIn("export CERT='it'\"'\"'s a cert'", code)
+        self.assertIn(f"export ME={self.home}", code)
+        self.assertIn('export ONE=one', code)
+        self.assertIn('export TWO=two', code)
+        self.assertLess(code.index('export A=1'), code.index('export CERT'))
+
+    def test_providers_run_concurrently(self):
+        started = time.time()
+        SwitchEnv().get_code('prod')
+        self.assertLess(time.time() - started, 1.9)
+
+    def test_values_are_fetched_every_time(self):
+        swenv = SwitchEnv()
+        swenv.get_code('tokens')
+        with open(self.cert_file, 'w') as buff:
+            buff.write('new cert')
+        self.assertIn("export CERT='new cert'", swenv.get_code('tokens'))
+
+    def test_failures_and_timeouts_are_reported(self):
+        swenv = SwitchEnv()
+        swenv.update_providers('broken', {
+            'GONE': 'file:/no/such/file',
+            'FAILS': 'cmd:exit 3',
+            'HANGS': 'cmd:sleep 30',
+        }, timeout=0.5)
+        started = time.time()
+        with self.assertRaises(switchenv.ActivationError) as raised:
+            swenv.get_code('broken')
+        self.assertLess(time.time() - started, 5)
+        self.assertIn('/no/such/file', str(raised.exception))
+        self.assertIn('exited with code 3', str(raised.exception))
+        self.assertIn('no answer within 0.5 seconds', str(raised.exception))
+
+        swenv.update_providers('fails', {'FAILS': 'cmd:exit 3'})
+        with self.assertRaises(switchenv.ActivationError):
+            api.get_environ('fails')
+        result = run_sw(self.home, 'exec', '-p', 'fails', 'true')
+        self.assertEqual(result.returncode, 1)
+        self.assertIn('Could not fetch provider values', result.stderr)
+
+    def test_bad_references_are_refused(self):
+        with self.assertRaises(ProviderError):
+            SwitchEnv().update_providers('bad', {'X': 'http://example.com'})
+        with self.assertRaises(ProviderError):
+            parse_provider_file('X=cmd:true\nnot a line\n')
+        self.assertEqual(
+            parse_provider_file('# tokens\n\nX=cmd:echo a=b\nY = env:USER\n'),
+            {'X': 'cmd:echo a=b', 'Y': 'env:USER'},
+        )
+
+
+class NormalizationTests(SwitchEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tools = os.path.join(self.home, 'tools')
+        os.makedirs(self.tools)
+        patcher = mock.patch.dict(os.environ, {'PATH': f'/usr/bin:/bin:{self.tools}:/usr/bin'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        swenv = SwitchEnv()
+        swenv.update_raw('tools', f'export PATH="{self.tools}:/no/such/dir:$PATH"')
+        swenv.update_raw('more_tools', f'export PATH="{self.tools}:$PATH"')
+        swenv.update_composed('both', ['tools', 'more_tools'])
+
+    def test_path_lists(self):
+        self.assertEqual(normalize_path_list('a:b:a::b:'), 'a:b:')
+        self.assertEqual(normalize_path_list(f'{self.tools}:/no/such/dir:', drop_missing=True), f'{self.tools}:')
+
+    def test_activation_keeps_first_occurrences(self):
+        swenv = SwitchEnv()
+        delta = swenv.resolved_environment('both', swenv.get_code('both'))
+        self.assertEqual(delta['set']['PATH'], f'{self.tools}:/no/such/dir:/usr/bin:/bin')
+
+        swenv.DROP_MISSING_DIRS = True
+        delta = swenv.resolved_environment('both', swenv.get_code('both'))
+        self.assertEqual(delta['set']['PATH'], f'{self.tools}:/usr/bin:/bin')
+
+        result = run_sw(self.home, 'exec', '-p', 'both', 'printenv PATH')
+        self.assertEqual(result.stdout.strip(), f'{self.tools}:/no/such/dir:/usr/bin:/bin')
+
+    def test_normalizing_can_be_turned_off(self):
+        with mock.patch.dict(os.environ, {'SWITCHENV_NORMALIZE': ''}):
+            swenv = SwitchEnv()
+            delta = swenv.resolved_environment('tools', swenv.get_code('tools'))
+        self.assertEqual(delta['set']['PATH'], f'{self.tools}:/no/such/dir:/usr/bin:/bin:{self.tools}:/usr/bin')
+
+    def test_show_reports_reductions(self):
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            SwitchEnv().show(['both'])
+        self.assertIn('# PATH: 7 entries -> 4 (3 removed)', stdout.getvalue())
+
+
+class StaticExportsTests(SwitchEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        swenv = SwitchEnv()
+        swenv.update_raw(
+            'db', "# prod database\nexport PGHOST=db.example.com  # primary\nexport PGPASSWORD='it'\"'\"'s'"
+        )
+        swenv.update_raw('dynamic', 'export NOW="$(date)"')
+        swenv.update_snapshot('base', {'HOME': self.home, 'PGHOST': 'localhost'})
+        swenv.update_composed('prod', ['base', 'db'])
+        swenv.update_composed('mixed', ['db', 'dynamic'])
+
+    def test_parser(self):
+        self.assertEqual(parse_static_exports('export A=1\nexport B="x y"\nexport C=\'$z\'\n'), {
+            'A': '1', 'B': 'x y', 'C': '$z',
+        })
+        for code in ['export A="$HOME"', 'export A=1; rm x', 'export A=a#b', 'export A=~/x', 'f() { :; }', 'A=1']:
+            self.assertIsNone(parse_static_exports(code), code)
+
+    def test_exports_are_saved_with_the_code(self):
+        store = SwitchEnv().store
+        self.assertEqual(store.get('db')['exports'], {'PGHOST': 'db.example.com', 'PGPASSWORD': "it's"})
+        self.assertIsNone(store.get('dynamic')['exports'])
+
+    def test_static_profiles_skip_bash(self):
+        swenv = SwitchEnv()
+        with mock.patch('subprocess.run') as run:
+            delta = swenv.static_delta('prod', env={'HOME': '/elsewhere'})
+            run.assert_not_called()
+        self.assertEqual(delta['set'], {'HOME': self.home, 'PGHOST': 'db.example.com', 'PGPASSWORD': "it's"})
+        # The same as bash makes of it, except for the prompt bash keeps for subshells
+        resolved = swenv.resolved_environment('prod', swenv.get_code('prod'), env={'HOME': '/elsewhere'})
+        resolved['set'].pop('__PSSWE__')
+        self.assertEqual(delta, resolved)
+
+        self.assertIsNone(swenv.static_delta('mixed'))
+
+    def test_bashrc_applies_to_static_profiles(self):
+        self.write_bashrc('export FROM_RC=yes\nexport PGHOST=from_rc')
+        swenv = SwitchEnv()
+        env = {'HOME': self.home, 'PATH': os.environ['PATH']}
+        delta = swenv.static_delta('prod', env=env)
+        self.assertEqual(delta['set']['FROM_RC'], 'yes')
+        self.assertEqual(delta['set']['PGHOST'], 'db.example.com')
+
+        resolved = swenv.resolved_environment('prod', swenv.get_code('prod'), env=env)
+        resolved['set'].pop('__PSSWE__')
+        self.assertEqual(delta, resolved)
+
+        # The bashrc is only run again when it or the environment changes
+        with mock.patch('subprocess.run') as run:
+            self.assertEqual(swenv.static_delta('prod', env=env), delta)
+            run.assert_not_called()
+
+        result = run_sw(self.home, 'exec', '--direct', '-p', 'prod', 'printenv FROM_RC')
+        self.assertEqual(result.stdout, 'yes\n')
+        result = run_sw(self.home, 'exec', '--direct', '-p', 'mixed', 'printenv PGHOST')
+        self.assertEqual(result.stdout, 'db.example.com\n')
+
+    def test_bashrc_that_returns_early_falls_back_to_bash(self):
+        # Like the stock Debian and Ubuntu bashrc, which stops in shells that aren't interactive
+        self.write_bashrc('case $- in\n    *i*) ;;\n      *) return;;\nesac\nexport FROM_RC=yes\n')
+        swenv = SwitchEnv()
+        for _ in range(2):
+            # Failures are never cached, so bash is asked again each time
+            with mock.patch('subprocess.run', wraps=subprocess.run) as run, self.assertRaises(ProbeError):
+                swenv.resolved_environment('prod', swenv.get_code('prod'))
+            run.assert_called_once()
+
+        # Static profiles can't skip bash when what the bashrc does is unknown
+        self.assertIsNone(swenv.static_delta('prod'))
+        with self.assertRaises(ProbeError):
+            api.get_environ('prod')
+
+        result = run_sw(self.home, 'exec', '--direct', '-p', 'prod', 'printenv HOME PATH')
+        self.assertEqual(result.stdout, f"{self.home}\n{os.environ['PATH']}\n")
+
+
+class ResolvedEnvironmentTests(SwitchEnvTestCase):
+    def test_delta_is_cached(self):
+        swenv = SwitchEnv()
+        delta = swenv.resolved_environment('dev', 'export A=1\nexport HOME=/elsewhere')
+        self.assertEqual(delta['set']['A'], '1')
+        self.assertEqual(apply_delta({'HOME': self.home}, delta)['HOME'], '/elsewhere')
+
+        with mock.patch('subprocess.run') as run:
+            self.assertEqual(swenv.resolved_environment('dev', 'export A=1\nexport HOME=/elsewhere'), delta)
+            run.assert_not_called()
+
+    def test_functions_and_aliases_need_bash(self):
+        swenv = SwitchEnv()
+        self.assertTrue(swenv.resolved_environment('dev', 'greet () { echo hi; }')['functions'])
+        self.assertTrue(swenv.resolved_environment('dev', 'alias ll="ls -l"')['functions'])
+        self.assertFalse(swenv.resolved_environment('dev', 'export A=1')['functions'])
+
+    def test_profile_output_is_ignored(self):
+        delta = SwitchEnv().resolved_environment('dev', 'echo "switched to prod"\nprintf "a\\0b"\nexport A=1')
+        self.assertEqual((delta['functions'], delta['set']['A']), (False, '1'))
+
+    def test_direct_argv(self):
+        self.assertEqual(direct_argv('psql -c "select 1"'), ['psql', '-c', 'select 1'])
+        self.assertEqual(direct_argv('printenv | grep PG'), ['bash', '-c', 'printenv | grep PG'])
+        self.assertEqual(direct_argv('A=1 env'), ['bash', '-c', 'A=1 env'])
+
+    def test_exec_direct(self):
+        SwitchEnv().update_raw('dev', 'export A=from_dev')
+        result = run_sw(self.home, 'exec', '--direct', '-p', 'dev', 'printenv A')
+        self.assertEqual(result.stdout.strip(), 'from_dev')
+
+
+class SearchTests(SwitchEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        SwitchEnv().update_raw_many({name: 'export A=1' for name in ['db_prod', 'web_prod', 'web_dev', 'analytics']})
+
+    def test_ranking(self):
+        swenv = SwitchEnv()
+        self.assertEqual(swenv.search('prod'), ['db_prod', 'web_prod'])
+        self.assertEqual(swenv.search('prd'), ['db_prod', 'web_prod'])
+        self.assertEqual(swenv.search('analitics'), ['analytics'])
+        self.assertEqual(swenv.search('zzz'), [])
+
+        # Among equally good matches, the most used profile comes first
+        swenv.usage.record('web_prod')
+        self.assertEqual(swenv.search('prod'), ['web_prod', 'db_prod'])
+        self.assertEqual(SwitchEnv().search('', limit=1), ['web_prod'])
+
+    def test_index_follows_store(self):
+        swenv = SwitchEnv()
+        self.assertEqual(NameIndex(swenv.store).names, ['analytics', 'db_prod', 'web_dev', 'web_prod'])
+
+        # A fresh index is read from disk without touching the store's profiles
+        with mock.patch.object(swenv.store, 'names') as names:
+            self.assertEqual(NameIndex(swenv.store).candidates('web'), ['web_dev', 'web_prod'])
+            names.assert_not_called()
+
+        swenv.update_raw('web_qa', 'export A=1')
+        self.assertEqual(swenv.search('web'), ['web_qa', 'web_dev', 'web_prod'])
+
+    def test_find_command(self):
+        self.assertEqual(parse_fast_args(['find', 'web']), ('find', {'query': 'web'}))
+        run_sw(self.home, 'exec', '-p', 'web_prod', 'true')
+        result = run_sw(self.home, 'find', 'web')
+        self.assertEqual(result.stdout.split(), ['web_prod', 'web_dev'])
+
+
+class CompletionTests(SwitchEnvTestCase):
+    def read_names_file(self):
+        with open(os.path.join(self.blob_dir, 'profile_names')) as buff:
+            return buff.read()
+
+    def test_names_file_follows_writes(self):
+        swenv = SwitchEnv()
+        swenv.update_raw_many({'web_prod': 'export A=1', 'db_prod': 'export A=2'})
+        self.assertEqual(self.read_names_file(), 'db_prod\nweb_prod\n')
+
+        swenv.update_composed('both', ['db_prod', 'web_prod'])
+        self.assertEqual(self.read_names_file(), 'both\ndb_prod\nweb_prod\n')
+
+        # Changing an existing profile leaves the names alone
+        with mock.patch.object(SwitchEnv, 'write_names_file') as write_names_file:
+            swenv.update_raw('db_prod', 'export A=3')
+            swenv.update_composed('both', ['db_prod'])
+            write_names_file.assert_not_called()
+
+        with mock.patch('builtins.input', return_value='y'):
+            swenv.delete(['both'])
+        self.assertEqual(self.read_names_file(), 'db_prod\nweb_prod\n')
+
+        swenv.save({'profiles': {'only': {'code_type': 'raw', 'code': ''}}})
+        self.assertEqual(self.read_names_file(), 'only\n')
+
+        os.unlink(os.path.join(self.blob_dir, 'profile_names'))
+        self.assertEqual(SwitchEnv().profile_names(), ['only'])
+        self.assertEqual(self.read_names_file(), 'only\n')
+
+    def test_bash_completion(self):
+        SwitchEnv().update_raw_many({'web_prod': 'export A=1', 'web_dev': 'export A=2', 'db_prod': 'export A=3'})
+        script = os.path.join(self.home, 'completion.bash')
+        with open(script, 'w') as buff:
+            buff.write(run_sw(self.home, 'completion').stdout)
+
+        def complete(word, command='exec', **extra_env):
+            result = subprocess.run(
+                ['bash', '-c', f'source {script}; COMP_WORDS=(sw {command} -p {word}); COMP_CWORD=3; _switchenv; '
+                               'printf "%s\\n" "${COMPREPLY[@]}"'],
+                env=dict(os.environ, HOME='/nonexistent', **extra_env), capture_output=True, text=True,
+            )
+            return result.stdout.split()
+
+        self.assertEqual(complete('web_'), ['web_dev', 'web_prod'])
+        self.assertEqual(complete('db', command='export-config'), ['db_prod'])
+
+        # SWITCHENV_HOME takes over from the directory the script was printed for
+        other_dir = os.path.join(self.home, 'other config')
+        with mock.patch.object(SwitchEnv, 'BLOB_DIR', other_dir):
+            SwitchEnv().update_raw('web_other', 'export A=4')
+        self.assertEqual(complete('web_', SWITCHENV_HOME=other_dir), ['web_other'])
+
+
+class DaemonTests(SwitchEnvTestCase):
+    def test_server_answers_and_reloads(self):
+        SwitchEnv().update_raw('dev', 'export A=1')
+        server = ProfileServer(SwitchEnv)
+
+        def respond(**request):
+            return json.loads(server.respond(json.dumps(request)))
+
+        self.assertEqual(respond(op='list'), {'ok': True, 'result': 'dev\n'})
+        self.assertIn('export A=1', respond(op='get-code', profile='dev')['result'])
+        self.assertEqual(respond(op='get-env', profile='dev', env={'HOME': self.home})['result']['set']['A'], '1')
+        self.assertFalse(respond(op='get-code', profile='missing')['ok'])
+
+        # Changes made by other processes are picked up on the next request
+        SwitchEnv().update_raw('dev', 'export A=2')
+        self.assertIn('export A=2', respond(op='get-code', profile='dev')['result'])
+
+    def start_daemon(self, extra_env=None):
+        socket_path = os.path.join(self.blob_dir, 'serve.sock')
+        env = dict(os.environ, HOME=self.home, PYTHONPATH=REPO_DIR, **(extra_env or {}))
+        daemon = subprocess.Popen(
+            [sys.executable, '-c', SW_SCRIPT, self.blob_dir, 'serve'], env=env, stderr=subprocess.DEVNULL
+        )
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(.05)
+        return daemon, socket_path
+
+    def test_daemon_serves_sqlite_store(self):
+        with mock.patch.dict(os.environ, {'SWITCHENV_STORE': 'sqlite'}):
+            SwitchEnv().update_raw('dev', 'export A=1')
+        daemon, socket_path = self.start_daemon({'SWITCHENV_STORE': 'sqlite'})
+        try:
+            for _ in range(10):
+                self.assertIn('export A=1', daemon_request(socket_path, {'op': 'get-code', 'profile': 'dev'}))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+    def test_client_uses_daemon(self):
+        SwitchEnv().update_raw('dev', 'export A=from_dev')
+        daemon, socket_path = self.start_daemon()
+        try:
+            trace_file = os.path.join(self.home, 'trace.jsonl')
+            result = run_sw(self.home, 'exec', '-p', 'dev', 'printenv A', extra_env={'SWITCHENV_TRACE': trace_file})
+            self.assertEqual(result.stdout.strip(), 'from_dev')
+            with open(trace_file) as buff:
+                self.assertIn('daemon.request', buff.read())
+        finally:
+            daemon.terminate()
+            daemon.wait()
+        self.assertFalse(os.path.exists(socket_path))
+
+        # Without the daemon, sw does the work itself
+        self.assertEqual(run_sw(self.home, 'exec', '-p', 'dev', 'printenv A').stdout.strip(), 'from_dev')
+
+
+class TraceTests(SwitchEnvTestCase):
+    def test_exec_writes_phases_and_counters(self):
+        SwitchEnv().update_raw('dev', 'export A=from_dev')
+        trace_file = os.path.join(self.home, 'trace.jsonl')
+        result = run_sw(self.home, 'exec', '-p', 'dev', 'printenv A', extra_env={'SWITCHENV_TRACE': trace_file})
+        self.assertEqual(result.stdout.strip(), 'from_dev')
+
+        with open(trace_file) as buff:
+            events = [json.loads(line) for line in buff]
+        names = [event['name'] for event in events if event['event'] == 'phase']
+        for name in ['imports', 'store.read', 'resolve', 'rc_cache.lookup', 'render', 'bash.activate']:
+            self.assertIn(name, names)
+
+        summary, = [event for event in events if event['event'] == 'summary']
+        self.assertEqual(summary['argv'], ['exec', '-p', 'dev', 'printenv A'])
+        # The compiled rc file and the usage table
+        self.assertEqual(summary['files_written'], 2)
+        self.assertGreaterEqual(summary['files_read'], 1)
+
+    def test_trace_flag_writes_to_stderr(self):
+        result = run_sw(self.home, '--trace', 'list')
+        events = [json.loads(line) for line in result.stderr.splitlines() if line.startswith('{')]
+        self.assertEqual(events[-1]['event'], 'summary')
+        self.assertEqual(events[-1]['argv'], ['list'])
+
+
+class ApiTests(SwitchEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        SwitchEnv().update_raw('dev', 'export PGHOST=dev.example.com\nunset SWITCHENV_TEST_VAR')
+
+    def test_get_environ(self):
+        with mock.patch.dict(os.environ, {'SWITCHENV_TEST_VAR': 'x'}):
+            env = switchenv.get_environ('dev')
+        self.assertEqual(env['PGHOST'], 'dev.example.com')
+        self.assertNotIn('SWITCHENV_TEST_VAR', env)
+        with self.assertRaises(KeyError):
+            switchenv.get_environ('nope')
+
+    def test_activated_restores_environment(self):
+        with mock.patch.dict(os.environ, {'SWITCHENV_TEST_VAR': 'x'}):
+            with switchenv.activated('dev'):
+                self.assertEqual(os.environ['PGHOST'], 'dev.example.com')
+                self.assertNotIn('SWITCHENV_TEST_VAR', os.environ)
+            self.assertNotIn('PGHOST', os.environ)
+            self.assertEqual(os.environ['SWITCHENV_TEST_VAR'], 'x')
+
+    def test_reuses_caches_until_store_changes(self):
+        switchenv.get_environ('dev')
+        with mock.patch.object(SwitchEnv, 'resolved_environment') as resolved_environment:
+            switchenv.get_environ('dev')
+            resolved_environment.assert_not_called()
+
+        SwitchEnv().update_raw('dev', 'export PGHOST=moved.example.com')
+        self.assertEqual(switchenv.get_environ('dev')['PGHOST'], 'moved.example.com')
+
+    def test_cached_profiles_expire(self):
+        token_file = os.path.join(self.home, 'token')
+        with open(token_file, 'w') as buff:
+            buff.write('one')
+        SwitchEnv().update_cached('secrets', f"export TOKEN=\"$(cat '{token_file}')\"", ttl=60)
+        self.assertEqual(switchenv.get_environ('secrets')['TOKEN'], 'one')
+
+        with open(token_file, 'w') as buff:
+            buff.write('two')
+        self.assertEqual(switchenv.get_environ('secrets')['TOKEN'], 'one')
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(switchenv.get_environ('secrets')['TOKEN'], 'two')
+
+    def test_provider_values_are_fetched_every_time(self):
+        token_file = os.path.join(self.home, 'token')
+        with open(token_file, 'w') as buff:
+            buff.write('one')
+        SwitchEnv().update_providers('tokens', {'TOKEN': f'file:{token_file}'})
+        self.assertEqual(switchenv.get_environ('tokens')['TOKEN'], 'one')
+
+        with open(token_file, 'w') as buff:
+            buff.write('two')
+        self.assertEqual(switchenv.get_environ('tokens')['TOKEN'], 'two')
+
+    def test_threads_with_sqlite_store(self):
+        with mock.patch.dict(os.environ, {'SWITCHENV_STORE': 'sqlite'}):
+            SwitchEnv().update_raw('db', 'export PGHOST=db.example.com')
+            self.assertEqual(switchenv.get_environ('db')['PGHOST'], 'db.example.com')
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                hosts = list(executor.map(lambda name: switchenv.get_environ(name)['PGHOST'], ['db', 'dev'] * 4))
+        self.assertEqual(hosts, ['db.example.com', 'dev.example.com'] * 4)
+
+
+class FanoutTests(SwitchEnvTestCase):
+    def test_fanout_exec(self):
+        SwitchEnv().update_raw_many({f'db{index}': f'export N={index}' for index in range(4)})
+        result = run_sw(self.home, 'exec', '-g', 'db*', '-j', '4', 'bash -c "echo n=$N; exit $N"')
+
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(sorted(result.stdout.splitlines()), [f'[db{index}] n={index}' for index in range(4)])
+        self.assertIn('1 succeeded, 3 failed', result.stderr)
+
+    def test_fanout_log_dir(self):
+        SwitchEnv().update_raw_many({'a': 'export N=a', 'b': 'export N=b'})
+        log_dir = os.path.join(self.home, 'logs')
+        result = run_sw(self.home, 'exec', '-p', 'a', '-p', 'b', '--log-dir', log_dir, 'printenv N')
+
+        self.assertEqual(result.returncode, 0)
+        for name in ['a', 'b']:
+            with open(os.path.join(log_dir, f'{name}.log')) as buff:
+                self.assertEqual(buff.read(), f'{name}\n')
+
+    def test_fanout_in_config_dir_with_spaces(self):
+        home = os.path.join(self.home, 'my home')
+        with mock.patch.object(SwitchEnv, 'BLOB_DIR', os.path.join(home, '.switchenv')):
+            SwitchEnv().update_raw_many({'a': 'export N=a', 'b': 'export N=b'})
+        result = run_sw(home, 'exec', '-p', 'a', '-p', 'b', 'printenv N')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(sorted(result.stdout.splitlines()), ['[a] a', '[b] b'])
+
+    def test_exec_in_config_dir_with_quotes(self):
+        # Profiles that define functions are always run through an rc file in the config dir
+        home = os.path.join(self.home, "it's home")
+        with mock.patch.object(SwitchEnv, 'BLOB_DIR', os.path.join(home, '.switchenv')):
+            SwitchEnv().update_raw_many({'a': 'f() { :; }\nexport N=a', 'b': 'f() { :; }\nexport N=b'})
+        result = run_sw(home, 'exec', '-p', 'a', '-p', 'b', 'printenv N')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(sorted(result.stdout.splitlines()), ['[a] a', '[b] b'])
+
+        result = run_sw(home, 'exec', '-p', 'a', 'printenv N')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout, 'a\n')
+
+    def test_fanout_with_cache_off(self):
+        SwitchEnv().update_raw_many({'a': 'export N=a', 'b': 'export N=b'})
+        result = run_sw(
+            self.home, 'exec', '-p', 'a', '-p', 'b', 'printenv N', extra_env={'SWITCHENV_CACHE_MAX_BYTES': '0'}
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(sorted(result.stdout.splitlines()), ['[a] a', '[b] b'])
+
+
+class ConcurrentExecTests(SwitchEnvTestCase):
+    EXECS = 200
+
+    def test_every_exec_sees_its_own_profile(self):
+        SwitchEnv().update_raw_many({f'p{index}': f'export WHO=p{index}' for index in range(self.EXECS)})
+
+        def run(index):
+            # Half the runs keep their rc file off disk entirely
+            cache_bytes = '0' if index % 2 else str(FileCache.DEFAULT_MAX_BYTES)
+            result = run_sw(
+                self.home, 'exec', '-p', f'p{index}', 'printenv WHO',
+                extra_env={'SWITCHENV_CACHE_MAX_BYTES': cache_bytes}
+            )
+            return result.stdout.strip()
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            outputs = list(executor.map(run, range(self.EXECS)))
+
+        self.assertEqual(outputs, [f'p{index}' for index in range(self.EXECS)])
+
+
+class BenchmarkTests(TestCase):
+    def test_generated_store_shape(self):
+        blob = benchmarks.generate_blob(100, depth=3, width=4, snapshot_every=10, snapshot_exports=200)
+        profiles = blob['profiles']
+        self.assertEqual(len(profiles), 100)
+        self.assertEqual(benchmarks.deepest_composed(blob)[:len('composed_3')], 'composed_3')
+        self.assertEqual(profiles['raw_000000']['code'].count('export'), 200)
+
+    def test_suite_runs_and_compares(self):
+        for store in ['json', 'sqlite']:
+            results = benchmarks.run_suite(20, repeat=1, exec_repeat=1, store=store)
+            self.assertIn('exec', results)
+            self.assertIn('blob_load_warm', results)
+            self.assertTrue(all(seconds > 0 for seconds in results.values()))
+
+        results = {'results': {'20': results}}
+        self.assertEqual(benchmarks.compare(results, results, threshold=0), [])
+        slower = {'results': {'20': {name: seconds * 2 for name, seconds in results['results']['20'].items()}}}
+        self.assertEqual(len(benchmarks.compare(slower, results, threshold=0.5)), len(results['results']['20']))
+
+    def test_rc_file_does_not_grow_with_environment(self):
+        small, large = benchmarks.run_env_suite(10, repeat=1), benchmarks.run_env_suite(1000, repeat=1)
+        self.assertEqual(small['rc_file_bytes'], large['rc_file_bytes'])
+        self.assertTrue(large['activate'] > 0)
 
 
 class SampleTest(TestCase):
     def test_1_equals_1(self):
-        self.assertEquals(1, 1)
+        self.assertEqual(1, 1)
@@ -0,0 +1,121 @@
+import json
+import os
+import sys
+import time
+
+# Taken when the package is first imported, so the first phase can report
+# how long the rest of the imports took
+IMPORT_STARTED = time.perf_counter()
+
+
+class Tracer:
+    """
+    Records wall-clock time per phase of a switchenv invocation along with
+    counts of the files it read and wrote.  Turned on by setting
+    SWITCHENV_TRACE, either to 1 (or stderr) to write json lines to stderr,
+    or to a file name to append them to that file.  When tracing is off,
+    every method returns immediately.
+    """
+    def __init__(self):
+        self.destination = None
+        self.events = []
+        self.counters = {'files_read': 0, 'files_written': 0}
+        self.started = IMPORT_STARTED
+        self.enable(os.environ.get('SWITCHENV_TRACE'))
+
+    def enable(self, destination):
+        self.destination = destination or None
+
+    @property
+    def enabled(self):
+        return self.destination is not None
+
+    def phase(self, name, **fields):
+        if self.destination is None:
+            return _NULL_PHASE
+        return _Phase(self, name, fields)
+
+    def record(self, name, seconds, **fields):
+        if self.destination is not None:
+            self.events.append(dict(event='phase', name=name, seconds=round(seconds, 6), **fields))
+
+    def count(self, counter, amount=1):
+        if self.destination is not None:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def shell_phase(self, name, started):
+        """
+        Returns bash code that records a phase which started at the epoch time
+        started (from time.time()) and ends when the code runs.  This is how
+        time spent in bash after Python has exec-ed it gets traced.
+        """
+        if self.destination is None:
+            return ''
+
+        started_us = int(started * 1000000)
+        line = f'{{"event": "phase", "name": "{name}", "seconds": %d.%06d, "pid": %d}}\\n'
+        if self.destination.lower() in {'1', 'true', 'yes', 'stderr'}:
+            redirect = '>&2'
+        else:
+            redirect = ">> '" + self.destination.replace("'", "'\\''") + "'"
+        return (
+            f'if [ -n "$EPOCHREALTIME" ]; then '
+            f'__switchenv_us=$(( ${{EPOCHREALTIME/[.,]/}} - {started_us} )); '
+            f"printf '{line}' $(( __switchenv_us / 1000000 )) $(( __switchenv_us % 1000000 )) $$ {redirect}; "
+            f'unset __switchenv_us; fi'
+        )
+
+    def flush(self, **fields):
+        """
+        Write out everything recorded so far, followed by a summary line.
+        Call this before exec-ing another program, because nothing else will
+        get the chance to.
+        """
+        if self.destination is None:
+            return
+
+        summary = dict(
+            event='summary',
+            argv=sys.argv[1:],
+            seconds=round(time.perf_counter() - self.started, 6),
+            **self.counters,
+            **fields
+        )
+        pid = os.getpid()
+        lines = [json.dumps(dict(event, pid=pid)) for event in self.events + [summary]]
+        self.events = []
+
+        text = '\n'.join(lines) + '\n'
+        if self.destination.lower() in {'1', 'true', 'yes', 'stderr'}:
+            sys.stderr.write(text)
+            sys.stderr.flush()
+        else:
+            with open(self.destination, 'a') as buff:
+                buff.write(text)
+
+
+class _Phase:
+    def __init__(self, tracer, name, fields):
+        self.tracer = tracer
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.record(self.name, time.perf_counter() - self.started, **self.fields)
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+tracer = Tracer()
@@ -0,0 +1,113 @@
+import fnmatch
+import json
+
+from .environ import parse_static_exports
+from .storage import upgrade_blob
+
+# The header line that starts a one-profile-per-line export
+NDJSON_FORMAT = 'switchenv-ndjson'
+
+CODE_TYPES = {'raw', 'snapshot', 'composed', 'cached', 'providers'}
+
+# Fields worked out from a profile's code whenever it is saved.  Exports leave
+# them out and imports ignore them, so they can never disagree with the code.
+DERIVED_FIELDS = {'exports'}
+
+
+class ImportConflictError(RuntimeError):
+    def __init__(self, names):
+        self.names = sorted(names)
+        super().__init__(f'These profiles already exist with different contents: {self.names}')
+
+
+def select_names(names, profiles=(), patterns=()):
+    """
+    Returns the names that are listed in profiles or match one of the glob
+    patterns, or all of them if neither is given
+    """
+    if not profiles and not patterns:
+        return list(names)
+    return [
+        name for name in names
+        if name in profiles or any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+    ]
+
+
+def without_derived(entry):
+    """
+    Returns the entry without the fields that are worked out from its code
+    """
+    return {key: val for key, val in entry.items() if key not in DERIVED_FIELDS}
+
+
+def with_derived(entry):
+    """
+    Returns the entry with its derived fields worked out from its code, as saving it would
+    """
+    entry = without_derived(entry)
+    if entry['code_type'] == 'raw':
+        entry['exports'] = parse_static_exports(entry['code'])
+    return entry
+
+
+def import_action(existing, entry, overwrite):
+    """
+    Returns what importing entry over the existing one does: 'added',
+    'updated' or 'unchanged', or None when it conflicts and can't overwrite it
+    """
+    if existing is None:
+        return 'added'
+    if without_derived(existing) == without_derived(entry):
+        return 'unchanged'
+    return 'updated' if overwrite else None
+
+
+def write_ndjson(store, out, names):
+    """
+    Write a header line and then one line per named profile, reading each
+    profile from the store only as it is written
+    """
+    out.write(json.dumps({'format': NDJSON_FORMAT, 'version': store.blob_version}) + '\n')
+    for name in names:
+        out.write(json.dumps(dict({'name': name}, **without_derived(store.get(name)))) + '\n')
+
+
+def read_profiles(buff, blob_version):
+    """
+    Yields (name, entry) pairs from an export.  An ndjson export is read one
+    line at a time.  A json export has to be read whole, and is upgraded if
+    it was saved by an older version of switchenv.  Raises ValueError for
+    anything that isn't a valid export.
+    """
+    first_line = buff.readline()
+    try:
+        header = json.loads(first_line)
+    except ValueError:
+        header = None
+
+    if not (isinstance(header, dict) and header.get('format') == NDJSON_FORMAT):
+        blob = upgrade_blob(json.loads(first_line + buff.read()), blob_version)
+        for name, entry in blob.get('profiles', {}).items():
+            yield name, check_entry(name, entry)
+        return
+
+    if header.get('version') != blob_version:
+        raise ValueError(f'Cannot import profiles saved in version {header.get("version")!r}')
+
+    for line_number, line in enumerate(buff, 2):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            name = entry.pop('name')
+        except (ValueError, KeyError, AttributeError, TypeError):
+            raise ValueError(f'Line {line_number} is not a profile')
+        yield name, check_entry(name, entry)
+
+
+def check_entry(name, entry):
+    if not isinstance(name, str) or not isinstance(entry, dict) or entry.get('code_type') not in CODE_TYPES:
+        raise ValueError(f'Not a valid profile: {name!r}')
+    if 'code' not in entry:
+        raise ValueError(f'Profile {name!r} has no code')
+    return without_derived(entry)